@@ -0,0 +1 @@
+# pytest puts the directory of this file on sys.path, so the tests import the checked out pyqserver
@@ -0,0 +1,71 @@
+import os
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .server import RECV_SIZE, Server
+from .session import BANNER, Session
+
+
+class AsyncServer(Server):
+    """Serves every connection from one event loop
+
+    At most `max_conns` sessions are served at a time, later connections wait
+    in the admission queue. Parsing and simulation run on a bounded thread
+    pool so a long simulation never blocks other clients' I/O.
+    """
+    def __init__(self, *args, workers: int = None, **kwargs):
+        super(AsyncServer, self).__init__(*args, **kwargs)
+        self.workers = workers or os.cpu_count() or 1
+
+    def _run(self):
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            print('\nShutting down quantum server')
+
+    async def _serve(self):
+        print('Starting quantum server on port %d with max %d connections' % \
+                (self.port, self.max_conns))
+        self.admission = asyncio.Semaphore(self.max_conns)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            self.executor = executor
+            server = await asyncio.start_server(self._handle_stream, '127.0.0.1', self.port)
+            async with server:
+                await server.serve_forever()
+
+    async def _handle_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info('peername')
+        loop = asyncio.get_running_loop()
+
+        # waiting in the admission queue for a free connection slot
+        async with self.admission:
+            self.num_conns += 1
+            print('Connected to %s' % str(addr))
+            try:
+                # sending initial info message
+                writer.write(BANNER)
+                await writer.drain()
+
+                # handling every complete line or record that has arrived so far
+                session = Session(self._get_simulator, self.verbose, self.debug, self.metrics)
+                try:
+                    while not session.closed:
+                        data = await reader.read(RECV_SIZE)
+                        replies = session.feed(data) if data else session.finish()
+                        while True:
+                            reply = await loop.run_in_executor(self.executor, next, replies, None)
+                            if reply is None: break
+                            writer.write(reply)
+                            await writer.drain()
+                        if not data: break
+                finally:
+                    await loop.run_in_executor(self.executor, session.close)
+
+            except ConnectionResetError:
+                print('Error: connection to %s reset' % str(addr), file=sys.stderr)
+
+            finally:
+                print('Connection to %s closed' % str(addr))
+                self.num_conns -= 1
+                writer.close()
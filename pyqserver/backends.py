@@ -0,0 +1,58 @@
+import importlib
+from typing import Dict, Tuple
+
+from .parser import *
+from .simulator import *
+
+
+# simulation method -> (module, class), a backend's module is imported on first use
+BACKENDS: Dict[str, Tuple[str, str]] = {
+    'qiskit': ('pyqserver.qiskit_simulator', 'QiskitSimulator'),
+    'cirq': ('pyqserver.cirq_simulator', 'CirqSimulator'),
+    'numpy': ('pyqserver.numpy_simulator', 'NumpySimulator'),
+    'sparse': ('pyqserver.sparse_simulator', 'SparseSimulator'),
+    'factored': ('pyqserver.factored_simulator', 'FactoredSimulator'),
+    'sharded': ('pyqserver.sharded_simulator', 'ShardedSimulator'),
+    'mps': ('pyqserver.mps_simulator', 'MPSSimulator'),
+    'stabilizer': ('pyqserver.stabilizer_simulator', 'StabilizerSimulator'),
+    'auto': ('pyqserver.stabilizer_simulator', 'AutoSimulator'),
+}
+
+# server options that only some backends take, see `Simulator.backend_options`
+BACKEND_OPTIONS = ('gpu', 'shards', 'bond_dim', 'truncation')
+
+# a small circuit that runs every step of a session's hot path
+WARMUP_COMMANDS = [Q(0), Q(1), H(0, []), CNOT(0, 1, []), T(1, []), M(0), M(1), R(0), R(1)]
+
+
+def register_backend(sim_method: str, module: str, class_name: str):
+    """Makes `module.class_name` available as `sim_method`, without importing it yet"""
+    BACKENDS[sim_method] = (module, class_name)
+
+
+def backend_class(sim_method: str) -> type:
+    if sim_method not in BACKENDS:
+        raise Exception('Invalid simulation method `%s`' % sim_method)
+    module, class_name = BACKENDS[sim_method]
+    return getattr(importlib.import_module(module), class_name)
+
+
+def create_simulator(sim_method: str, **options) -> Simulator:
+    # dropping the options of other backends
+    cls = backend_class(sim_method)
+    options = {name: value for name, value in options.items()
+               if name not in BACKEND_OPTIONS or name in cls.backend_options}
+    return cls(**options)
+
+
+def warm_up(simulator: Simulator):
+    """Runs `WARMUP_COMMANDS` on a simulator and closes it
+
+    The first session of a process then does not pay for importing the
+    backend and compiling its code paths.
+    """
+    try:
+        for command in WARMUP_COMMANDS:
+            simulator.execute(command)
+    finally:
+        simulator.close()
@@ -0,0 +1,450 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import signal
+import socket
+import platform
+import subprocess
+from threading import Thread
+from typing import Dict, List, Optional, Tuple
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import numpy as np
+
+from .parser import parse_command
+from .binary import REPLY, REPLY_HEADER, encode_command
+from .simulator import UsageError
+from .backends import backend_class, create_simulator
+
+
+SINGLE_QUBIT_GATES = ['X', 'Y', 'Z', 'H', 'S', 'S*', 'T', 'T*']
+CLIFFORD_GATES = ['X', 'Y', 'Z', 'H', 'S', 'S*']
+
+
+def _prepare(num_qubits: int) -> List[str]:
+    return ['Q %d' % q for q in range(num_qubits)]
+
+
+def _read_out(num_qubits: int) -> List[str]:
+    # measuring and reading (which also frees) every qubit
+    return ['M %d' % q for q in range(num_qubits)] + ['R %d' % q for q in range(num_qubits)]
+
+
+def _random_gates(num_qubits: int, num_gates: int, gates: List[str], rng: random.Random) -> List[str]:
+    lines = []
+    for _ in range(num_gates):
+        if num_qubits > 1 and rng.random() < 0.3:
+            x, y = rng.sample(range(num_qubits), 2)
+            lines.append('CNOT %d %d' % (x, y))
+        else:
+            lines.append('%s %d' % (rng.choice(gates), rng.randrange(num_qubits)))
+    return lines
+
+
+def clifford_t_round(num_qubits: int, num_gates: int, rng: random.Random) -> List[str]:
+    """Allocates qubits, applies random Clifford+T gates, then measures and reads every qubit"""
+    return _prepare(num_qubits) + _random_gates(num_qubits, num_gates, SINGLE_QUBIT_GATES, rng) + \
+           _read_out(num_qubits)
+
+
+def clifford_round(num_qubits: int, num_gates: int, rng: random.Random) -> List[str]:
+    """Like `clifford_t_round` without T gates, so stabilizer simulation applies"""
+    return _prepare(num_qubits) + _random_gates(num_qubits, num_gates, CLIFFORD_GATES, rng) + \
+           _read_out(num_qubits)
+
+
+def qft_round(num_qubits: int, num_gates: int, rng: random.Random) -> List[str]:
+    """Quantum Fourier transform of a random basis state (`num_gates` is unused)"""
+    lines = _prepare(num_qubits)
+    lines += ['X %d' % q for q in range(num_qubits) if rng.random() < 0.5]
+    for j in range(num_qubits):
+        lines.append('H %d' % j)
+        for k in range(j + 1, num_qubits):
+            lines.append('CROT %r %d %d' % (math.pi / 2**(k - j), j, k))
+    for j in range(num_qubits // 2):
+        # swapping with three CNOTs
+        k = num_qubits - 1 - j
+        lines += ['CNOT %d %d' % (k, j), 'CNOT %d %d' % (j, k), 'CNOT %d %d' % (k, j)]
+    return lines + _read_out(num_qubits)
+
+
+def adder_round(num_qubits: int, num_gates: int, rng: random.Random) -> List[str]:
+    """Ripple-carry (Cuccaro) addition of two random numbers (`num_gates` is unused)
+
+    Uses the largest `2n + 2 <= num_qubits`: a carry in, n bits of a, n bits
+    of b (which receives the sum) and a carry out.
+    """
+    n = max(1, (num_qubits - 2) // 2)
+    c, a, b, z = 0, list(range(1, n + 1)), list(range(n + 1, 2 * n + 1)), 2 * n + 1
+    lines = _prepare(2 * n + 2)
+    lines += ['X %d' % q for q in a + b if rng.random() < 0.5]
+
+    def maj(x, y, w):
+        return ['CNOT %d %d' % (y, w), 'CNOT %d %d' % (x, w), 'TOF %d %d %d' % (w, x, y)]
+
+    def uma(x, y, w):
+        return ['TOF %d %d %d' % (w, x, y), 'CNOT %d %d' % (x, w), 'CNOT %d %d' % (y, x)]
+
+    carries = [c] + a[:-1]
+    for i in range(n):
+        lines += maj(carries[i], b[i], a[i])
+    lines.append('CNOT %d %d' % (z, a[-1]))
+    for i in reversed(range(n)):
+        lines += uma(carries[i], b[i], a[i])
+    return lines + _read_out(2 * n + 2)
+
+
+WORKLOADS = {
+    'clifford_t': clifford_t_round,
+    'clifford': clifford_round,
+    'qft': qft_round,
+    'adder': adder_round,
+}
+
+
+def load_replay(path: str) -> List[str]:
+    """Commands of a recorded session, without its `Universal` and `quit` lines
+
+    The whole file is replayed as one round, every `R` line must get a reply.
+    """
+    with open(path) as f:
+        lines = [line.rstrip('\n') for line in f]
+    return [line for line in lines if line.strip() not in ('Universal', 'quit')]
+
+
+def state_fidelity(sim_method: str, precision: str, lines: List[str]) -> Optional[float]:
+    """Fidelity at `precision` to double precision of the state `lines` prepare before reading out
+
+    Both states are simulated in this process, None if the simulation method
+    has no dense state vector.
+    """
+    if not hasattr(backend_class(sim_method), 'state'):
+        return None
+    end = next((i for i, line in enumerate(lines) if line.split(' ')[0] in ('M', 'R', 'D')),
+               len(lines))
+    states = []
+    for p in ('double', precision):
+        simulator = create_simulator(sim_method, precision=p)
+        try:
+            for line in lines[:end]:
+                simulator.execute(parse_command(line))
+            states.append(np.array(simulator.state, dtype=np.complex128).reshape(-1))
+        finally:
+            simulator.close()
+    return float(abs(np.vdot(states[0], states[1])) ** 2)
+
+
+class Client:
+    """Minimal client of the line protocol, or of binary records (protocol 4)"""
+    def __init__(self, host: str, port: int, binary: bool = False):
+        self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rwb')
+        self.file.readline() # info message
+        self.binary = False
+        self.send(self.encode(['Universal'] + (['protocol 4'] if binary else [])))
+        self.binary = binary
+
+    def encode(self, lines: List[str]) -> bytes:
+        if self.binary:
+            return b''.join(encode_command(parse_command(line)) for line in lines)
+        return ''.join(line + '\n' for line in lines).encode()
+
+    def send(self, data: bytes):
+        self.file.write(data)
+        self.file.flush()
+
+    def _read_reply(self) -> str:
+        # an error reply or a closed connection is unexpected
+        if not self.binary:
+            reply = self.file.readline().decode()
+            if not reply.startswith('Reply'):
+                raise Exception('Unexpected reply %r' % reply)
+            return reply
+        header = self.file.read(REPLY_HEADER.size)
+        if len(header) < REPLY_HEADER.size:
+            raise Exception('Unexpected end of replies')
+        kind, size = REPLY_HEADER.unpack(header)
+        message = self.file.read(size).decode()
+        if kind != REPLY:
+            raise Exception('Unexpected reply %r' % message)
+        return message
+
+    def receive(self, num_replies: int) -> List[str]:
+        return [self._read_reply() for _ in range(num_replies)]
+
+    def close(self):
+        self.send(self.encode(['quit']))
+        self.sock.close()
+
+
+def _segments(lines: List[str]) -> List[List[str]]:
+    # the lines up to and including each read, and the lines after the last one
+    segments = [[]]
+    for line in lines:
+        segments[-1].append(line)
+        if line.startswith('R '):
+            segments.append([])
+    return [segment for segment in segments if segment]
+
+
+def run_client(args: tuple) -> Tuple[int, List[float], List[float]]:
+    # replaying rounds in lockstep, sending up to each read and waiting for its reply
+    host, port, seed, rounds, workload, num_qubits, num_gates, replay, binary = args
+    rng = random.Random(seed)
+    client = Client(host, port, binary)
+    num_commands = 0
+    round_latencies = []
+    command_latencies = []
+    for _ in range(rounds):
+        lines = replay if replay is not None else WORKLOADS[workload](num_qubits, num_gates, rng)
+        segments = [(client.encode(segment), segment[-1].startswith('R '))
+                    for segment in _segments(lines)]
+        start = time.perf_counter()
+        for data, replies in segments:
+            sent = time.perf_counter()
+            client.send(data)
+            if replies:
+                client.receive(1)
+                command_latencies.append(time.perf_counter() - sent)
+        round_latencies.append(time.perf_counter() - start)
+        num_commands += len(lines)
+    client.close()
+    return num_commands, round_latencies, command_latencies
+
+
+def _percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered)) - 1)]
+
+
+def _us(value: Optional[float]) -> str:
+    return '-' if value is None else '%.1f' % value
+
+
+def run_load(pool: Pool, host: str, port: int, num_clients: int, rounds: int, workload: str,
+             num_qubits: int, num_gates: int, replay: Optional[List[str]] = None,
+             binary: bool = False) -> Dict:
+    """Throughput and latency of `num_clients` concurrent clients
+
+    Command latency runs from sending a command that replies (with the
+    commands before it that do not) to its reply. Round latency runs from
+    sending a round's first command to its last reply.
+    """
+    jobs = [(host, port, seed, rounds, workload, num_qubits, num_gates, replay, binary)
+            for seed in range(num_clients)]
+    start = time.perf_counter()
+    results = pool.map(run_client, jobs)
+    elapsed = time.perf_counter() - start
+    num_commands = sum(n for n, _, _ in results)
+    round_latencies = [latency for _, latencies, _ in results for latency in latencies]
+    command_latencies = [latency for _, _, latencies in results for latency in latencies]
+    return dict(
+        clients=num_clients,
+        commands=num_commands,
+        seconds=elapsed,
+        commands_per_sec=num_commands / elapsed,
+        command_p50_us=_percentile(command_latencies, 0.5) * 1e6 if command_latencies else None,
+        command_p99_us=_percentile(command_latencies, 0.99) * 1e6 if command_latencies else None,
+        round_p50_us=_percentile(round_latencies, 0.5) * 1e6,
+        round_p99_us=_percentile(round_latencies, 0.99) * 1e6,
+    )
+
+
+def _status_kib(pid: int, field: str) -> Optional[int]:
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss(pid: int) -> Optional[int]:
+    """Peak resident set size of a process in KiB (Linux only)"""
+    return _status_kib(pid, 'VmHWM')
+
+
+def process_tree(pid: int) -> List[int]:
+    """A process and its live descendants (Linux only)"""
+    pids = [pid]
+    for parent in pids:
+        try:
+            for task in os.listdir('/proc/%d/task' % parent):
+                with open('/proc/%d/task/%s/children' % (parent, task)) as f:
+                    pids += [int(child) for child in f.read().split()]
+        except OSError:
+            pass
+    return pids
+
+
+class ServerProcess:
+    """A `pyqserver` started for one benchmark configuration
+
+    The resident set of the server and its pool workers and shard processes
+    is sampled while it runs, since shard processes exit with their session.
+    """
+    def __init__(self, port: int, sim_method: str, queueing: bool, precision: Optional[str],
+                 extra_args: List[str], timeout: float = 120):
+        cmd = [sys.executable, '-m', 'pyqserver.main', '-p', str(port), '-s', sim_method]
+        if queueing:
+            cmd.append('-q')
+        if precision is not None:
+            cmd += ['--precision', precision]
+        self.process = subprocess.Popen(cmd + extra_args, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+
+        # waiting until the server accepts connections
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.process.poll() is not None:
+                raise Exception('Server exited with status %d' % self.process.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise Exception('Server did not start within %d seconds' % timeout)
+                time.sleep(0.2)
+
+        self.tree_rss = 0
+        self.sampling = True
+        Thread(target=self._sample_rss, daemon=True).start()
+
+    def _sample_rss(self, interval: float = 0.05):
+        while self.sampling:
+            rss = sum(_status_kib(pid, 'VmRSS') or 0 for pid in process_tree(self.process.pid))
+            self.tree_rss = max(self.tree_rss, rss)
+            time.sleep(interval)
+
+    def peak_rss(self) -> Optional[int]:
+        # (the server's own peak may fall between samples)
+        own = peak_rss(self.process.pid)
+        if own is None:
+            return None
+        return max(own, self.tree_rss)
+
+    def stop(self):
+        self.sampling = False
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def main():
+    parser = ArgumentParser(description='Measures pyqserver throughput, latency and memory')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=1901)
+    parser.add_argument('-e', '--external', action='store_true',
+                        help='benchmark an already running server instead of starting one')
+    parser.add_argument('-s', '--sim_method', type=str, nargs='+', default=['cirq'])
+    parser.add_argument('-q', '--queueing', choices=['off', 'on', 'both'], default='off')
+    parser.add_argument('-x', '--precision', choices=['single', 'double'], nargs='+', default=[None],
+                        help='precisions to compare, with the fidelity of each to double')
+    parser.add_argument('-w', '--workload', choices=list(WORKLOADS), nargs='+',
+                        default=['clifford_t'])
+    parser.add_argument('-f', '--replay', type=str, nargs='+', default=[],
+                        help='recorded command streams to replay as well')
+    parser.add_argument('-c', '--clients', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('-r', '--rounds', type=int, default=20)
+    parser.add_argument('-n', '--qubits', type=int, nargs='+', default=[12])
+    parser.add_argument('-g', '--gates', type=int, default=200)
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='send binary records (protocol 4) instead of lines')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON results file')
+    parser.add_argument('server_args', nargs='*',
+                        help='extra arguments of started servers (after --)')
+    args = parser.parse_args()
+
+    # every workload as (name, qubits, replayed lines)
+    workloads = [(w, n, None) for w in args.workload for n in args.qubits]
+    workloads += [(path, None, load_replay(path)) for path in args.replay]
+    if args.external:
+        configs = [(None, None, None)]
+    else:
+        queueing = {'off': [False], 'on': [True], 'both': [False, True]}[args.queueing]
+        configs = [(s, q, x) for s in args.sim_method for q in queueing for x in args.precision]
+
+    # latencies in microseconds
+    print('%-10s %-5s %-6s %-12s %6s %7s %14s %10s %10s %10s %10s %10s %10s' % ('method', 'queue',
+          'prec', 'workload', 'qubits', 'clients', 'commands/sec', 'cmd p50', 'cmd p99',
+          'round p50', 'round p99', 'rss (MiB)', 'fidelity'))
+    results = []
+    with Pool(max(args.clients)) as pool:
+        for i, (sim_method, queueing, precision) in enumerate(configs):
+            server, port = None, args.port
+            if not args.external:
+                # a fresh port, the previous server's may still be in TIME_WAIT
+                port += i
+                server = ServerProcess(port, sim_method, queueing, precision, args.server_args)
+            try:
+                for workload, num_qubits, replay in workloads:
+                    # the fidelity of the first client's first round
+                    fidelity = None
+                    if precision is not None:
+                        lines = replay if replay is not None else \
+                            WORKLOADS[workload](num_qubits, args.gates, random.Random(0))
+                        try:
+                            fidelity = state_fidelity(sim_method, precision, lines)
+                        except UsageError:
+                            # a workload the simulation method does not support, which
+                            # the load run reports
+                            pass
+                    for num_clients in args.clients:
+                        config = dict(sim_method=sim_method, queueing=queueing,
+                                      precision=precision, workload=workload, qubits=num_qubits,
+                                      gates=args.gates if replay is None else None,
+                                      rounds=args.rounds, fidelity=fidelity)
+                        try:
+                            result = run_load(pool, args.host, port, num_clients,
+                                              args.rounds, workload, num_qubits, args.gates, replay,
+                                              args.binary)
+                        except Exception as e:
+                            # e.g. a workload the simulation method does not support
+                            results.append(dict(config, clients=num_clients, error=str(e)))
+                            print('%-10s %-5s %-6s %-12s %6s %7d failed: %s' % (
+                                sim_method or '-', '-' if queueing is None else queueing,
+                                precision or '-', os.path.basename(workload)[:12],
+                                num_qubits or '-', num_clients, e))
+                            continue
+                        # the server's peak so far with its child processes, which includes
+                        # earlier workloads
+                        rss = server.peak_rss() if server is not None else None
+                        result = dict(config, peak_rss_kib=rss, **result)
+                        results.append(result)
+                        print('%-10s %-5s %-6s %-12s %6s %7d %14.1f %10s %10s %10s %10s %10s %10s' % (
+                            sim_method or '-', '-' if queueing is None else queueing,
+                            precision or '-', os.path.basename(workload)[:12], num_qubits or '-',
+                            num_clients, result['commands_per_sec'],
+                            *[_us(result[key]) for key in ('command_p50_us', 'command_p99_us',
+                                                           'round_p50_us', 'round_p99_us')],
+                            '-' if rss is None else '%.1f' % (rss / 1024),
+                            '-' if fidelity is None else '%.8f' % fidelity))
+            finally:
+                if server is not None:
+                    server.stop()
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(dict(
+                time=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                cpus=os.cpu_count(),
+                server_args=args.server_args,
+                binary=args.binary,
+                results=results,
+            ), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import struct
+from dataclasses import fields
+from typing import Callable, Dict, List, Tuple, Union
+
+from .parser import *
+
+
+# every record starts with its opcode, a flag byte and the count of its trailing items
+HEADER = struct.Struct('<BBH')
+# every reply record starts with its kind and the length of its UTF-8 message
+REPLY_HEADER = struct.Struct('<BI')
+
+# reply kinds
+REPLY = 1
+INFO = 2
+PARSE_ERROR = 3
+USAGE_ERROR = 4
+INTERNAL_ERROR = 5
+
+# values of the flag byte of `Stats` and `Precision` records
+STATS_SCOPES = ('session', 'server')
+PRECISION_NAMES = ('single', 'double')
+
+
+class FramingError(ParseError):
+    """A record with an unknown opcode, after which records cannot be told apart"""
+
+
+def _flag_value(names: Tuple[str, ...], flag: int) -> str:
+    if flag >= len(names):
+        raise ParseError('Flag %d is not one of %s' % (flag, ', '.join(names)))
+    return names[flag]
+
+
+def _controls(tail: memoryview) -> List[int]:
+    # most gates have no controls
+    return list(struct.unpack_from('<%dI' % (len(tail) // 4), tail)) if tail else []
+
+
+# every record decoder takes the fixed operands, the flag byte and the trailing items
+_Build = Callable[[tuple, int, memoryview], Command]
+
+
+def _bit_record(cls: type) -> _Build:
+    def build(values: tuple, flag: int, tail: memoryview) -> Command:
+        if flag > 1:
+            raise ParseError('%d is not a bit, must be 0 or 1' % flag)
+        return cls(values[0], bool(flag))
+    return build
+
+
+def _gate_record(cls: type) -> _Build:
+    return lambda values, flag, tail: cls(*values, _controls(tail))
+
+
+def _plain_record(cls: type) -> _Build:
+    return lambda values, flag, tail: cls(*values)
+
+
+def _name_record(cls: type) -> _Build:
+    def build(values: tuple, flag: int, tail: memoryview) -> Command:
+        try:
+            return cls(bytes(tail).decode())
+        except UnicodeDecodeError:
+            raise ParseError('Name is not UTF-8')
+    return build
+
+
+# opcode -> (command class, struct of its fixed operands, size of a trailing item, decoder)
+# operands are the command's fields in order, controls are trailing u32 items and
+# names trailing bytes, `Q`/`B` bits and `Stats`/`Precision` choices are the flag byte
+RECORDS: Dict[int, Tuple[type, struct.Struct, int, _Build]] = {}
+for _opcode, _cls, _operands, _item_size, _build in [
+    (1, Q, 'I', 0, _bit_record(Q)),
+    (2, B, 'I', 0, _bit_record(B)),
+    (3, N, 'I', 0, _plain_record(N)),
+    (4, M, 'I', 0, _plain_record(M)),
+    (5, R, 'I', 0, _plain_record(R)),
+    (6, D, 'I', 0, _plain_record(D)),
+    (7, X, 'I', 4, _gate_record(X)),
+    (8, Y, 'I', 4, _gate_record(Y)),
+    (9, Z, 'I', 4, _gate_record(Z)),
+    (10, H, 'I', 4, _gate_record(H)),
+    (11, S, 'I', 4, _gate_record(S)),
+    (12, T, 'I', 4, _gate_record(T)),
+    (13, TInv, 'I', 4, _gate_record(TInv)),
+    (14, SInv, 'I', 4, _gate_record(SInv)),
+    (15, Diag, 'ddI', 4, _gate_record(Diag)),
+    (16, Rot, 'dI', 4, _gate_record(Rot)),
+    (17, CRot, 'dII', 4, _gate_record(CRot)),
+    (18, CNOT, 'II', 4, _gate_record(CNOT)),
+    (19, Toffoli, 'III', 4, _gate_record(Toffoli)),
+    (20, CZ, 'II', 4, _gate_record(CZ)),
+    (21, CY, 'II', 4, _gate_record(CY)),
+    (32, Protocol, 'I', 0, _plain_record(Protocol)),
+    (33, Shots, 'I', 0, _plain_record(Shots)),
+    (34, End, '', 0, _plain_record(End)),
+    (35, Threads, 'I', 0, _plain_record(Threads)),
+    (36, Stats, '', 0, lambda values, flag, tail: Stats(_flag_value(STATS_SCOPES, flag))),
+    (37, Precision, '', 0,
+     lambda values, flag, tail: Precision(_flag_value(PRECISION_NAMES, flag))),
+    (38, Snapshot, '', 1, _name_record(Snapshot)),
+    (39, Restore, '', 1, _name_record(Restore)),
+    (40, Dump, '', 0, _plain_record(Dump)),
+    (41, Reset, '', 0, _plain_record(Reset)),
+    (42, Quit, '', 0, _plain_record(Quit)),
+]:
+    RECORDS[_opcode] = (_cls, struct.Struct('<' + _operands), _item_size, _build)
+OPCODES: Dict[type, int] = {cls: opcode for opcode, (cls, *_) in RECORDS.items()}
+
+
+def decode_records(view: memoryview) -> Tuple[List[Union[Command, ParseError]], int]:
+    """Decodes every complete record at the start of `view`, and returns them with their size
+
+    A record that does not decode yields its `ParseError`, and an unknown
+    opcode a `FramingError` that ends decoding. Decoding also stops after a
+    `Protocol` record, since the bytes after it may no longer be records.
+    """
+    commands = []
+    offset = 0
+    end = len(view)
+    while offset + HEADER.size <= end:
+        opcode, flag, count = HEADER.unpack_from(view, offset)
+        record = RECORDS.get(opcode)
+        if record is None:
+            commands.append(FramingError('Unknown opcode %d' % opcode))
+            break
+        cls, operands, item_size, build = record
+        start = offset + HEADER.size
+        tail = start + operands.size
+        size = tail + count * item_size - offset
+        if offset + size > end:
+            break
+        offset += size
+        try:
+            command = build(operands.unpack_from(view, start), flag, view[tail:offset])
+        except ParseError as e:
+            # (a new error, the raised one's traceback keeps views of the buffer alive)
+            command = ParseError(str(e))
+        commands.append(command)
+        if cls is Protocol:
+            break
+    return commands, offset
+
+
+def encode_command(command: Command) -> bytes:
+    """The record of a command, as clients send it"""
+    opcode = OPCODES.get(type(command))
+    if opcode is None:
+        raise ParseError('%s has no binary record' % type(command).__name__)
+    _, operands, item_size, _ = RECORDS[opcode]
+    values, flag, tail = [], 0, b''
+    for field in fields(command):
+        value = getattr(command, field.name)
+        match field.name:
+            case 'controls':
+                tail = struct.pack('<%dI' % len(value), *value)
+            case 'name':
+                tail = value.encode()
+            case 'bvalue':
+                flag = int(value)
+            case 'scope':
+                flag = STATS_SCOPES.index(value)
+            case 'precision':
+                flag = PRECISION_NAMES.index(value)
+            case _:
+                values.append(value)
+    count = len(tail) // item_size if item_size else 0
+    return HEADER.pack(opcode, flag, count) + operands.pack(*values) + tail
+
+
+def encode_reply(kind: int, message: str) -> bytes:
+    payload = message.encode()
+    return REPLY_HEADER.pack(kind, len(payload)) + payload
@@ -1,4 +1,6 @@
+import re
 import cirq
+import sympy
 import numpy as np
 from typing import List, Dict, Union
 from abc import ABC
@@ -8,57 +10,64 @@ from cirq.contrib.qasm_import import circuit_from_qasm
 from .simulator import *
 
 
-class CirqSimulator(Simulator):
-    def __init__(self, queueing=False):
-        super(CirqSimulator, self).__init__(queueing=queueing)
-
-    def reset(self):
-        super().reset()
-        self.state = np.array([1], dtype=np.complex64)
-
-    def dump(self):
-        pass
-
-    def _measure(self, reg: int):
-        # measuring the state and collapsing the state vector
-        result, sv = cirq.measure_state_vector(self.state, [self.qubit_map[reg]])
-        bit_result = result[0]
-        self.bit_register[reg] = bit_result
-
-        # removing qubit from state vector
-        if self.num_qubits > 1:
-            prune_idxs = [np.s_[:]] * self.num_qubits
-            prune_idxs[self.qubit_map[reg]] = bit_result
-            prune_idxs
-            dims = [2] * self.num_qubits
-            sv_reshaped = sv.reshape(dims)
-            new_sv = sv_reshaped[*prune_idxs].flatten()
-            self.state = new_sv
-
-            # shifting qubit map down to fill space of removed qubit
-            for x in self.qubit_map:
-                if self.qubit_map[x] > self.qubit_map[reg]:
-                    self.qubit_map[x] -= 1
-        
-        else:
-            self.state = np.array([1], dtype=np.complex64)
-
-        self.num_qubits -= 1
-        del self.qubit_map[reg]
-
-    def _execute_qasm(self, qasm_str: str):
-        # loading OpenQASM circuit
-        qc = circuit_from_qasm(qasm_str)
-
-        # loading previous statevector
-        sv = None
-        if len(self.state) > 1:
-            num_prev_qubits = int(np.log2(self.state.shape[0]))
-            new_sv = np.zeros(2**(self.num_qubits-num_prev_qubits), dtype=np.complex64)
-            new_sv[0] = 1
-            sv = np.kron(self.state, new_sv)
+# statements whose angles are circuit inputs (see `_param`)
+PARAM_STMT = re.compile(r'^(?:rz|U)\(([^)]*)\) qs\[(\d+)\];$', re.M)
+
+
+def _compile(qasm_str: str) -> cirq.Circuit:
+    """Circuit of OpenQASM source whose angles `p<k>` become sympy symbols"""
+    # the symbols of each qubit's rz and U statements, in circuit order
+    symbols = {}
+    for angles, idx in PARAM_STMT.findall(qasm_str):
+        names = [name.strip() for name in angles.split(',')]
+        symbols.setdefault('qs_' + idx, []).append([sympy.Symbol(name) for name in names])
+
+    # cirq's importer takes neither inputs nor identifiers as angles, so parsing with zeros
+    qasm_str = '\n'.join(line for line in qasm_str.split('\n') if not line.startswith('input '))
+    qc = circuit_from_qasm(re.sub(r'\bp\d+\b', '0', qasm_str))
+
+    def parametrize(op: cirq.Operation, _):
+        match op.gate:
+            case cirq.Rz() | cirq.circuits.qasm_output.QasmUGate():
+                qubit, = op.qubits
+                angles = symbols[qubit.name].pop(0)
+            case _:
+                return op
+        if len(angles) == 1:
+            return cirq.rz(angles[0]).on(qubit)
+        # U(theta, phi, lambda) = P(phi) Ry(theta) P(lambda)
+        theta, phi, lam = angles
+        return [cirq.ZPowGate(exponent=lam / sympy.pi).on(qubit), cirq.ry(theta).on(qubit),
+                cirq.ZPowGate(exponent=phi / sympy.pi).on(qubit)]
+
+    return cirq.map_operations_and_unroll(qc, parametrize)
+
+
+class CirqSimulator(QasmSimulator):
+    def __init__(self, **kwargs):
+        super(CirqSimulator, self).__init__(**kwargs)
+
+        # one simulator and circuit cache for the whole session
+        self.simulator = cirq.Simulator(dtype=self.dtype)
+        self.circuits = CircuitCache()
+
+    def _convert_state(self):
+        super()._convert_state()
+        self.simulator = cirq.Simulator(dtype=self.dtype)
+
+    def _has_qasm_gate(self, command: Command) -> bool:
+        # cirq's OpenQASM importer has no `cp`
+        return not isinstance(command, CRot) and super()._has_qasm_gate(command)
+
+    def _execute_qasm(self, qasm_str: str, params: List[float]):
+        # loading OpenQASM circuit, whose angles are resolved per run
+        qc = self.circuits.get(qasm_str, _compile)
+        resolver = {'p%d' % k: angle for k, angle in enumerate(params)}
+
+        # qs[k] is bit k of the amplitude index, while cirq's first qubit is the highest bit
+        qubit_order = [cirq.NamedQubit('qs_%d' % k) for k in reversed(range(self.num_qubits))]
 
         # running simulation and saving statevector for future computation
-        sim = cirq.Simulator()
-        result = sim.simulate(qc, initial_state=sv)
-        self.state = result.final_state_vector
+        result = self.simulator.simulate(qc, param_resolver=resolver, qubit_order=qubit_order,
+                                         initial_state=self.state)
+        self.store.assign(result.final_state_vector)
@@ -0,0 +1,184 @@
+import numpy as np
+from typing import Dict, List, Tuple
+
+from .simulator import *
+from .gates import lower_command
+from .numpy_simulator import NumpySimulator
+from .state import StateStore
+from .kernels import apply_gate, marginal, probability_one
+
+
+class FactoredSimulator(NumpySimulator):
+    """State vector simulator that keeps unentangled groups of qubits as separate states
+
+    Every qubit starts in a group of its own, and a gate acting on qubits of
+    several groups first merges them into their tensor product. A group is
+    dropped once all of its qubits are measured or discarded, so memory and
+    time scale with the largest group rather than with all qubits.
+    `groups[reg]` is the `StateStore` holding `reg`, and `qubit_map[reg]`
+    its physical qubit there.
+    """
+    # fused blocks could span qubits that never interact
+    native_blocks = False
+
+    def __init__(self, **kwargs):
+        super(FactoredSimulator, self).__init__(**kwargs)
+
+    def reset(self):
+        super().reset()
+        self.groups: Dict[int, StateStore] = {}
+
+    def _stores(self) -> List[StateStore]:
+        # every group once, ordered by their lowest register
+        stores = {id(store): store for store in self.groups.values()}
+        return sorted(stores.values(), key=lambda store: min(store.regs))
+
+    def _state_nbytes(self, num_qubits: int) -> int:
+        # new qubits start as groups of two amplitudes
+        itemsize = np.dtype(self.dtype).itemsize
+        nbytes = sum(store.nbytes for store in self._stores())
+        return nbytes + max(0, num_qubits - self.num_qubits) * 2 * itemsize
+
+    def _convert_state(self):
+        converted = {id(store): store.astype(self.dtype) for store in self._stores()}
+        self.groups = {reg: converted[id(store)] for reg, store in self.groups.items()}
+
+    @property
+    def state(self) -> np.ndarray:
+        """The product of every group's state, with bit `k` for register `sorted(qubit_map)[k]`"""
+        # group qubit `q` is axis `num_qubits - 1 - q` of its reshaped vector
+        state = np.ones((), dtype=self.dtype)
+        axes = []
+        for store in self._stores():
+            state = np.multiply.outer(state, store.vector.reshape((2,) * store.num_qubits))
+            axes += reversed(store.regs)
+        order = [axes.index(reg) for reg in sorted(self.qubit_map, reverse=True)]
+        return state.transpose(order).reshape(-1)
+
+    def dump(self) -> str:
+        # one section per group
+        stores = self._stores()
+        if not stores:
+            return super().dump()
+        lines = []
+        for store in stores:
+            indices = np.flatnonzero(np.abs(store.vector) > 1e-6)
+            lines += self._dump_lines(store.regs, indices, store.vector[indices])
+        return ''.join(line + '\n' for line in lines)
+
+    def _allocate_qubit(self, reg: int, bvalue: bool = False):
+        store = StateStore(self.dtype, self.scratch_dir)
+        self.qubit_map[reg] = store.allocate(reg, bvalue)
+        self.groups[reg] = store
+        self.num_qubits += 1
+
+    def _merge(self, regs: List[int]) -> StateStore:
+        """The group holding every register of `regs`, merging their groups if needed"""
+        stores = {id(self.groups[reg]): self.groups[reg] for reg in regs}
+        if len(stores) == 1:
+            return self.groups[regs[0]]
+
+        # the largest group takes on the others' qubits above its own
+        stores = sorted(stores.values(), key=lambda store: store.num_qubits, reverse=True)
+        num_qubits = sum(store.num_qubits for store in stores)
+        if self.memory_limit is not None:
+            nbytes = self._state_nbytes(self.num_qubits) - sum(store.nbytes for store in stores) \
+                + (1 << num_qubits) * np.dtype(self.dtype).itemsize
+            if nbytes > self.memory_limit:
+                raise UsageError('Entangling %d qubits needs %d bytes, over the session limit '
+                                 'of %d bytes' % (num_qubits, nbytes, self.memory_limit))
+        merged = stores[0]
+        for store in stores[1:]:
+            offset = merged.num_qubits
+            merged.extend(store)
+            for reg in store.regs:
+                self.qubit_map[reg] += offset
+                self.groups[reg] = merged
+        return merged
+
+    def _apply_gate(self, gate: Gate):
+        store = self._merge([gate.target] + gate.controls)
+        target = self.qubit_map[gate.target]
+        controls = [self.qubit_map[c] for c in gate.controls]
+        apply_gate(store.writable(), store.num_qubits, target, controls, gate.matrix, self.pool)
+
+    def _execute_commands(self, commands: List[Command]):
+        for command in commands:
+            match command:
+                case Q():
+                    self._allocate_qubit(command.reg, command.bvalue)
+                case _:
+                    gate = lower_command(command)
+                    if gate is not None:
+                        self._apply_gate(gate)
+
+    def _remove(self, reg: int, bit: int):
+        # an emptied group is dropped with its last register
+        store = self.groups.pop(reg)
+        qubit = self.qubit_map.pop(reg)
+        moved = store.remove(qubit, bit)
+        if moved is not None:
+            self.qubit_map[moved] = qubit
+        self.num_qubits -= 1
+
+    def _collapse(self, reg: int, bit: int, probability: float):
+        # the outcome's probability within the group is the same as in the full state
+        store = self.groups[reg]
+        self._remove(reg, bit)
+        store.normalize(probability)
+
+    def _marginal(self, regs: List[int]) -> np.ndarray:
+        if len(regs) == 1:
+            store = self.groups[regs[0]]
+            p1 = probability_one(store.vector, store.num_qubits, self.qubit_map[regs[0]], self.pool)
+            return np.array([1 - p1, p1])
+
+        # groups are independent, so the joint distribution is the product of theirs
+        by_store: Dict[int, Tuple[StateStore, List[int]]] = {}
+        for reg in regs:
+            by_store.setdefault(id(self.groups[reg]), (self.groups[reg], []))[1].append(reg)
+        joint = np.ones(())
+        order = []
+        for store, group_regs in by_store.values():
+            qubits = [self.qubit_map[reg] for reg in group_regs]
+            probabilities = marginal(store.vector, store.num_qubits, qubits, self.pool)
+            joint = np.multiply.outer(joint, probabilities.reshape((2,) * len(group_regs)))
+            order += group_regs
+        return joint.transpose([order.index(reg) for reg in regs]).reshape(-1)
+
+    def _measure_many(self, regs: List[int]):
+        # sampling each group's outcome on its own
+        by_store: Dict[int, List[int]] = {}
+        for reg in regs:
+            by_store.setdefault(id(self.groups[reg]), []).append(reg)
+        for group_regs in by_store.values():
+            if len(group_regs) == 1:
+                self._measure(group_regs[0])
+                continue
+            store = self.groups[group_regs[0]]
+            probabilities = self._marginal(group_regs)
+            outcome = self.rng.choice(len(probabilities), p=probabilities / probabilities.sum())
+            bits = np.unravel_index(outcome, (2,) * len(group_regs))
+            for reg, bit in zip(group_regs, bits):
+                self.bit_register[reg] = int(bit)
+                self._remove(reg, int(bit))
+            store.normalize(probabilities[outcome])
+
+    def _save_state(self):
+        # copy-on-write, every group shared once
+        shared = {id(store): store.share() for store in self._stores()}
+        groups = {reg: shared[id(store)] for reg, store in self.groups.items()}
+        return (groups, dict(self.qubit_map), dict(self.bit_register))
+
+    def _share_state(self, saved):
+        groups, qubit_map, bit_register = saved
+        shared = {id(store): store.share() for store in groups.values()}
+        groups = {reg: shared[id(store)] for reg, store in groups.items()}
+        return (groups, dict(qubit_map), dict(bit_register))
+
+    def _load_state(self, saved):
+        self.groups, self.qubit_map, self.bit_register = saved
+        self.num_qubits = len(self.qubit_map)
+        self.queue = []
+        self.queued_qubits = 0
+        self.pending_measurements = 0
@@ -0,0 +1,103 @@
+import numpy as np
+from typing import List, Optional, Tuple
+from dataclasses import dataclass
+
+from .parser import *
+
+
+# single qubit gate matrices
+I_MATRIX = np.array([[1, 0], [0, 1]], dtype=np.complex128)
+X_MATRIX = np.array([[0, 1], [1, 0]], dtype=np.complex128)
+Y_MATRIX = np.array([[0, -1j], [1j, 0]], dtype=np.complex128)
+Z_MATRIX = np.array([[1, 0], [0, -1]], dtype=np.complex128)
+H_MATRIX = np.array([[1, 1], [1, -1]], dtype=np.complex128) / np.sqrt(2)
+S_MATRIX = np.array([[1, 0], [0, 1j]], dtype=np.complex128)
+SINV_MATRIX = np.array([[1, 0], [0, -1j]], dtype=np.complex128)
+T_MATRIX = np.array([[1, 0], [0, np.exp(0.25j * np.pi)]], dtype=np.complex128)
+TINV_MATRIX = np.array([[1, 0], [0, np.exp(-0.25j * np.pi)]], dtype=np.complex128)
+
+
+def rz_matrix(r: float) -> np.ndarray:
+    return np.array([[np.exp(-0.5j * r), 0], [0, np.exp(0.5j * r)]], dtype=np.complex128)
+
+
+def phase_matrix(r: float) -> np.ndarray:
+    return np.array([[1, 0], [0, np.exp(1j * r)]], dtype=np.complex128)
+
+
+def diag_matrix(a: float, b: float) -> np.ndarray:
+    return np.array([[np.exp(1j * a), 0], [0, np.exp(1j * b)]], dtype=np.complex128)
+
+
+class Unitary(Command):
+    """Single qubit unitary produced by fusing gates on one wire"""
+    matrix: np.ndarray
+    reg: int
+    controls: List[int]
+
+class Block(Command):
+    """Dense unitary on several registers, `regs[0]` is the most significant bit of `matrix`"""
+    matrix: np.ndarray
+    regs: List[int]
+
+
+@dataclass
+class Gate:
+    """Single qubit unitary applied to `target` when every register in `controls` is 1"""
+    target: int
+    controls: List[int]
+    matrix: np.ndarray
+
+
+def lower_command(command: Command) -> Optional[Gate]:
+    """Lowers a gate command to a controlled single qubit unitary on registers"""
+    match command:
+        case Unitary():
+            return Gate(command.reg, command.controls, command.matrix)
+        case X():
+            return Gate(command.reg, command.controls, X_MATRIX)
+        case Y():
+            return Gate(command.reg, command.controls, Y_MATRIX)
+        case Z():
+            return Gate(command.reg, command.controls, Z_MATRIX)
+        case H():
+            return Gate(command.reg, command.controls, H_MATRIX)
+        case S():
+            return Gate(command.reg, command.controls, S_MATRIX)
+        case SInv():
+            return Gate(command.reg, command.controls, SINV_MATRIX)
+        case T():
+            return Gate(command.reg, command.controls, T_MATRIX)
+        case TInv():
+            return Gate(command.reg, command.controls, TINV_MATRIX)
+        case Rot():
+            return Gate(command.reg, command.controls, rz_matrix(command.r))
+        case Diag():
+            return Gate(command.reg, command.controls, diag_matrix(command.a, command.b))
+        case CRot():
+            return Gate(command.y, [command.x] + command.controls, phase_matrix(command.r))
+        case CNOT():
+            return Gate(command.y, [command.x] + command.controls, X_MATRIX)
+        case Toffoli():
+            return Gate(command.z, [command.x, command.y] + command.controls, X_MATRIX)
+        case CZ():
+            return Gate(command.y, [command.x] + command.controls, Z_MATRIX)
+        case CY():
+            return Gate(command.y, [command.x] + command.controls, Y_MATRIX)
+        case _:
+            return None
+
+
+def u_angles(matrix: np.ndarray) -> Tuple[float, float, float]:
+    """Angles (theta, phi, lambda) of the OpenQASM `U` gate equal to `matrix` up to global phase"""
+    (u00, u01), (u10, u11) = matrix
+    theta = 2 * np.arctan2(abs(u10), abs(u00))
+    if abs(u00) > 1e-12:
+        alpha = np.angle(u00)
+        phi = np.angle(u10) - alpha if abs(u10) > 1e-12 else 0.0
+        lam = np.angle(u11) - alpha - phi
+    else:
+        # no cosine component, so only phi + lambda is determined
+        phi = 0.0
+        lam = np.angle(-u01) - np.angle(u10)
+    return float(theta), float(phi), float(lam)
@@ -0,0 +1,155 @@
+import itertools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional
+
+
+# kernels visit larger states in chunks of at most 2^CHUNK_QUBITS amplitudes
+CHUNK_QUBITS = 20
+# states below 2^PARALLEL_QUBITS amplitudes are not worth splitting across threads
+PARALLEL_QUBITS = 16
+
+
+class KernelPool:
+    """Threads that kernels spread the chunks of large states over
+
+    NumPy releases the GIL inside its loops, so chunks run in parallel.
+    """
+    def __init__(self, threads: int):
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def _chunks(num_qubits: int, qubits: List[int], pool: Optional[KernelPool] = None) -> List[List]:
+    """Tensor indices that fix the highest qubits not in `qubits`
+
+    Every chunk keeps the axes of `qubits` and has at most 2^CHUNK_QUBITS
+    amplitudes (unless `qubits` alone need more), so temporaries stay small
+    and a memory-mapped state is streamed through in large contiguous blocks.
+    With a pool, large states get at least four chunks per thread.
+    """
+    free = [q for q in reversed(range(num_qubits)) if q not in qubits]
+    num_outer = num_qubits - CHUNK_QUBITS
+    if pool is not None and num_qubits >= PARALLEL_QUBITS:
+        num_outer = max(num_outer, (4 * pool.threads - 1).bit_length())
+    outer = free[:max(0, num_outer)]
+
+    chunks = []
+    index = [np.s_[:]] * num_qubits + [Ellipsis]
+    for values in itertools.product((0, 1), repeat=len(outer)):
+        for q, v in zip(outer, values):
+            index[num_qubits - 1 - q] = v
+        chunks.append(list(index))
+    return chunks
+
+
+def _map_chunks(func: Callable[[List], object], chunks: List[List],
+                pool: Optional[KernelPool] = None) -> list:
+    # chunks are disjoint, so they can be processed in any order
+    if pool is None or len(chunks) == 1:
+        return [func(index) for index in chunks]
+    return list(pool.executor.map(func, chunks))
+
+
+def _chunk_axes(num_qubits: int, index: List, qubits: List[int]) -> List[int]:
+    # axes of `qubits` in the chunk selected by `index`
+    remaining = [q for q in reversed(range(num_qubits)) if not isinstance(index[num_qubits - 1 - q], int)]
+    return [remaining.index(q) for q in qubits]
+
+
+def apply_gate(state: np.ndarray, num_qubits: int, target: int, controls: List[int],
+               matrix: np.ndarray, pool: Optional[KernelPool] = None):
+    """Applies a controlled single qubit unitary to a state vector in place
+
+    Qubit `k` is bit `k` of the amplitude index (little-endian), so the state
+    is viewed as a tensor whose axis `num_qubits - 1 - k` belongs to qubit `k`.
+    """
+    tensor = state.reshape((2,) * num_qubits)
+
+    # python scalars keep the state dtype (no upcast to complex128)
+    (u00, u01), (u10, u11) = matrix.tolist()
+    axis = num_qubits - 1 - target
+
+    def apply(index):
+        # fixing control axes to 1 selects the subspace the gate acts on
+        # (the trailing ellipsis keeps fully indexed results as writable views)
+        for c in controls:
+            index[num_qubits - 1 - c] = 1
+        index[axis] = 0
+        a0 = tensor[tuple(index)]
+        index[axis] = 1
+        a1 = tensor[tuple(index)]
+
+        if u01 == 0 and u10 == 0:
+            # diagonal gates only scale amplitudes
+            if u00 != 1:
+                a0 *= u00
+            if u11 != 1:
+                a1 *= u11
+        elif u00 == 0 and u11 == 0:
+            # anti-diagonal gates swap amplitudes
+            tmp = a0.copy()
+            a0[...] = a1
+            if u01 != 1:
+                a0 *= u01
+            a1[...] = tmp
+            if u10 != 1:
+                a1 *= u10
+        else:
+            tmp = a0.copy()
+            a0 *= u00
+            a0 += u01 * a1
+            a1 *= u11
+            a1 += u10 * tmp
+
+    _map_chunks(apply, _chunks(num_qubits, [target] + controls, pool), pool)
+
+
+def apply_matrix(state: np.ndarray, num_qubits: int, qubits: List[int], matrix: np.ndarray,
+                 pool: Optional[KernelPool] = None):
+    """Applies a dense unitary on `qubits` (`qubits[0]` is its most significant bit) in place"""
+    tensor = state.reshape((2,) * num_qubits)
+    k = len(qubits)
+    matrix = matrix.astype(state.dtype)
+
+    def apply(index):
+        chunk = tensor[tuple(index)]
+        moved = np.moveaxis(chunk, _chunk_axes(num_qubits, index, qubits), list(range(k)))
+        result = matrix @ moved.reshape(2**k, -1)
+        moved[...] = result.reshape(moved.shape)
+
+    _map_chunks(apply, _chunks(num_qubits, qubits, pool), pool)
+
+
+def probability_one(state: np.ndarray, num_qubits: int, qubit: int,
+                    pool: Optional[KernelPool] = None) -> float:
+    """Probability of measuring `qubit` as 1"""
+    tensor = state.reshape((2,) * num_qubits)
+
+    def probability(index):
+        index[num_qubits - 1 - qubit] = 1
+        a1 = tensor[tuple(index)]
+        return float(np.vdot(a1, a1).real)
+
+    return sum(_map_chunks(probability, _chunks(num_qubits, [qubit], pool), pool))
+
+
+def marginal(state: np.ndarray, num_qubits: int, qubits: List[int],
+             pool: Optional[KernelPool] = None) -> np.ndarray:
+    """Joint outcome distribution of measuring `qubits` (`qubits[0]` is the most significant bit)"""
+    tensor = state.reshape((2,) * num_qubits)
+
+    def chunk_marginal(index):
+        chunk = tensor[tuple(index)]
+
+        # summing probabilities over every other qubit of the chunk
+        axes = _chunk_axes(num_qubits, index, qubits)
+        others = tuple(a for a in range(chunk.ndim) if a not in axes)
+        probabilities = (np.abs(chunk) ** 2).sum(axis=others, dtype=np.float64)
+        order = sorted(axes)
+        return np.transpose(probabilities, [order.index(a) for a in axes]).flatten()
+
+    return sum(_map_chunks(chunk_marginal, _chunks(num_qubits, qubits, pool), pool))
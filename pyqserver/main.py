@@ -1,6 +1,7 @@
 from argparse import ArgumentParser
 
 from .server import Server
+from .async_server import AsyncServer
 
 
 def main():
@@ -12,17 +13,65 @@ def main():
     parser.add_argument('-q', '--queueing', action='store_true')
     parser.add_argument('-g', '--gpu', action='store_true')
     parser.add_argument('-s', '--sim_method', type=str, default='cirq')
+    parser.add_argument('-a', '--asyncio', action='store_true')
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    parser.add_argument('-P', '--process_pool', action='store_true')
+    parser.add_argument('-l', '--lazy_measurement', action='store_true')
+    parser.add_argument('-o', '--optimize', action='store_true')
+    parser.add_argument('-k', '--fusion_qubits', type=int, default=2)
+    parser.add_argument('-m', '--memory_limit', type=int, default=None) # MiB per session
+    parser.add_argument('-d', '--scratch_dir', type=str, default=None)
+    parser.add_argument('-C', '--snapshot_memory', type=int, default=None) # MiB per process
+    parser.add_argument('-t', '--threads', type=int, default=1) # kernel threads per session
+    parser.add_argument('-M', '--metrics', action='store_true')
+    parser.add_argument('--metrics_port', type=int, default=None)
+    # queued commands that trigger a flush, as a count, qubits x count and seconds
+    parser.add_argument('--flush_gates', type=int, default=4096)
+    parser.add_argument('--flush_cost', type=int, default=1 << 17)
+    parser.add_argument('--flush_delay', type=float, default=0.1)
+    parser.add_argument('-W', '--warmup', action='store_true')
+    parser.add_argument('--shards', type=int, default=4) # worker processes of a sharded session
+    # largest bond dimension and dropped weight per SVD of an mps session
+    parser.add_argument('--bond_dim', type=int, default=64)
+    parser.add_argument('--truncation', type=float, default=1e-10)
+    # amplitude precision of every session, by default each backend's own
+    parser.add_argument('-x', '--precision', choices=['single', 'double'], default=None)
     args = parser.parse_args()
+    memory_limit = args.memory_limit << 20 if args.memory_limit is not None else None
+    snapshot_memory = args.snapshot_memory << 20 if args.snapshot_memory is not None else None
 
-    # starting server
-    Server(
+    # starting server, the asyncio one also taking its thread count
+    server_class, options = Server, {}
+    if args.asyncio:
+        server_class, options = AsyncServer, {'workers': args.workers}
+    server = server_class(
         args.port,
         args.max_connections,
         args.verbose,
         sim_method=args.sim_method,
         queueing=args.queueing,
         gpu=args.gpu,
-    ).run()
+        process_pool=args.process_pool,
+        lazy_measurement=args.lazy_measurement,
+        optimize=args.optimize,
+        fusion_qubits=args.fusion_qubits,
+        memory_limit=memory_limit,
+        scratch_dir=args.scratch_dir,
+        snapshot_memory=snapshot_memory,
+        threads=args.threads,
+        metrics=args.metrics,
+        metrics_port=args.metrics_port,
+        flush_gates=args.flush_gates,
+        flush_cost=args.flush_cost,
+        flush_delay=args.flush_delay,
+        warmup=args.warmup,
+        shards=args.shards,
+        bond_dim=args.bond_dim,
+        truncation=args.truncation,
+        precision=args.precision,
+        **options,
+    )
+    server.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,165 @@
+import math
+from threading import Lock, Thread
+from typing import Callable, Dict, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# histogram buckets split every power of two into this many
+SUBBUCKETS = 4
+
+
+class Histogram:
+    """Count, sum and maximum of observations, with quantiles from log-scale buckets
+
+    Bucket bounds grow by 2^(1/SUBBUCKETS), so quantiles are upper bounds
+    within 19% of the true value.
+    """
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets: Dict[int, int] = {}
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        mantissa, exponent = math.frexp(value)
+        key = exponent * SUBBUCKETS + int((mantissa - 0.5) * 2 * SUBBUCKETS) if value > 0 else None
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other: 'Histogram'):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        # (the session may add buckets to a live histogram meanwhile)
+        for key, count in list(other.buckets.items()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def copy(self) -> 'Histogram':
+        histogram = Histogram()
+        histogram.merge(self)
+        return histogram
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the observation of rank q * count
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for key in sorted(self.buckets, key=lambda k: -math.inf if k is None else k):
+            seen += self.buckets[key]
+            if seen >= rank:
+                if key is None:
+                    return 0.0
+                exponent, sub = divmod(key, SUBBUCKETS)
+                return min(self.max, math.ldexp(0.5 + (sub + 1) / (2 * SUBBUCKETS), exponent))
+        return self.max
+
+
+class Metrics:
+    """Counters and histograms of one session, or merged over several"""
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def count(self, name: str, n: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, value: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def merge(self, other: 'Metrics') -> 'Metrics':
+        for name, n in list(other.counters.items()):
+            self.count(name, n)
+        for name, histogram in list(other.histograms.items()):
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].merge(histogram)
+        return self
+
+    def copy(self) -> 'Metrics':
+        return Metrics().merge(self)
+
+    def report(self) -> str:
+        """Protocol comment lines, one per counter and histogram"""
+        lines = ['# %s %g' % (name, n) for name, n in sorted(self.counters.items())]
+        for name, h in sorted(self.histograms.items()):
+            lines.append('# %s count=%d mean=%.6g p50=%.6g p99=%.6g max=%.6g' % \
+                         (name, h.count, h.total / h.count, h.quantile(0.5), h.quantile(0.99), h.max))
+        return ''.join(line + '\n' for line in lines)
+
+    def exposition(self, prefix: str = 'pyqserver_') -> str:
+        """Prometheus text format, histograms as summaries"""
+        lines = []
+        for name, n in sorted(self.counters.items()):
+            lines.append('# TYPE %s%s_total counter' % (prefix, name))
+            lines.append('%s%s_total %r' % (prefix, name, n))
+        for name, h in sorted(self.histograms.items()):
+            lines.append('# TYPE %s%s summary' % (prefix, name))
+            for q in (0.5, 0.9, 0.99):
+                lines.append('%s%s{quantile="%g"} %r' % (prefix, name, q, h.quantile(q)))
+            lines.append('%s%s_sum %r' % (prefix, name, h.total))
+            lines.append('%s%s_count %d' % (prefix, name, h.count))
+        return ''.join(line + '\n' for line in lines)
+
+
+class MetricsRegistry:
+    """Server-wide metrics: those of ended sessions merged, plus every live session's
+
+    Sessions record into their own `Metrics` without locking, they are only
+    merged when read.
+    """
+    def __init__(self):
+        self.ended = Metrics()
+        self.live: Dict[int, Callable[[], Metrics]] = {}
+        self.lock = Lock()
+
+    def register(self, key: int, collect: Callable[[], Metrics]):
+        with self.lock:
+            self.live[key] = collect
+
+    def unregister(self, key: int):
+        with self.lock:
+            collect = self.live.pop(key, None)
+            if collect is not None:
+                self.ended.merge(collect())
+
+    def total(self) -> Metrics:
+        with self.lock:
+            metrics = self.ended.copy()
+            live = list(self.live.values())
+        for collect in live:
+            metrics.merge(collect())
+        return metrics
+
+
+class MetricsServer:
+    """Serves server-wide metrics over HTTP on localhost at `/metrics`"""
+    def __init__(self, registry: MetricsRegistry, port: int):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.total().exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
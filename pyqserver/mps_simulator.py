@@ -0,0 +1,266 @@
+import numpy as np
+from typing import Callable, List, Tuple
+
+from .simulator import *
+from .gates import lower_command
+
+
+# swaps the two sites of a (left bond, 2, 2, right bond) block
+def _swap_sites(theta: np.ndarray) -> np.ndarray:
+    return theta.transpose(0, 2, 1, 3)
+
+
+class MPSSimulator(Simulator):
+    """Matrix product state simulator for wide circuits with little entanglement
+
+    `tensors[i]` is the (left bond, 2, right bond) tensor of chain site `i`,
+    which holds register `sites[i]`, and `qubit_map[reg]` is the site of
+    `reg`. The chain is kept in mixed canonical form around site `center`,
+    so a block of sites that contains it holds the whole norm. Gates on
+    several qubits first swap their sites next to each other, then the
+    block is contracted, updated and split again by SVDs that keep at most
+    `bond_dim` singular values and drop a tail of at most `truncation` of
+    the weight. `fidelity` is the product of the weights kept, so
+    `1 - fidelity` bounds the error of the state. Metrics count the SVDs
+    the bond dimension cap cut short as `truncations`, and observe the
+    weight every truncated SVD drops as `truncation_error`.
+    """
+    dtype = np.complex128
+    backend_options = ('bond_dim', 'truncation')
+
+    def __init__(self, bond_dim: int = 64, truncation: float = 1e-10, **kwargs):
+        if bond_dim < 1:
+            raise UsageError('Bond dimension must be at least 1')
+        self.bond_dim = bond_dim
+        self.truncation = truncation
+        super(MPSSimulator, self).__init__(**kwargs)
+
+    def reset(self):
+        super().reset()
+        self.tensors: List[np.ndarray] = []
+        self.sites: List[int] = []
+        self.center = 0
+        self.fidelity = 1.0
+
+    @property
+    def truncation_error(self) -> float:
+        return 1 - self.fidelity
+
+    def _state_nbytes(self, num_qubits: int) -> int:
+        # new qubits start as sites of two amplitudes
+        nbytes = sum(tensor.nbytes for tensor in self.tensors)
+        return nbytes + max(0, num_qubits - self.num_qubits) * 2 * np.dtype(self.dtype).itemsize
+
+    def _convert_state(self):
+        self.tensors = [tensor.astype(self.dtype) for tensor in self.tensors]
+
+    @property
+    def state(self) -> np.ndarray:
+        """The contracted chain, site `i` being axis `i`"""
+        state = np.ones((1, 1), dtype=self.dtype)
+        for tensor in self.tensors:
+            state = np.tensordot(state, tensor, axes=(-1, 0))
+        return state.reshape((2,) * self.num_qubits)
+
+    def dump(self) -> str:
+        # amplitudes only while the full state is small enough to contract
+        regs = sorted(self.qubit_map)
+        lines = ['# %d qubits: %s' % (len(regs), ' '.join(map(str, regs))),
+                 '# bond dimensions: %s' % ' '.join(str(t.shape[2]) for t in self.tensors[:-1]),
+                 '# truncation error: %.6g' % self.truncation_error]
+        if self.num_qubits <= 20:
+            state = self.state
+            indices = np.argwhere(np.abs(state) > 1e-6)
+            for index in indices[:DUMP_LIMIT]:
+                label = ''.join(str(index[self.qubit_map[reg]]) for reg in regs)
+                amplitude = complex(state[tuple(index)])
+                lines.append('# |%s> %.6f%+.6fi' % (label, amplitude.real, amplitude.imag))
+            if len(indices) > DUMP_LIMIT:
+                lines.append('# ... and %d more' % (len(indices) - DUMP_LIMIT))
+        return ''.join(line + '\n' for line in lines)
+
+    def _allocate_qubit(self, reg: int, bvalue: bool = False):
+        # a product state site at the end of the chain is canonical either way
+        tensor = np.zeros((1, 2, 1), dtype=self.dtype)
+        tensor[0, int(bvalue), 0] = 1
+        self.qubit_map[reg] = len(self.tensors)
+        self.tensors.append(tensor)
+        self.sites.append(reg)
+        self.num_qubits += 1
+
+    def _move_center(self, site: int):
+        # QR decompositions shift the norm one site at a time
+        tensors = self.tensors
+        while self.center < site:
+            i = self.center
+            left, _, right = tensors[i].shape
+            q, r = np.linalg.qr(tensors[i].reshape(left * 2, right))
+            tensors[i] = q.reshape(left, 2, -1)
+            tensors[i + 1] = np.tensordot(r, tensors[i + 1], axes=(1, 0))
+            self.center += 1
+        while self.center > site:
+            i = self.center
+            left, _, right = tensors[i].shape
+            q, r = np.linalg.qr(tensors[i].reshape(left, 2 * right).T)
+            tensors[i] = q.T.reshape(-1, 2, right)
+            tensors[i - 1] = np.tensordot(tensors[i - 1], r.T, axes=(2, 0))
+            self.center -= 1
+
+    def _truncate(self, s: np.ndarray) -> Tuple[int, float]:
+        """How many singular values to keep, and the factor that restores the norm"""
+        weights = s * s
+        total = weights.sum()
+        # tail[k] is the weight dropped by keeping k values
+        tail = np.append(np.cumsum(weights[::-1])[::-1], 0.0)
+        wanted = min(int(np.count_nonzero(tail[1:] > self.truncation * total)) + 1, len(s))
+        keep = min(wanted, self.bond_dim)
+        if total > 0:
+            self.fidelity *= 1 - tail[keep] / total
+        if self.metrics is not None:
+            # recorded as they happen, so resets and restores do not undo them
+            if keep < wanted:
+                self.metrics.count('truncations')
+            if tail[keep] > 0:
+                self.metrics.observe('truncation_error', float(tail[keep] / total))
+        # (a python float keeps the tensors' dtype)
+        return keep, float(np.sqrt(total / (total - tail[keep]))) if tail[keep] < total else 1.0
+
+    def _update_block(self, start: int, size: int, update: Callable[[np.ndarray], np.ndarray]):
+        """Contracts `size` sites from `start`, applies `update` and splits the result again"""
+        self._move_center(start)
+        tensors = self.tensors
+        theta = tensors[start]
+        for i in range(start + 1, start + size):
+            theta = np.tensordot(theta, tensors[i], axes=(-1, 0))
+        theta = update(theta)
+
+        # splitting off one site at a time from the left leaves the norm on the last one
+        for i in range(start, start + size - 1):
+            left = theta.shape[0]
+            u, s, vh = np.linalg.svd(theta.reshape(left * 2, -1), full_matrices=False)
+            keep, scale = self._truncate(s)
+            tensors[i] = u[:, :keep].reshape(left, 2, keep)
+            theta = ((s[:keep] * scale)[:, None] * vh[:keep]).reshape(keep, *theta.shape[2:])
+        tensors[start + size - 1] = theta
+        self.center = start + size - 1
+
+    def _swap(self, site: int):
+        # swaps the registers of sites `site` and `site + 1`
+        self._update_block(site, 2, _swap_sites)
+        sites = self.sites
+        sites[site], sites[site + 1] = sites[site + 1], sites[site]
+        self.qubit_map[sites[site]] = site
+        self.qubit_map[sites[site + 1]] = site + 1
+
+    def _gather(self, regs: List[int]) -> int:
+        """Swaps the sites of `regs` next to the middle one of them, returns the first site"""
+        sites = sorted(self.qubit_map[reg] for reg in regs)
+        middle = len(sites) // 2
+        first = last = sites[middle]
+        for site in reversed(sites[:middle]):
+            while site < first - 1:
+                self._swap(site)
+                site += 1
+            first = site
+        for site in sites[middle + 1:]:
+            while site > last + 1:
+                self._swap(site - 1)
+                site -= 1
+            last = site
+        return first
+
+    def _apply_gate(self, gate: Gate):
+        if not gate.controls:
+            # a single site gate keeps the chain canonical, so it needs no SVD
+            site = self.qubit_map[gate.target]
+            matrix = gate.matrix.astype(self.dtype)
+            self.tensors[site] = np.einsum('st,atb->asb', matrix, self.tensors[site])
+            return
+
+        start = self._gather([gate.target] + gate.controls)
+
+        def update(theta: np.ndarray) -> np.ndarray:
+            # block axis 0 is the left bond, so site `start + i` is axis `i + 1`
+            theta = theta.copy()
+            index = [np.s_[:]] * theta.ndim
+            for c in gate.controls:
+                index[self.qubit_map[c] - start + 1] = 1
+            axis = self.qubit_map[gate.target] - start + 1
+            axis -= sum(self.qubit_map[c] < self.qubit_map[gate.target] for c in gate.controls)
+            view = theta[tuple(index)]
+            matrix = gate.matrix.astype(self.dtype)
+            view[...] = np.moveaxis(np.tensordot(matrix, view, axes=(1, axis)), 0, axis)
+            return theta
+
+        self._update_block(start, len(gate.controls) + 1, update)
+
+    def _execute_commands(self, commands: List[Command]):
+        for command in commands:
+            match command:
+                case Q():
+                    self._allocate_qubit(command.reg, command.bvalue)
+                case _:
+                    gate = lower_command(command)
+                    if gate is not None:
+                        self._apply_gate(gate)
+
+    def _measure(self, reg: int):
+        p1 = self._marginal([reg])[1]
+        bit_result = int(self.rng.random() < p1)
+        self._collapse(reg, bit_result, p1 if bit_result else 1 - p1)
+        self.bit_register[reg] = bit_result
+
+    def _collapse(self, reg: int, bit: int, probability: float):
+        # the projected site is contracted into a neighbour, which then holds the norm
+        site = self.qubit_map.pop(reg)
+        self._move_center(site)
+        matrix = self.tensors[site][:, bit, :] * float(1 / np.sqrt(probability))
+        del self.tensors[site]
+        del self.sites[site]
+        if site < len(self.tensors):
+            self.tensors[site] = np.tensordot(matrix, self.tensors[site], axes=(1, 0))
+        elif site > 0:
+            self.tensors[site - 1] = np.tensordot(self.tensors[site - 1], matrix, axes=(2, 0))
+            self.center = site - 1
+        for i in range(site, len(self.sites)):
+            self.qubit_map[self.sites[i]] = i
+        self.num_qubits -= 1
+
+    def _marginal(self, regs: List[int]) -> np.ndarray:
+        if len(regs) == 1:
+            # the norm lives on the center site
+            site = self.qubit_map[regs[0]]
+            self._move_center(site)
+            weights = np.sum(np.abs(self.tensors[site]) ** 2, axis=(0, 2))
+            return weights / weights.sum()
+
+        # one left environment per outcome of the registers passed so far
+        measured = {self.qubit_map[reg] for reg in regs}
+        order = []
+        envs = np.ones((1, 1, 1), dtype=self.dtype)
+        for site, tensor in enumerate(self.tensors):
+            envs = np.einsum('oab,asc,bsd->oscd', envs, tensor.conj(), tensor)
+            if site in measured:
+                order.append(self.sites[site])
+                envs = envs.reshape(-1, *envs.shape[2:])
+            else:
+                envs = envs.sum(axis=1)
+        probabilities = np.einsum('oaa->o', envs).real.reshape((2,) * len(regs))
+        return probabilities.transpose([order.index(reg) for reg in regs]).reshape(-1)
+
+    def _save_state(self):
+        # sites are replaced rather than changed, so saving copies the chain only
+        return (list(self.tensors), list(self.sites), dict(self.qubit_map), dict(self.bit_register),
+                self.center, self.fidelity)
+
+    def _share_state(self, saved):
+        tensors, sites, qubit_map, bit_register, *rest = saved
+        return (list(tensors), list(sites), dict(qubit_map), dict(bit_register), *rest)
+
+    def _load_state(self, saved):
+        (self.tensors, self.sites, self.qubit_map, self.bit_register,
+         self.center, self.fidelity) = saved
+        self.num_qubits = len(self.sites)
+        self.queue = []
+        self.queued_qubits = 0
+        self.pending_measurements = 0
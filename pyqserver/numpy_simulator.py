@@ -0,0 +1,28 @@
+import numpy as np
+from typing import List
+
+from .simulator import *
+from .gates import Block, lower_command
+from .kernels import apply_matrix
+
+
+class NumpySimulator(StateVectorSimulator):
+    """State vector simulator that applies gates directly to a NumPy array"""
+    native_blocks = True
+
+    def __init__(self, **kwargs):
+        super(NumpySimulator, self).__init__(**kwargs)
+
+    def _execute_commands(self, commands: List[Command]):
+        for command in commands:
+            match command:
+                case Q():
+                    self._allocate_qubit(command.reg, command.bvalue)
+                case Block():
+                    qubits = [self.qubit_map[reg] for reg in command.regs]
+                    apply_matrix(self.store.writable(), self.num_qubits, qubits, command.matrix,
+                                 self.pool)
+                case _:
+                    gate = lower_command(command)
+                    if gate is not None:
+                        self._apply_gate(gate)
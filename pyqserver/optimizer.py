@@ -0,0 +1,157 @@
+import numpy as np
+from typing import Dict, List, Optional
+
+from .parser import *
+from .gates import Gate, Unitary, Block, lower_command
+
+
+def _is_identity(matrix: np.ndarray, up_to_phase: bool = False) -> bool:
+    n = matrix.shape[0]
+    if up_to_phase:
+        return abs(abs(np.trace(matrix)) - n) < 1e-9 * n
+    return np.allclose(matrix, np.eye(n), atol=1e-9)
+
+
+def _touched_regs(command: Command) -> Optional[List[int]]:
+    # registers a non-gate command depends on (None means every register)
+    match command:
+        case Q() | B() | N() | M() | D() | R():
+            return [command.reg]
+        case Empty() | Help() | Protocol():
+            return []
+        case _:
+            return None
+
+
+def block_matrix(gates: List[Gate], regs: List[int]) -> np.ndarray:
+    """Dense unitary of `gates` on `regs`, `regs[0]` being the most significant bit"""
+    k = len(regs)
+    bits = {reg: 1 << (k - 1 - i) for i, reg in enumerate(regs)}
+    matrix = np.eye(2**k, dtype=np.complex128)
+    for gate in gates:
+        # basis states where every control is set and the target is 0
+        tbit = bits[gate.target]
+        cmask = sum(bits[c] for c in gate.controls)
+        i0 = np.array([i for i in range(2**k) if i & cmask == cmask and not i & tbit])
+        i1 = i0 | tbit
+        (u00, u01), (u10, u11) = gate.matrix
+        rows0, rows1 = matrix[i0].copy(), matrix[i1].copy()
+        matrix[i0] = u00 * rows0 + u01 * rows1
+        matrix[i1] = u10 * rows0 + u11 * rows1
+    return matrix
+
+
+class Optimizer:
+    """Peephole optimization of queued commands before they are simulated
+
+    Cancels adjacent inverse gates, merges runs of uncontrolled single qubit
+    gates on a wire into one `Unitary` and, if `fusion_qubits` > 1, fuses
+    neighbouring gates acting on at most `fusion_qubits` registers into one
+    dense `Block`.
+    """
+    def __init__(self, fusion_qubits: int = 1):
+        self.fusion_qubits = fusion_qubits
+        self.gates_removed = 0
+        self.gates_fused = 0
+
+    def optimize(self, commands: List[Command]) -> List[Command]:
+        commands = self._peephole(commands)
+        if self.fusion_qubits > 1:
+            commands = self._fuse_blocks(commands)
+        return commands
+
+    def _peephole(self, commands: List[Command]) -> List[Command]:
+        # output slots hold (command, gate, number of original gates); None once removed
+        slots = []
+        history: Dict[int, List[int]] = {} # slots touching each register, in order
+        pending: Dict[int, int] = {} # mergeable single qubit slot on each register
+
+        def barrier(regs):
+            for reg in (list(history) if regs is None else regs):
+                history.pop(reg, None)
+                pending.pop(reg, None)
+
+        def remove(idx):
+            command, gate, count = slots[idx]
+            slots[idx] = None
+            self.gates_removed += count
+            for reg in [gate.target] + gate.controls:
+                history[reg].pop()
+                pending.pop(reg, None)
+
+        for command in commands:
+            gate = lower_command(command)
+            if gate is None:
+                barrier(_touched_regs(command))
+                slots.append((command, None, 0))
+                continue
+
+            target = gate.target
+            regs = [target] + gate.controls
+            if not gate.controls and target in pending:
+                # merging into the previous single qubit gate on this wire
+                idx = pending[target]
+                _, prev, count = slots[idx]
+                matrix = gate.matrix @ prev.matrix
+                slots[idx] = (Unitary(matrix, target, []), Gate(target, [], matrix), count + 1)
+                self.gates_fused += 1
+                if _is_identity(matrix, up_to_phase=True):
+                    # the whole run cancels out, so none of it counts as fused
+                    self.gates_fused -= count
+                    remove(idx)
+                continue
+
+            last = [history[reg][-1] if history.get(reg) else None for reg in regs]
+            if last[0] is not None and all(idx == last[0] for idx in last):
+                # cancelling a gate against its inverse on exactly the same wires
+                _, prev, _ = slots[last[0]]
+                if prev.target == target and set(prev.controls) == set(gate.controls) \
+                        and _is_identity(gate.matrix @ prev.matrix):
+                    remove(last[0])
+                    self.gates_removed += 1
+                    continue
+
+            for reg in regs:
+                pending.pop(reg, None)
+                history.setdefault(reg, []).append(len(slots))
+            if not gate.controls:
+                pending[target] = len(slots)
+            slots.append((command, gate, 1))
+
+        return [slot[0] for slot in slots if slot is not None]
+
+    def _fuse_blocks(self, commands: List[Command]) -> List[Command]:
+        output = []
+        block_cmds, block_gates, block_regs = [], [], []
+
+        def flush():
+            if len(block_gates) > 1:
+                output.append(Block(block_matrix(block_gates, block_regs), list(block_regs)))
+                self.gates_fused += len(block_gates) - 1
+            else:
+                output.extend(block_cmds)
+            block_cmds.clear()
+            block_gates.clear()
+            block_regs.clear()
+
+        for command in commands:
+            gate = lower_command(command)
+            if gate is None:
+                flush()
+                output.append(command)
+                continue
+
+            new_regs = [r for r in [gate.target] + gate.controls if r not in block_regs]
+            if len(block_regs) + len(new_regs) > self.fusion_qubits:
+                flush()
+                new_regs = [gate.target] + gate.controls
+            if len(new_regs) > self.fusion_qubits:
+                output.append(command)
+                continue
+
+            block_cmds.append(command)
+            block_gates.append(gate)
+            block_regs.extend(new_regs)
+
+        flush()
+        return output
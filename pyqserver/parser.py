@@ -1,13 +1,20 @@
-from abc import ABC
-from typing import List, Type
-from dataclasses import dataclass, is_dataclass
+from abc import ABC, ABCMeta
+from typing import Callable, Dict, List, Union
+from dataclasses import dataclass
 
 
-class Command(ABC):
-    def __init_subclass__(cls: Type, **kwargs):
-        super().__init_subclass__(**kwargs)
-        if not is_dataclass(cls):
-            dataclass(cls)
+class CommandMeta(ABCMeta):
+    """Turns every subclass of `Command` into a dataclass with `__slots__`"""
+    def __new__(mcls, name, bases, namespace, **kwargs):
+        cls = super().__new__(mcls, name, bases, namespace, **kwargs)
+        # dataclass(slots=True) creates the class again through this metaclass,
+        # and that second class already has its slots
+        if bases != (ABC,) and '__slots__' not in namespace:
+            cls = dataclass(cls, slots=True)
+        return cls
+
+class Command(ABC, metaclass=CommandMeta):
+    __slots__ = ()
 
 class Help(Command):
     """Displays help message"""
@@ -31,6 +38,33 @@ class Protocol(Command):
     """Used for negotiation of protocol versions"""
     protocol: int
 
+class Shots(Command):
+    """Starts a block of commands that is run `count` times (protocol 2)"""
+    count: int
+
+class End(Command):
+    """Ends a block of commands"""
+
+class Threads(Command):
+    """Sets how many threads the session's kernels use"""
+    count: int
+
+class Precision(Command):
+    """Sets the session's amplitude precision, `single` or `double`"""
+    precision: str
+
+class Stats(Command):
+    """Reports the metrics of the session or, with scope `server`, of the whole server"""
+    scope: str
+
+class Snapshot(Command):
+    """Saves the current state under `name` for any session to restore"""
+    name: str
+
+class Restore(Command):
+    """Replaces the current state with the one saved under `name`"""
+    name: str
+
 class Q(Command):
     reg: int
     bvalue: bool = False
@@ -154,72 +188,134 @@ def parse_nats(float_strs: List[str]) -> List[float]:
     return [parse_nat(x) for x in float_strs]
 
 
+# commands without arguments are immutable, so one instance of each is shared
+_EMPTY = Empty()
+_SINGLETONS = {'dump': Dump(), 'fresh': Fresh(), 'reset': Reset(), 'help': Help(),
+               'quit': Quit(), 'end': End()}
+
+
+def _reg_bit_parser(cls: type, op: str) -> Callable[[List[str]], Command]:
+    def parse(args: List[str]) -> Command:
+        match len(args):
+            case 1: return cls(parse_nat(args[0]))
+            case 2: return cls(parse_nat(args[0]), parse_bit(args[1]))
+            case 0: raise ParseError('Command %s requires an argument' % op)
+            case _: raise ParseError('Command %s requires at most two arguments' % op)
+    return parse
+
+
+def _single_parser(cls: type, message: str) -> Callable[[List[str]], Command]:
+    def parse(args: List[str]) -> Command:
+        if len(args) != 1:
+            raise ParseError(message)
+        return cls(parse_nat(args[0]))
+    return parse
+
+
+def _name_parser(cls: type, message: str) -> Callable[[List[str]], Command]:
+    def parse(args: List[str]) -> Command:
+        if len(args) != 1 or not args[0]:
+            raise ParseError(message)
+        return cls(args[0])
+    return parse
+
+
+def _stats_parser(args: List[str]) -> Command:
+    if len(args) > 1 or args and args[0] not in ('session', 'server'):
+        raise ParseError('Command stats takes at most one argument, session or server')
+    return Stats(args[0] if args else 'session')
+
+
+def _precision_parser(args: List[str]) -> Command:
+    if len(args) != 1 or args[0] not in ('single', 'double'):
+        raise ParseError('Command precision requires one argument, single or double')
+    return Precision(args[0])
+
+
+def _gate_parser(cls: type, op: str) -> Callable[[List[str]], Command]:
+    message = 'Command %s requires at least one argument' % op
+    def parse(args: List[str]) -> Command:
+        if not args:
+            raise ParseError(message)
+        return cls(parse_nat(args[0]), [parse_nat(x) for x in args[1:]])
+    return parse
+
+
+def _controlled_parser(cls: type, op: str, params: List[tuple],
+                       count: str) -> Callable[[List[str]], Command]:
+    # `params` are (parser, argument position) in constructor order, which is
+    # also the order arguments are checked in
+    num_params = len(params)
+    message = 'Command %s requires at least %s arguments' % (op, count)
+    def parse(args: List[str]) -> Command:
+        if len(args) < num_params:
+            raise ParseError(message)
+        values = [f(args[i]) for f, i in params]
+        return cls(*values, [parse_nat(x) for x in args[num_params:]])
+    return parse
+
+
+# parser of the arguments of every operation
+PARSERS: Dict[str, Callable[[List[str]], Command]] = {
+    '': lambda args: _EMPTY, # empty command
+    '#': lambda args: _EMPTY, # ignoring comments
+    'Q': _reg_bit_parser(Q, 'Q'),
+    'B': _reg_bit_parser(B, 'B'),
+    'N': _single_parser(N, 'Command N requires exactly one argument'),
+    'M': _single_parser(M, 'Command M requires exactly one argument'),
+    'R': _single_parser(R, 'Command R requires exactly one argument'),
+    'D': _single_parser(D, 'Command D requires exactly one argument'),
+    'X': _gate_parser(X, 'X'),
+    'Y': _gate_parser(Y, 'Y'),
+    'Z': _gate_parser(Z, 'Z'),
+    'H': _gate_parser(H, 'H'),
+    'S': _gate_parser(S, 'S'),
+    'T': _gate_parser(T, 'T'),
+    'T*': _gate_parser(TInv, 'T*'),
+    'S*': _gate_parser(SInv, 'S*'),
+    'DIAG': _controlled_parser(Diag, 'DIAG', [(parse_float, 0), (parse_float, 1), (parse_nat, 2)],
+                               'three'),
+    'ROT': _controlled_parser(Rot, 'ROT', [(parse_float, 0), (parse_nat, 1)], 'two'),
+    'CROT': _controlled_parser(CRot, 'CROT', [(parse_float, 0), (parse_nat, 2), (parse_nat, 1)],
+                               'three'),
+    'CNOT': _controlled_parser(CNOT, 'CNOT', [(parse_nat, 1), (parse_nat, 0)], 'two'),
+    'TOF': _controlled_parser(Toffoli, 'TOF', [(parse_nat, 2), (parse_nat, 1), (parse_nat, 0)],
+                              'three'),
+    'CZ': _controlled_parser(CZ, 'CZ', [(parse_nat, 0), (parse_nat, 1)], 'two'),
+    'CY': _controlled_parser(CY, 'CY', [(parse_nat, 0), (parse_nat, 1)], 'two'),
+    'protocol': _single_parser(Protocol, 'Command Protocol requires exactly one argument'),
+    'shots': _single_parser(Shots, 'Command Shots requires exactly one argument'),
+    'threads': _single_parser(Threads, 'Command Threads requires exactly one argument'),
+    'precision': _precision_parser,
+    'stats': _stats_parser,
+    'snapshot': _name_parser(Snapshot, 'Command Snapshot requires exactly one argument'),
+    'restore': _name_parser(Restore, 'Command Restore requires exactly one argument'),
+}
+for _op, _command in _SINGLETONS.items():
+    PARSERS[_op] = lambda args, command=_command: command
+
+
 def parse_command(command_str: str) -> Command:
     # splitting command into words
-    command_str_split = command_str.split(' ')
-    op = command_str_split[0]
-    args = command_str_split[1:]
-
-    # parsing command into operation
-    match op, args:
-        case '', _: return Empty() # empty command
-        case '#', _: return Empty() # ignoring comments
-        case 'Q', [reg]: return Q(parse_nat(reg))
-        case 'Q', [reg, bit]: return Q(parse_nat(reg), parse_bit(bit))
-        case 'Q', []: raise ParseError('Command Q requires an argument')
-        case 'Q', [*_]: raise ParseError('Command Q requires at most two arguments')
-        case 'B', [reg]: return B(parse_nat(reg))
-        case 'B', [reg, bit]: return B(parse_nat(reg), parse_bit(bit))
-        case 'B', []: raise ParseError('Command B requires an argument')
-        case 'B', [*_]: raise ParseError('Command B requires at most two arguments')
-        case 'N', [reg]: return N(parse_nat(reg))
-        case 'N', [*_]: raise ParseError('Command N requires exactly one argument')
-        case 'M', [reg]: return M(parse_nat(reg))
-        case 'M', [*_]: raise ParseError('Command M requires exactly one argument')
-        case 'R', [reg]: return R(parse_nat(reg))
-        case 'R', [*_]: raise ParseError('Command R requires exactly one argument')
-        case 'D', [reg]: return D(parse_nat(reg))
-        case 'D', [*_]: raise ParseError('Command D requires exactly one argument')
-        case 'X', [reg, *ctrls]: return X(parse_nat(reg), parse_nats(ctrls))
-        case 'X', []: raise ParseError('Command X requires at least one argument')
-        case 'Y', [reg, *ctrls]: return Y(parse_nat(reg), parse_nats(ctrls))
-        case 'Y', []: raise ParseError('Command Y requires at least one argument')
-        case 'Z', [reg, *ctrls]: return Z(parse_nat(reg), parse_nats(ctrls))
-        case 'Z', []: raise ParseError('Command Z requires at least one argument')
-        case 'H', [reg, *ctrls]: return H(parse_nat(reg), parse_nats(ctrls))
-        case 'H', []: raise ParseError('Command H requires at least one argument')
-        case 'S', [reg, *ctrls]: return S(parse_nat(reg), parse_nats(ctrls))
-        case 'S', []: raise ParseError('Command S requires at least one argument')
-        case 'T', [reg, *ctrls]: return T(parse_nat(reg), parse_nats(ctrls))
-        case 'T', []: raise ParseError('Command T requires at least one argument')
-        case 'T*', [reg, *ctrls]: return TInv(parse_nat(reg), parse_nats(ctrls))
-        case 'T*', []: raise ParseError('Command T* requires at least one argument')
-        case 'S*', [reg, *ctrls]: return SInv(parse_nat(reg), parse_nats(ctrls))
-        case 'S*', []: raise ParseError('Command S* requires at least one argument')
-        case 'DIAG', [a, b, reg, *ctrls]: return Diag(parse_float(a), parse_float(b), \
-            parse_nat(reg), parse_nats(ctrls))
-        case 'DIAG', [*_]: raise ParseError('Command DIAG requires at least three arguments')
-        case 'ROT', [r, reg, *ctrls]: return Rot(parse_float(r), parse_nat(reg), \
-            parse_nats(ctrls))
-        case 'ROT', [*_]: raise ParseError('Command ROT requires at least two arguments')
-        case 'CROT', [r, y, x, *ctrls]: return CRot(parse_float(r), parse_nat(x), \
-            parse_nat(y), parse_nats(ctrls))
-        case 'CROT', [*_]: raise ParseError('Command CROT requires at least three arguments')
-        case 'CNOT', [y, x, *ctrls]: return CNOT(parse_nat(x), parse_nat(y), \
-            parse_nats(ctrls))
-        case 'CNOT', [*_]: raise ParseError('Command CNOT requires at least two arguments')
-        case 'TOF', [c, b, a, *ctrls]: return Toffoli(parse_nat(a), \
-            parse_nat(b), parse_nat(c), parse_nats(ctrls))
-        case 'TOF', [*_]: raise ParseError('Command TOF requires at least three arguments')
-        case 'CZ', [x, y, *ctrls]: return CZ(parse_nat(x), parse_nat(y), parse_nats(ctrls))
-        case 'CZ', [*_]: raise ParseError('Command CZ requires at least two arguments')
-        case 'CY', [x, y, *ctrls]: return CY(parse_nat(x), parse_nat(y), parse_nats(ctrls))
-        case 'CY', [*_]: raise ParseError('Command CY requires at least two arguments')
-        case 'dump', _: return Dump()
-        case 'fresh', _: return Fresh()
-        case 'reset', _: return Reset()
-        case 'help', _: return Help()
-        case 'quit', _: return Quit()
-        case 'protocol', [version]: return Protocol(parse_nat(version))
-        case 'protocol', [*_]: raise ParseError('Command Protocol requires exactly one argument')
-        case _, _: raise ParseError('Unrecognized operation')
+    op, *args = command_str.split(' ')
+
+    # looking up the operation
+    parse = PARSERS.get(op)
+    if parse is None:
+        raise ParseError('Unrecognized operation')
+    return parse(args)
+
+
+def parse_commands(buffer: str) -> List[Union[Command, ParseError]]:
+    """Parses every line of `buffer`, a line that does not parse yields its `ParseError`"""
+    lines = buffer.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+
+    commands = []
+    for line in lines:
+        try:
+            commands.append(parse_command(line.strip()))
+        except ParseError as e:
+            commands.append(e)
+    return commands
@@ -3,64 +3,54 @@ from typing import List, Dict, Union
 from abc import ABC
 from dataclasses import dataclass
 from qiskit import QuantumCircuit, qasm3
+from qiskit.circuit import CircuitInstruction
 from qiskit_aer import AerSimulator
+from qiskit_aer.library import SetStatevector
 from qiskit.quantum_info import Statevector
 
 from .simulator import *
 
 
-class QiskitSimulator(Simulator):
-    def __init__(self, queueing=False, gpu=False):
-        super(QiskitSimulator, self).__init__(queueing=queueing)
-        self.gpu = gpu
-
-    def reset(self):
-        super().reset()
-        self.state = None
+class QiskitSimulator(QasmSimulator):
+    # Aer works in double precision by default
+    dtype = np.complex128
+    backend_options = ('gpu',)
 
-    def dump(self):
-        pass
-
-    def _measure(self, reg: int):
-        # measuring the state and collapsing the state vector
-        result, sv = self.state.measure([self.qubit_map[reg]])
-        bit_result = int(result)
-        self.bit_register[reg] = bit_result
+    def __init__(self, gpu=False, **kwargs):
+        super(QiskitSimulator, self).__init__(**kwargs)
+        self.gpu = gpu
 
-        # removing qubit from state vector
-        if self.num_qubits > 1:
-            prune_idxs = [np.s_[:]] * self.num_qubits
-            prune_idxs[self.qubit_map[reg]] = bit_result
-            prune_idxs.reverse()
-            sv_reshaped = sv.data.reshape(sv.dims())
-            new_sv = sv_reshaped[*prune_idxs].flatten()
-            self.state = Statevector(new_sv)
+        # one simulator and circuit cache for the whole session
+        self.simulator = self._create_simulator()
+        self.circuits = CircuitCache()
 
-            # shifting qubit map down to fill space of removed qubit
-            for x in self.qubit_map:
-                if self.qubit_map[x] > self.qubit_map[reg]:
-                    self.qubit_map[x] -= 1
-        
-        else:
-            self.state = None
+    def _create_simulator(self) -> AerSimulator:
+        # (Aer returns double precision statevectors either way)
+        precision = 'single' if np.dtype(self.dtype) == np.complex64 else 'double'
+        return AerSimulator(device=('GPU' if self.gpu else 'CPU'), precision=precision)
 
-        self.num_qubits -= 1
-        del self.qubit_map[reg]
+    def _convert_state(self):
+        super()._convert_state()
+        self.simulator = self._create_simulator()
 
-    def _execute_qasm(self, qasm_str: str):
-        # loading qasm as a circuit
-        qc = qasm3.loads(qasm_str)
+    def _compile(self, qasm_str: str) -> QuantumCircuit:
+        # loading qasm as a circuit (Aer runs the standard gates without transpiling)
+        qc = QuantumCircuit(self.num_qubits)
+        qc.compose(qasm3.loads(qasm_str), inplace=True)
         qc.save_statevector()
-
-        if self.state:
-            qc_init = QuantumCircuit(self.num_qubits)
-            num_prev_qubits = len(self.state.dims())
-            qc_init.initialize(self.state, list(range(num_prev_qubits)))
-            qc = qc_init.compose(qc)
-
-        # running simulation
-        sim = AerSimulator(device=('GPU' if self.gpu else 'CPU'))
-        result = sim.run(qc).result()
-
-        # saving statevector for future computation
-        self.state = result.get_statevector()
+        return qc
+
+    def _execute_qasm(self, qasm_str: str, params: List[float]):
+        # one circuit per gate structure, with the angles bound on a copy per run
+        # (Aer's own parameter binds leave controlled phases unbound)
+        qc = self.circuits.get(qasm_str, self._compile)
+        qc = qc.assign_parameters({p: params[int(p.name[1:])] for p in qc.parameters})
+
+        # carrying over the previous state as a native initial state
+        # (a state whose first amplitude is 1 is all zeros, so needs no initialization)
+        if self.state[0] != 1:
+            qc.data.insert(0, CircuitInstruction(SetStatevector(self.state), qc.qubits))
+
+        # running simulation and saving statevector for future computation
+        result = self.simulator.run(qc).result()
+        self.store.assign(result.get_statevector().data)
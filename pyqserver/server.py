@@ -1,11 +1,19 @@
 import sys
 import socket
-from threading import Thread
+from functools import partial
+from threading import Thread, Lock, BoundedSemaphore
 
 from .parser import *
 from .simulator import *
-from .cirq_simulator import CirqSimulator
-from .qiskit_simulator import QiskitSimulator
+from .session import BANNER, Session
+from .backends import create_simulator, warm_up
+from .workers import WorkerPool
+from .metrics import MetricsRegistry, MetricsServer
+from .snapshots import SNAPSHOTS
+
+
+# bytes read from a connection at a time
+RECV_SIZE = 1 << 16
 
 
 class Server:
@@ -16,17 +24,108 @@ class Server:
                  sim_method: str = 'cirq',
                  queueing: bool = True,
                  debug: bool = True,
-                 gpu: bool = False):
+                 gpu: bool = False,
+                 process_pool: bool = False,
+                 lazy_measurement: bool = False,
+                 optimize: bool = False,
+                 fusion_qubits: int = 2,
+                 memory_limit: int = None,
+                 scratch_dir: str = None,
+                 snapshot_memory: int = None,
+                 threads: int = 1,
+                 metrics: bool = False,
+                 metrics_port: int = None,
+                 flush_gates: int = 4096,
+                 flush_cost: int = 1 << 17,
+                 flush_delay: float = 0.1,
+                 warmup: bool = False,
+                 shards: int = 4,
+                 bond_dim: int = 64,
+                 truncation: float = 1e-10,
+                 precision: str = None):
         self.port = port
         self.max_conns = max_conns
         self.verbose = verbose
         self.num_conns = 0
+        self.conns_lock = Lock()
+        self.slots = BoundedSemaphore(max_conns)
         self.sim_method = sim_method
         self.queueing = queueing
         self.debug = debug
         self.gpu = gpu
+        self.process_pool = process_pool
+        self.lazy_measurement = lazy_measurement
+        self.optimize = optimize
+        self.fusion_qubits = fusion_qubits
+        self.memory_limit = memory_limit
+        self.scratch_dir = scratch_dir
+        self.snapshot_memory = snapshot_memory
+        self.threads = threads
+        self.metrics_port = metrics_port
+        self.flush_gates = flush_gates
+        self.flush_cost = flush_cost
+        self.flush_delay = flush_delay
+        self.warmup = warmup
+        self.shards = shards
+        self.bond_dim = bond_dim
+        self.truncation = truncation
+        self.precision = precision
+        # a metrics endpoint implies recording metrics
+        self.metrics = MetricsRegistry() if metrics or metrics_port is not None else None
+        self.metrics_server = None
+        self.pool = None
+
+    def _start_pool(self):
+        # starting simulator worker processes before accepting connections
+        if self.process_pool:
+            # sharded sessions start processes of their own, which pool workers may not
+            if self.sim_method == 'sharded':
+                raise Exception('The sharded backend cannot run in a process pool')
+            self.pool = WorkerPool(partial(create_simulator, self.sim_method,
+                                           **self._simulator_options()),
+                                   snapshot_memory=self.snapshot_memory)
+            print('Started %d simulator worker processes' % len(self.pool.workers))
+
+    def _stop_pool(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def _start_metrics(self):
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+            print('Serving metrics on http://127.0.0.1:%d/metrics' % self.metrics_port)
+
+    def _stop_metrics(self):
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def _warm_up(self):
+        # importing the backend and running its code paths once before accepting connections
+        if self.warmup:
+            if self.pool is not None:
+                simulators = [self.pool.open_session() for _ in self.pool.workers]
+            else:
+                simulators = [self._get_simulator()]
+            for simulator in simulators:
+                warm_up(simulator)
+            print('Warmed up %s backend' % self.sim_method)
 
     def run(self):
+        # the snapshot cache is shared by every session of the process
+        if self.snapshot_memory is not None:
+            SNAPSHOTS.max_bytes = self.snapshot_memory
+        self._start_pool()
+        self._warm_up()
+        self._start_metrics()
+        try:
+            self._run()
+        finally:
+            self._stop_metrics()
+            self._stop_pool()
+
+    def _run(self):
         # setting up socket connection
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 print('Starting quantum server on port %d with max %d connections' % \
@@ -39,90 +138,65 @@ class Server:
                     while True:
                         # handling connection
                         conn, addr = s.accept()
-                        while self.num_conns >= self.max_conns:
-                            # stopping at connection limit and waiting
-                            pass
 
+                        # blocking (without spinning) until a connection slot frees up
+                        self.slots.acquire()
                         t = Thread(target=self._handle_connection, args=(conn, addr,))
                         t.start()
                 except KeyboardInterrupt:
                     print('\nShutting down quantum server')
 
+    def _simulator_options(self):
+        return dict(
+            gpu=self.gpu,
+            queueing=self.queueing,
+            lazy_measurement=self.lazy_measurement,
+            optimize=self.optimize,
+            fusion_qubits=self.fusion_qubits,
+            memory_limit=self.memory_limit,
+            scratch_dir=self.scratch_dir,
+            threads=self.threads,
+            metrics=self.metrics is not None,
+            flush_gates=self.flush_gates,
+            flush_cost=self.flush_cost,
+            flush_delay=self.flush_delay,
+            shards=self.shards,
+            bond_dim=self.bond_dim,
+            truncation=self.truncation,
+            precision=self.precision,
+        )
+
     def _get_simulator(self):
-        if self.sim_method == 'qiskit':
-            return QiskitSimulator(queueing=self.queueing, gpu=self.gpu)
-        elif self.sim_method == 'cirq':
-            return CirqSimulator(queueing=self.queueing)
-        else:
-            raise Exception('Invalid simulation method `%s`' % self.sim_method)
+        if self.pool is not None:
+            return self.pool.open_session()
+        return create_simulator(self.sim_method, **self._simulator_options())
 
     def _handle_connection(self, conn, addr):
-        self.num_conns += 1
+        with self.conns_lock:
+            self.num_conns += 1
         try:
             print('Connected to %s' % str(addr))
             with conn:
                 # sending initial info message
-                conn.send(b'# quantum server, version 0.2.\n')
-
-                # reading simulation mode from client
-                connFile = conn.makefile()
-                sim_mode = connFile.readline().strip()
-                
-                # making sure only universal mode is selected
-                while sim_mode != 'Universal':
-                    conn.send(b'Invalid simulation method\n')
-                    sim_mode = connFile.readline().strip()
-
-                # parsing commands line by line
-                simulator = self._get_simulator()
-                while True:
-                    # reading the next line
-                    line = connFile.readline()
-                    if not line: break
-
-                    try:
-                        # parsing the command
-                        command_str: str = line.strip()
-                        if self.verbose:
-                            print('\tIncoming command: "%s"' % command_str)
-
-                        command: Command = parse_command(command_str)
-                        if self.verbose:
-                            print('\tParsed command: %s' % command)
-
-                        # interpreting the command
-                        result: Result = simulator.execute(command)
-                        if self.verbose:
-                            print('\tSimulator result: %s' % result)
-
-                        # handling simulator result
-                        match result:
-                            case OK():
-                                pass
-                            case Null():
-                                pass
-                            case Terminate():
-                                break
-                            case Reply():
-                                conn.send(('Reply "%s"\n' % result.message).encode())
-                            case Info():
-                                conn.send(result.content.encode())
-
-                    # handling errors
-                    except ParseError as e:
-                        print('Parse error: %s' % str(e))
-                        conn.send(('! Parse error: %s. Try help.\n' % str(e)).encode())
-                    except UsageError as e:
-                        print('Usage error: %s' % str(e))
-                        conn.send((('Usage error "! %s"\n' % str(e))).encode())
-                    except Exception as e:
-                        if self.debug:
-                            raise e
-                        print('Internal error: %s' % str(e))
-                        conn.send(('Internal error: %s\n' % str(e)).encode())
+                conn.send(BANNER)
+
+                # handling every complete line or record that has arrived so far
+                session = Session(self._get_simulator, self.verbose, self.debug, self.metrics)
+                try:
+                    while not session.closed:
+                        data = conn.recv(RECV_SIZE)
+                        replies = session.feed(data) if data else session.finish()
+                        for reply in replies:
+                            conn.sendall(reply)
+                        if not data: break
+                finally:
+                    session.close()
 
         except ConnectionResetError:
             print('Error: connection to %s reset' % str(addr), file=sys.stderr)
 
-        print('Connection to %s closed' % str(addr))
-        self.num_conns -= 1
+        finally:
+            print('Connection to %s closed' % str(addr))
+            with self.conns_lock:
+                self.num_conns -= 1
+            self.slots.release()
@@ -0,0 +1,284 @@
+import time
+from typing import Callable, Iterator, List, Optional, Union
+
+from .parser import *
+from .simulator import *
+from .metrics import Metrics, MetricsRegistry
+from .binary import (REPLY, INFO, PARSE_ERROR, USAGE_ERROR, INTERNAL_ERROR, FramingError,
+                     decode_records, encode_reply)
+
+
+BANNER = b'# quantum server, version 0.2.\n'
+
+# 1: plain line protocol, 2: adds `shots` blocks, 3: adds pipelining,
+# 4: binary records instead of lines (see `binary`)
+PROTOCOL_VERSIONS = (1, 2, 3, 4)
+
+# the line protocol's text of every reply kind
+TEXT_REPLIES = {
+    REPLY: 'Reply "%s"\n',
+    INFO: '%s',
+    PARSE_ERROR: '! Parse error: %s. Try help.\n',
+    USAGE_ERROR: 'Usage error "! %s"\n',
+    INTERNAL_ERROR: 'Internal error: %s\n',
+}
+
+
+class Session:
+    """Protocol state of a single client connection
+
+    Independent of how the connection is served, so the threaded and the
+    asyncio servers send byte-for-byte identical replies.
+    """
+    def __init__(self,
+                 simulator_factory: Callable[[], Simulator],
+                 verbose: bool = False,
+                 debug: bool = True,
+                 registry: Optional[MetricsRegistry] = None):
+        self.simulator_factory = simulator_factory
+        self.verbose = verbose
+        self.debug = debug
+        self.registry = registry
+        self.metrics = None
+        if registry is not None:
+            self.metrics = Metrics()
+            registry.register(id(self), self.collect_metrics)
+        self.simulator = None
+        self.closed = False
+        self.protocol = 1
+        self.shots = None
+        self.block = []
+        self.buffer = bytearray()
+
+    @property
+    def pipelined(self) -> bool:
+        # from protocol 3 on every complete line received is handled as one batch
+        return self.protocol >= 3
+
+    @property
+    def binary(self) -> bool:
+        # from protocol 4 on the client sends binary records instead of lines
+        return self.protocol >= 4
+
+    def collect_metrics(self) -> Metrics:
+        """Metrics of the session so far, including its simulator's"""
+        metrics = self.metrics.copy()
+        simulator = self.simulator
+        if simulator is not None:
+            metrics.merge(simulator.collect_metrics() or Metrics())
+        return metrics
+
+    def close(self):
+        if self.registry is not None:
+            self.registry.unregister(id(self))
+            self.registry = None
+        if self.simulator is not None:
+            self.simulator.close()
+            self.simulator = None
+
+    def _execute(self, command: Command) -> List[Result]:
+        match command:
+            case Protocol():
+                if command.protocol not in PROTOCOL_VERSIONS:
+                    raise UsageError('Unsupported protocol version %d' % command.protocol)
+                self.protocol = command.protocol
+                return [OK()]
+            case Shots():
+                if self.protocol < 2:
+                    raise UsageError('Shot blocks require protocol 2')
+                if self.shots is not None:
+                    raise UsageError('Shot blocks cannot be nested')
+                if command.count < 1:
+                    raise UsageError('Shot blocks need at least one shot')
+                self.shots = command.count
+                return [OK()]
+            case End():
+                if self.shots is None:
+                    raise UsageError('No shot block to end')
+                block, shots = self.block, self.shots
+                self.block, self.shots = [], None
+                return self.simulator.run_shots(block, shots)
+            case Stats():
+                if self.metrics is None:
+                    raise UsageError('Metrics are disabled on this server')
+                if command.scope == 'server':
+                    return [Info(self.registry.total().report())]
+                return [Info(self.collect_metrics().report())]
+            case Quit():
+                return [self.simulator.execute(command)]
+            case _ if self.shots is not None:
+                # collecting the block until it ends
+                self.block.append(command)
+                return [OK()]
+            case _:
+                return [self.simulator.execute(command)]
+
+    def _reply(self, kind: int, message: str) -> bytes:
+        if self.binary:
+            return encode_reply(kind, message)
+        return (TEXT_REPLIES[kind] % message).encode()
+
+    def _parse_error(self, e: ParseError) -> bytes:
+        if self.metrics is not None:
+            self.metrics.count('errors')
+        print('Parse error: %s' % str(e))
+        return self._reply(PARSE_ERROR, str(e))
+
+    def handle_line(self, line: str) -> Optional[bytes]:
+        """Handles one line from the client and returns the reply to send back (if any)"""
+        # making sure only universal mode is selected
+        if self.simulator is None:
+            if line.strip() != 'Universal':
+                return b'Invalid simulation method\n'
+            self.simulator = self.simulator_factory()
+            return None
+
+        metrics = self.metrics
+        start = None
+        if metrics is not None:
+            start = time.perf_counter()
+            metrics.count('commands')
+        try:
+            # parsing the command
+            command_str: str = line.strip()
+            if self.verbose:
+                print('\tIncoming command: "%s"' % command_str)
+            command: Command = parse_command(command_str)
+        except ParseError as e:
+            return self._parse_error(e)
+        if metrics is not None:
+            metrics.observe('parse_seconds', time.perf_counter() - start)
+        return self.handle_command(command, start)
+
+    def handle_command(self, command: Command, start: Optional[float] = None) -> Optional[bytes]:
+        """Runs a parsed command and returns the reply to send back (if any)
+
+        `start` is when handling the command began, if metrics are recorded.
+        """
+        metrics = self.metrics
+        try:
+            if self.verbose:
+                print('\tParsed command: %s' % command)
+
+            # interpreting the command
+            results: List[Result] = self._execute(command)
+            if metrics is not None:
+                metrics.observe('command_seconds', time.perf_counter() - start)
+            if self.verbose:
+                print('\tSimulator result: %s' % ', '.join(map(str, results)))
+
+            # handling simulator results
+            replies = []
+            for result in results:
+                match result:
+                    case OK():
+                        pass
+                    case Null():
+                        pass
+                    case Terminate():
+                        self.closed = True
+                    case Reply():
+                        replies.append(self._reply(REPLY, result.message))
+                    case Info():
+                        replies.append(self._reply(INFO, result.content))
+            return b''.join(replies) or None
+
+        # handling errors
+        except UsageError as e:
+            if metrics is not None:
+                metrics.count('errors')
+            print('Usage error: %s' % str(e))
+            return self._reply(USAGE_ERROR, str(e))
+        except Exception as e:
+            if self.debug:
+                raise e
+            print('Internal error: %s' % str(e))
+            return self._reply(INTERNAL_ERROR, str(e))
+
+    def handle_commands(self, commands: List[Union[Command, ParseError]]) -> Optional[bytes]:
+        """Runs commands in order until the session closes and returns their replies together
+
+        A command that did not parse or decode is given as its `ParseError`.
+        """
+        metrics = self.metrics
+        replies = []
+        for command in commands:
+            if self.closed:
+                break
+            start = None
+            if metrics is not None:
+                start = time.perf_counter()
+                metrics.count('commands')
+            if isinstance(command, ParseError):
+                reply = self._parse_error(command)
+                # records cannot be told apart after an unknown opcode
+                self.closed = isinstance(command, FramingError)
+            else:
+                reply = self.handle_command(command, start)
+            if reply:
+                replies.append(reply)
+        return b''.join(replies) or None
+
+    def _feed_lines(self) -> Iterator[bytes]:
+        metrics = self.metrics
+        *lines, self.buffer = self.buffer.split(b'\n')
+        i = 0
+        while i < len(lines) and not self.closed and not self.binary:
+            if self.pipelined:
+                # parsing a batch at once up to the next protocol line, which may switch to records
+                end = next((j + 1 for j in range(i, len(lines))
+                            if lines[j].lstrip().startswith(b'protocol')), len(lines))
+                start = time.perf_counter() if metrics is not None else None
+                commands = parse_commands(b'\n'.join(lines[i:end]).decode() + '\n')
+                if metrics is not None:
+                    metrics.observe('decode_seconds', time.perf_counter() - start)
+                i = end
+                reply = self.handle_commands(commands)
+            else:
+                reply = self.handle_line(lines[i].decode())
+                i += 1
+            if reply:
+                yield reply
+        if self.binary:
+            # the lines after the switch were sent as records
+            self.buffer = bytearray(b'\n'.join(lines[i:] + [self.buffer]))
+
+    def _feed_records(self) -> Iterator[bytes]:
+        # decoding every complete record from the buffer without copying it, then running them
+        metrics = self.metrics
+        while not self.closed and self.binary:
+            start = time.perf_counter() if metrics is not None else None
+            with memoryview(self.buffer) as view:
+                commands, size = decode_records(view)
+            del self.buffer[:size]
+            if not commands:
+                break
+            if metrics is not None:
+                metrics.observe('decode_seconds', time.perf_counter() - start)
+            reply = self.handle_commands(commands)
+            if reply:
+                yield reply
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        """Handles every complete line or record received so far and yields the replies to send
+
+        Each line's reply is yielded as soon as it is handled, except in
+        pipelined mode where the rest of the buffer runs as one batch whose
+        replies are yielded at once. Binary records always run in batches.
+        """
+        if self.metrics is not None:
+            self.metrics.count('bytes_received', len(data))
+        self.buffer += data
+        # what is left of the buffer is handled again after a switch between lines and records
+        binary = None
+        while not self.closed and self.binary != binary:
+            binary = self.binary
+            for reply in self._feed_records() if binary else self._feed_lines():
+                if self.metrics is not None:
+                    self.metrics.count('bytes_sent', len(reply))
+                yield reply
+
+    def finish(self) -> Iterator[bytes]:
+        """Handles a last line the client did not terminate before closing its end"""
+        if self.buffer and not self.binary:
+            yield from self.feed(b'\n')
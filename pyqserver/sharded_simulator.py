@@ -0,0 +1,388 @@
+import multiprocessing
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional, Tuple
+
+from .simulator import *
+from .gates import lower_command
+from .state import StateStore
+from .kernels import apply_gate, marginal, probability_one
+
+
+class SharedStateStore(StateStore):
+    """`StateStore` whose buffer lives in shared memory, so another process can map it by name"""
+    def __init__(self, dtype=np.complex64):
+        super().__init__(dtype)
+        self.shm = None
+        self.buffer = self._empty(1)
+        self.buffer[0] = 1
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def _empty(self, size: int) -> np.ndarray:
+        # the segment replaced by this one is released in `_reserve`, after its data is copied
+        self.old_shm, self.shm = self.shm, SharedMemory(create=True, size=size * self.dtype.itemsize)
+        return np.ndarray(size, dtype=self.dtype, buffer=self.shm.buf)
+
+    def _reserve(self, num_qubits: int):
+        super()._reserve(num_qubits)
+        if self.old_shm is not None:
+            self.old_shm.close()
+            self.old_shm.unlink()
+            self.old_shm = None
+
+    def release(self):
+        self.buffer = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _attach(name: str, dtype: np.dtype, size: int) -> Tuple[SharedMemory, np.ndarray]:
+    # (shards share the session's resource tracker, which unlinks leftover segments)
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(size, dtype=dtype, buffer=shm.buf)
+
+
+class Shard:
+    """One worker's slice of a sharded state: the amplitudes whose global qubits equal `index`
+
+    Every shard holds the same local qubits. Operations on a global qubit
+    pair shard `index` with shard `index | 1 << bit`, and only the lower
+    shard of each pair works, on both amplitude arrays, so no two workers
+    ever write the same memory.
+    """
+    def __init__(self, index: int):
+        self.index = index
+        self.dtype = None
+        self.store = None
+
+    def reset(self, dtype) -> str:
+        # every global qubit starts free (always 0), so shard 0 holds the whole state
+        if self.store is not None:
+            self.store.release()
+        self.dtype = np.dtype(dtype)
+        self.store = SharedStateStore(self.dtype)
+        if self.index != 0:
+            self.store.buffer[0] = 0
+        return self.store.name
+
+    def close(self):
+        if self.store is not None:
+            self.store.release()
+
+    def astype(self, dtype) -> str:
+        # (the product with a one amplitude state is a copy)
+        store = SharedStateStore(dtype)
+        store.extend(self.store)
+        self.store.release()
+        self.dtype = store.dtype
+        self.store = store
+        return store.name
+
+    def allocate(self, bvalue: bool) -> str:
+        self.store.allocate(None, bvalue)
+        return self.store.name
+
+    def _tensor(self, vector: np.ndarray) -> np.ndarray:
+        return vector.reshape((2,) * self.store.num_qubits)
+
+    def apply_local(self, target: int, controls: List[int], global_mask: int, matrix: np.ndarray):
+        if self.index & global_mask == global_mask:
+            apply_gate(self.store.writable(), self.store.num_qubits, target, controls, matrix)
+
+    def _pair(self, bit: int, global_mask: int, names: List[str]):
+        # the partner's shared memory if this shard works on the pair, None otherwise
+        if self.index >> bit & 1 or self.index & global_mask != global_mask:
+            return None
+        return _attach(names[self.index | 1 << bit], self.dtype, 1 << self.store.num_qubits)
+
+    def _index(self, fixed: List[Tuple[int, int]]) -> tuple:
+        n = self.store.num_qubits
+        index = [np.s_[:]] * n + [Ellipsis]
+        for qubit, value in fixed:
+            index[n - 1 - qubit] = value
+        return tuple(index)
+
+    def apply_global(self, bit: int, controls: List[int], global_mask: int, matrix: np.ndarray,
+                     names: List[str]):
+        pair = self._pair(bit, global_mask, names)
+        if pair is None:
+            return
+        shm, partner = pair
+        index = self._index([(c, 1) for c in controls])
+        a0 = self._tensor(self.store.writable())[index]
+        a1 = self._tensor(partner)[index]
+        (u00, u01), (u10, u11) = matrix.tolist()
+        tmp = a0.copy()
+        a0 *= u00
+        a0 += u01 * a1
+        a1 *= u11
+        a1 += u10 * tmp
+        del a0, a1, partner
+        shm.close()
+
+    def swap(self, bit: int, qubit: int, names: List[str]):
+        """Swaps global qubit `bit` with local qubit `qubit`"""
+        pair = self._pair(bit, 0, names)
+        if pair is None:
+            return
+        shm, partner = pair
+        ours = self._tensor(self.store.writable())[self._index([(qubit, 1)])]
+        theirs = self._tensor(partner)[self._index([(qubit, 0)])]
+        tmp = ours.copy()
+        ours[...] = theirs
+        theirs[...] = tmp
+        del ours, theirs, partner
+        shm.close()
+
+    def exchange(self, bit: int, names: List[str]):
+        """Flips global qubit `bit` by swapping whole shards"""
+        pair = self._pair(bit, 0, names)
+        if pair is None:
+            return
+        shm, partner = pair
+        ours = self.store.writable()
+        tmp = ours.copy()
+        ours[...] = partner
+        partner[...] = tmp
+        del ours, partner
+        shm.close()
+
+    def project(self, bit: int, value: int, names: List[str]):
+        """Projects global qubit `bit` onto `value` and leaves it free (0)"""
+        pair = self._pair(bit, 0, names)
+        if pair is None:
+            return
+        shm, partner = pair
+        if value:
+            self.store.writable()[...] = partner
+        partner[...] = 0
+        del partner
+        shm.close()
+
+    def remove(self, qubit: int, bit: int):
+        self.store.remove(qubit, bit)
+
+    def normalize(self, probability: float):
+        self.store.normalize(probability)
+
+    def norm(self) -> float:
+        vector = self.store.vector
+        return float(np.vdot(vector, vector).real)
+
+    def probability_one(self, qubit: int) -> float:
+        return probability_one(self.store.vector, self.store.num_qubits, qubit)
+
+    def marginal(self, qubits: List[int]) -> np.ndarray:
+        if not qubits:
+            return np.array([self.norm()])
+        return marginal(self.store.vector, self.store.num_qubits, qubits)
+
+    def vector(self) -> np.ndarray:
+        return self.store.vector.copy()
+
+    def nonzero(self, limit: int) -> Tuple[int, np.ndarray, np.ndarray]:
+        indices = np.flatnonzero(np.abs(self.store.vector) > 1e-6)
+        return len(indices), indices[:limit], self.store.vector[indices[:limit]]
+
+
+def _shard_main(conn, index: int):
+    shard = Shard(index)
+    while True:
+        try:
+            method, args = conn.recv()
+        except EOFError:
+            break
+        try:
+            reply = (True, getattr(shard, method)(*args))
+        except Exception as e:
+            reply = (False, e)
+        conn.send(reply)
+        if method == 'close':
+            break
+
+
+class ShardedSimulator(StateVectorSimulator):
+    """State vector split across `shards` worker processes over shared memory
+
+    The top log2(shards) qubits of the state are global: shard `i` holds the
+    amplitudes where they spell `i`, and every other qubit is local to each
+    shard. New qubits fill free global slots first. Gates on local qubits
+    run in every shard at once, gates on global qubits pair up shards.
+    Global qubits are measured by swapping them with a local qubit first.
+    Probabilities are reduced over the shards. A session can then hold a
+    state larger than one process may, using every shard's cores.
+    """
+    native_blocks = False
+    backend_options = ('shards',)
+
+    def __init__(self, shards: int = 4, **kwargs):
+        if shards < 1 or shards & (shards - 1):
+            raise UsageError('Shard count must be a power of two')
+        self.num_global = shards.bit_length() - 1
+        ctx = multiprocessing.get_context('spawn')
+        self.conns = []
+        self.processes = []
+        try:
+            for i in range(shards):
+                conn, child_conn = ctx.Pipe()
+                process = ctx.Process(target=_shard_main, args=(child_conn, i), daemon=True)
+                process.start()
+                child_conn.close()
+                self.conns.append(conn)
+                self.processes.append(process)
+            # (the base constructor resets the state, which needs the shards)
+            super(ShardedSimulator, self).__init__(**kwargs)
+        except BaseException:
+            # nothing would close a simulator whose constructor failed
+            self._stop_shards()
+            raise
+
+    def _call_all(self, method: str, *args) -> list:
+        # every shard runs the step before any runs the next one
+        for conn in self.conns:
+            conn.send((method, args))
+        replies = [conn.recv() for conn in self.conns]
+        for ok, value in replies:
+            if not ok:
+                raise value
+        return [value for _, value in replies]
+
+    def reset(self):
+        super().reset()
+        self.names = self._call_all('reset', self.dtype)
+        self.local_regs: List[int] = []
+        self.global_regs: List[Optional[int]] = [None] * self.num_global
+
+    def _stop_shards(self):
+        # shards release their shared memory before exiting
+        if self.conns:
+            self._call_all('close')
+            for process in self.processes:
+                process.join()
+            self.conns = []
+
+    def close(self):
+        super().close()
+        self._stop_shards()
+
+    def _convert_state(self):
+        self.names = self._call_all('astype', self.dtype)
+
+    @property
+    def state(self) -> np.ndarray:
+        # every shard's amplitudes, shards being the high bits of the index
+        return np.concatenate(self._call_all('vector'))
+
+    def _update_global_positions(self):
+        # global qubit b is bit len(local_regs) + b of a full amplitude index
+        for b, reg in enumerate(self.global_regs):
+            if reg is not None:
+                self.qubit_map[reg] = len(self.local_regs) + b
+
+    def _locate(self, reg: int) -> Tuple[bool, int]:
+        # (whether reg is global, its global bit or local qubit)
+        qubit = self.qubit_map[reg]
+        num_local = len(self.local_regs)
+        return (True, qubit - num_local) if qubit >= num_local else (False, qubit)
+
+    def _allocate_qubit(self, reg: int, bvalue: bool = False):
+        if None in self.global_regs:
+            bit = self.global_regs.index(None)
+            self.global_regs[bit] = reg
+            if bvalue:
+                self._call_all('exchange', bit, self.names)
+        else:
+            self.names = self._call_all('allocate', bvalue)
+            self.local_regs.append(reg)
+            self.qubit_map[reg] = len(self.local_regs) - 1
+        self._update_global_positions()
+        self.num_qubits += 1
+
+    def _apply_gate(self, gate: Gate):
+        controls, global_mask = [], 0
+        for c in gate.controls:
+            is_global, position = self._locate(c)
+            if is_global:
+                global_mask |= 1 << position
+            else:
+                controls.append(position)
+        is_global, target = self._locate(gate.target)
+        if is_global:
+            self._call_all('apply_global', target, controls, global_mask, gate.matrix, self.names)
+        else:
+            self._call_all('apply_local', target, controls, global_mask, gate.matrix)
+
+    def _execute_commands(self, commands: List[Command]):
+        for command in commands:
+            match command:
+                case Q():
+                    self._allocate_qubit(command.reg, command.bvalue)
+                case _:
+                    gate = lower_command(command)
+                    if gate is not None:
+                        self._apply_gate(gate)
+
+    def _remove(self, reg: int, bit: int):
+        is_global, position = self._locate(reg)
+        if is_global and not self.local_regs:
+            self._call_all('project', position, bit, self.names)
+            self.global_regs[position] = None
+        else:
+            if is_global:
+                # the top local qubit takes the global slot, then is removed as a local qubit
+                top = len(self.local_regs) - 1
+                self._call_all('swap', position, top, self.names)
+                self.global_regs[position] = self.local_regs[top]
+                self.local_regs[top] = reg
+                position = top
+            self._call_all('remove', position, bit)
+            top = self.local_regs.pop()
+            if position < len(self.local_regs):
+                self.local_regs[position] = top
+                self.qubit_map[top] = position
+        del self.qubit_map[reg]
+        self._update_global_positions()
+        self.num_qubits -= 1
+
+    def _collapse(self, reg: int, bit: int, probability: float):
+        self._remove(reg, bit)
+        self._call_all('normalize', probability)
+
+    def _marginal(self, regs: List[int]) -> np.ndarray:
+        located = [self._locate(reg) for reg in regs]
+        local = [position for is_global, position in located if not is_global]
+        joint = np.zeros((2,) * len(regs))
+        for i, probabilities in enumerate(self._call_all('marginal', local)):
+            # the shard's global bits fix the axes of global registers
+            index = tuple((i >> position & 1) if is_global else np.s_[:]
+                          for is_global, position in located)
+            joint[index] += probabilities.reshape((2,) * len(local))
+        return joint.reshape(-1)
+
+    def _measure_many(self, regs: List[int]):
+        for reg in regs:
+            self._measure(reg)
+
+    def dump(self) -> str:
+        # the lowest basis states over every shard, shards being the high bits of the index
+        num_local = len(self.local_regs)
+        count, indices, amplitudes = 0, [], []
+        for i, (n, shard_indices, shard_amplitudes) in enumerate(self._call_all('nonzero', DUMP_LIMIT)):
+            count += n
+            indices.append(shard_indices + (i << num_local))
+            amplitudes.append(shard_amplitudes)
+        indices = np.concatenate(indices)[:DUMP_LIMIT]
+        amplitudes = np.concatenate(amplitudes)[:DUMP_LIMIT]
+        lines = self._dump_lines(self.qubit_map, indices, amplitudes)
+        if count > DUMP_LIMIT:
+            lines.append('# ... and %d more' % (count - DUMP_LIMIT))
+        return ''.join(line + '\n' for line in lines)
+
+    def _save_state(self):
+        raise UsageError('Shot blocks are not supported by %s' % type(self).__name__)
+
+    def _share_state(self, saved):
+        raise UsageError('Snapshots are not supported by %s' % type(self).__name__)
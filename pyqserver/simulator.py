@@ -1,9 +1,25 @@
+import time
+import numpy as np
 from abc import ABC, abstractmethod
-from typing import Type
+from typing import Any, Callable, Optional, Tuple, Type
+from collections import Counter, OrderedDict
 from dataclasses import dataclass, is_dataclass
 from enum import Enum
 
 from .parser import *
+from .gates import Gate, Unitary, lower_command, u_angles
+from .optimizer import Optimizer
+from .state import StateStore
+from .snapshots import SNAPSHOTS, CachedState
+from .kernels import KernelPool, apply_gate, marginal, probability_one
+from .metrics import Metrics
+
+
+# most basis states listed by `dump`
+DUMP_LIMIT = 256
+
+# amplitude dtype of each `precision` option
+PRECISIONS = {'single': np.complex64, 'double': np.complex128}
 
 
 class UsageError(Exception):
@@ -34,31 +50,558 @@ class Null(Result):
     """Nothing happened"""
 
 
+def _param(params: List[float], angle: float) -> str:
+    # angles are circuit inputs, so circuits that differ in angles only share a cache entry
+    params.append(angle)
+    return 'p%d' % (len(params) - 1)
+
+
+class CircuitCache:
+    """LRU cache of compiled backend circuits keyed by their OpenQASM source
+
+    Angles are inputs of the source, so the key is the gate sequence's shape.
+    """
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.circuits = OrderedDict()
+
+    def get(self, qasm_str: str, compile: Callable[[str], Any]) -> Any:
+        circuit = self.circuits.get(qasm_str)
+        if circuit is None:
+            circuit = compile(qasm_str)
+            self.circuits[qasm_str] = circuit
+            if len(self.circuits) > self.max_size:
+                self.circuits.popitem(last=False)
+        else:
+            self.circuits.move_to_end(qasm_str)
+        return circuit
+
+
+@dataclass
+class FlushPolicy:
+    """When a queueing session runs its queue before a result needs it
+
+    The queue is flushed before it exceeds `max_gates` commands or
+    `max_cost` qubits x commands, or once its oldest command has waited
+    `max_delay` seconds. From `max_gates // 16` commands on it is also
+    flushed when the next command touches none of its registers, which cuts
+    between independent pieces of work.
+    """
+    max_gates: int = 4096
+    max_cost: int = 1 << 17
+    max_delay: float = 0.1
+
+    @property
+    def min_gates(self) -> int:
+        return self.max_gates // 16
+
+
+def _command_regs(command: Command) -> List[int]:
+    regs = [getattr(command, name) for name in ('reg', 'x', 'y', 'z') if hasattr(command, name)]
+    return regs + getattr(command, 'controls', [])
+
+
 class Simulator(ABC):
-    def __init__(self, queueing=False):
+    # amplitude dtype, unless the session sets a precision
+    dtype = np.complex64
+    # whether `_execute_commands` applies dense multi-qubit `Block`s
+    native_blocks = False
+    # whether `_marginal` takes several registers at once
+    joint_marginals = False
+    # server options only this backend's constructor takes
+    backend_options = ()
+
+    def __init__(self, queueing=False, lazy_measurement=False, optimize=False, fusion_qubits=2,
+                 memory_limit=None, scratch_dir=None, threads=1,
+                 metrics=False, flush_gates=4096, flush_cost=1 << 17, flush_delay=0.1,
+                 precision=None):
+        self.metrics = Metrics() if metrics else None
+        if precision is not None:
+            self.dtype = PRECISIONS[precision]
+        self.rng = np.random.default_rng()
+        self.memory_limit = memory_limit
+        self.scratch_dir = scratch_dir
+        self.threads = 1
+        self.pool = None
+        self._set_threads(threads)
         self.reset()
         self.queueing = queueing
+        self.flush_policy = FlushPolicy(flush_gates, flush_cost, flush_delay)
+        self.lazy_measurement = lazy_measurement
+        self.optimizer = None
+        if optimize:
+            self.optimizer = Optimizer(fusion_qubits if self.native_blocks else 1)
 
     @abstractmethod
-    def dump(self):
+    def dump(self) -> str:
+        """Describes the current state for debugging"""
         pass
 
     @abstractmethod
-    def _execute_qasm(self):
+    def _measure(self, reg: int):
         pass
 
-    @abstractmethod
-    def _measure(self, reg: int):
+    def _marginal(self, regs: List[int]) -> np.ndarray:
+        """Joint outcome distribution of measuring `regs` (`regs[0]` is the most significant bit)"""
+        raise UsageError('Shot blocks are not supported by %s' % type(self).__name__)
+
+    def _collapse(self, reg: int, bit: int, probability: float):
+        """Measures `reg` with the given outcome, which has the given probability"""
+        raise UsageError('Shot blocks are not supported by %s' % type(self).__name__)
+
+    def _save_state(self) -> Any:
+        raise UsageError('Shot blocks are not supported by %s' % type(self).__name__)
+
+    def _share_state(self, saved: Any) -> Any:
+        """Copy of a saved state to load, sharing storage with it where possible"""
+        raise UsageError('Snapshots are not supported by %s' % type(self).__name__)
+
+    def _load_state(self, saved: Any):
+        raise UsageError('Shot blocks are not supported by %s' % type(self).__name__)
+
+    def close(self):
+        """Releases resources held by the simulator when its session ends"""
+        self._set_threads(1)
+
+    def collect_metrics(self) -> Optional[Metrics]:
+        """Copy of the metrics recorded so far, if enabled"""
+        if self.metrics is None:
+            return None
+        metrics = self.metrics.copy()
+        if self.optimizer is not None:
+            metrics.count('gates_removed', self.optimizer.gates_removed)
+            metrics.count('gates_fused', self.optimizer.gates_fused)
+        return metrics
+
+    def _timed(self, name: str, func: Callable, *args):
+        # calls `func`, recording how long it took when metrics are enabled
+        if self.metrics is None:
+            return func(*args)
+        start = time.perf_counter()
+        result = func(*args)
+        self.metrics.observe(name, time.perf_counter() - start)
+        return result
+
+    def _set_threads(self, threads: int):
+        # kernels of large states run on a pool of `threads` threads
+        if threads < 1:
+            raise UsageError('Thread count must be at least 1')
+        if self.pool is not None:
+            self.pool.close()
+        self.threads = threads
+        self.pool = KernelPool(threads) if threads > 1 else None
+
+    def _set_precision(self, precision: str):
+        dtype = PRECISIONS[precision]
+        if np.dtype(dtype) != np.dtype(self.dtype):
+            self._execute_queue()
+            self.dtype = dtype
+            self._convert_state()
+
+    def _convert_state(self):
+        """Converts the state's amplitudes to `dtype`"""
         pass
 
+    def _state_nbytes(self, num_qubits: int) -> int:
+        """Memory the state needs for `num_qubits` qubits"""
+        return 0
+
+    def _check_memory(self, num_qubits: int):
+        nbytes = self._state_nbytes(num_qubits)
+        if self.memory_limit is not None and nbytes > self.memory_limit:
+            raise UsageError('%d qubits need %d bytes, over the session limit of %d bytes' % \
+                             (num_qubits, nbytes, self.memory_limit))
+
     def reset(self):
         self.num_qubits = 0
         self.qubit_map = {}
         self.bit_register = {}
         self.queue = []
+        self.queued_qubits = 0
+        self.pending_measurements = 0
+
+    def _flush_reason(self, command: Command) -> Optional[str]:
+        """Why the queue should run before `command` joins it, None if it should not"""
+        policy = self.flush_policy
+        n = len(self.queue)
+        if n >= policy.max_gates:
+            return 'gates'
+        if n * (self.num_qubits + self.queued_qubits) >= policy.max_cost:
+            return 'cost'
+        if time.monotonic() - self.queue_started >= policy.max_delay:
+            return 'delay'
+        if n >= policy.min_gates:
+            regs = _command_regs(command)
+            if regs and self.queued_regs.isdisjoint(regs):
+                return 'disjoint'
+        return None
+
+    def _enqueue(self, command: Command):
+        if self.queueing:
+            if not self.queue:
+                self.queue_started = time.monotonic()
+                self.queued_regs = set()
+            else:
+                reason = self._flush_reason(command)
+                if reason is not None:
+                    if self.metrics is not None:
+                        self.metrics.count('flushes_' + reason)
+                    self._execute_queue()
+                    self.queue_started = time.monotonic()
+                    self.queued_regs = set()
+            self.queued_regs.update(_command_regs(command))
+        if isinstance(command, Q):
+            if self.memory_limit is not None:
+                # refusing the allocation before it is queued keeps the session usable
+                self._check_memory(self.num_qubits + self.queued_qubits + 1)
+            self.queued_qubits += 1
+        self.queue.append(command)
+
+    def _allocate_qubit(self, reg: int):
+        self.qubit_map[reg] = self.num_qubits
+        self.num_qubits += 1
+
+    @abstractmethod
+    def _execute_commands(self, commands: List[Command]):
+        """Applies a batch of queued commands to the state"""
+
+    def _discard(self, reg: int):
+        # tracing a qubit out is the same as measuring it and forgetting the outcome
+        self._measure(reg)
+        del self.bit_register[reg]
+
+    def _measure_many(self, regs: List[int]):
+        # backends that can sample several qubits jointly override this
+        for reg in regs:
+            self._measure(reg)
+
+    def _execute_queue(self):
+        # do nothing if there are no commands in the queue
+        if len(self.queue) > 0:
+            commands = self.queue
+            if self.metrics is not None:
+                self.metrics.observe('flush_queue_length', len(commands))
+            if self.optimizer is not None and len(commands) > 1:
+                commands = self.optimizer.optimize(commands)
+
+            # running gates in batches and consecutive measurements jointly
+            batch = []
+            measured = []
+            for command in commands:
+                match command:
+                    case M():
+                        if batch:
+                            self._timed('execute_seconds', self._execute_commands, batch)
+                            batch = []
+                        if command.reg in measured:
+                            self._timed('measure_seconds', self._measure_many, measured)
+                            measured = []
+                        measured.append(command.reg)
+                    case _:
+                        if measured:
+                            self._timed('measure_seconds', self._measure_many, measured)
+                            measured = []
+                        batch.append(command)
+            if batch:
+                self._timed('execute_seconds', self._execute_commands, batch)
+            if measured:
+                self._timed('measure_seconds', self._measure_many, measured)
+            if self.metrics is not None:
+                self.metrics.observe('state_bytes', self._state_nbytes(self.num_qubits))
+
+            self.queue = []
+            self.queued_qubits = 0
+            self.pending_measurements = 0
+
+    def execute(self, command: Command):
+        match command:
+            case M():
+                if self.lazy_measurement:
+                    # deferring the measurement until its result is read
+                    self._enqueue(command)
+                    self.pending_measurements += 1
+                    return OK()
+                self._execute_queue()
+                self._timed('measure_seconds', self._measure, command.reg)
+                return OK()
+            case R():
+                if self.pending_measurements > 0:
+                    self._execute_queue()
+                rval = self.bit_register[command.reg]
+                del self.bit_register[command.reg]
+                return Reply(str(rval))
+            case B():
+                self.bit_register[command.reg] = int(command.bvalue)
+                return OK()
+            case N():
+                if self.pending_measurements > 0:
+                    self._execute_queue()
+                if command.reg not in self.bit_register:
+                    raise UsageError('Register %d is not a bit' % command.reg)
+                self.bit_register[command.reg] ^= 1
+                return OK()
+            case D():
+                if self.pending_measurements > 0:
+                    self._execute_queue()
+                if command.reg in self.bit_register:
+                    del self.bit_register[command.reg]
+                    return OK()
+                self._execute_queue()
+                if command.reg not in self.qubit_map:
+                    raise UsageError('Register %d does not exist' % command.reg)
+                self._discard(command.reg)
+                return OK()
+            case Dump():
+                self._execute_queue()
+                dump = self.dump()
+                if self.optimizer is not None:
+                    # the session's optimizer counters follow the state
+                    dump += '# gates removed: %d, gates fused: %d\n' % (
+                        self.optimizer.gates_removed, self.optimizer.gates_fused)
+                return Info(dump)
+            case Threads():
+                self._set_threads(command.count)
+                return OK()
+            case Precision():
+                self._set_precision(command.precision)
+                return OK()
+            case Snapshot():
+                self._execute_queue()
+                nbytes = self._state_nbytes(self.num_qubits)
+                state = CachedState(type(self), self._save_state(), self.num_qubits, nbytes,
+                                    self.dtype)
+                if not SNAPSHOTS.put(command.name, state):
+                    raise UsageError('Snapshot of %d bytes does not fit in the snapshot cache' % nbytes)
+                return OK()
+            case Restore():
+                state = SNAPSHOTS.get(command.name)
+                if state is None:
+                    raise UsageError('No snapshot named %s' % command.name)
+                if state.backend is not type(self):
+                    raise UsageError('Snapshot %s was taken by %s' % \
+                                     (command.name, state.backend.__name__))
+                self._check_memory(state.num_qubits)
+                self._load_state(self._share_state(state.saved))
+                if np.dtype(state.dtype) != np.dtype(self.dtype):
+                    # the restored state takes on this session's precision
+                    self._convert_state()
+                return OK()
+            case Quit():
+                return Terminate()
+            case Reset():
+                self.reset()
+                return OK()
+            case _:
+                self._enqueue(command)
+                if not self.queueing:
+                    self._execute_queue()
+                return OK()
+
+    def run_shots(self, commands: List[Command], shots: int) -> List[Result]:
+        """Runs `commands` `shots` times from the current state and aggregates the reads
+
+        Gates are simulated once per distinct measurement history: every
+        measurement splits the remaining shots binomially between its two
+        outcomes, and trailing measurements are sampled jointly. Each `R`
+        replies with how often it read 0 and 1, and the state is restored
+        afterwards.
+        """
+        self._execute_queue()
+        initial = self._save_state()
+        counts = {i: Counter() for i, command in enumerate(commands) if isinstance(command, R)}
+
+        # from here on only measurements and reads are left
+        trailing = len(commands)
+        while trailing > 0 and isinstance(commands[trailing - 1], (M, R)):
+            trailing -= 1
+
+        # branches still to run as (next command, shots, saved state, forced measurement)
+        # where a forced measurement is (register, bit, probability, whether the bit is kept)
+        branches = [(0, shots, None, None)]
+        while branches:
+            i, n, saved, forced = branches.pop()
+            if saved is not None:
+                self._load_state(saved)
+            if forced is not None:
+                reg, bit, probability, keep = forced
+                self._collapse(reg, bit, probability)
+                if keep:
+                    self.bit_register[reg] = bit
+
+            while i < len(commands):
+                command = commands[i]
+                match command:
+                    case M() if i >= trailing and self.joint_marginals:
+                        # sampling every remaining measurement at once
+                        self._execute_queue()
+                        regs = [c.reg for c in commands[i:] if isinstance(c, M)]
+                        marginal = self._marginal(regs)
+                        samples = self.rng.multinomial(n, marginal / marginal.sum())
+                        for outcome in np.flatnonzero(samples):
+                            bits = dict(zip(regs, np.unravel_index(outcome, (2,) * len(regs))))
+                            for j, c in enumerate(commands[i:], i):
+                                if isinstance(c, R):
+                                    bit = bits[c.reg] if c.reg in bits else self.bit_register[c.reg]
+                                    counts[j][int(bit)] += int(samples[outcome])
+                        break
+                    case M() | D() if command.reg not in self.bit_register:
+                        # discarding a qubit branches like measuring it, only without the bit
+                        keep = isinstance(command, M)
+                        self._execute_queue()
+                        p1 = self._marginal([command.reg])[1]
+                        n1 = int(self.rng.binomial(n, min(max(p1, 0.0), 1.0)))
+                        if n1 == 0 or n1 == n:
+                            bit = int(n1 == n)
+                        else:
+                            # the other outcome gets its own branch from a copy of the state
+                            forced = (command.reg, 1, p1, keep)
+                            branches.append((i + 1, n1, self._save_state(), forced))
+                            bit, n = 0, n - n1
+                        self._collapse(command.reg, bit, p1 if bit else 1 - p1)
+                        if keep:
+                            self.bit_register[command.reg] = bit
+                    case R():
+                        counts[i][self.bit_register.pop(command.reg)] += n
+                    case _:
+                        self.execute(command)
+                i += 1
+            self.queue = []
+            self.queued_qubits = 0
+
+        self._load_state(initial)
+        return [Reply(' '.join('%d:%d' % (bit, c[bit]) for bit in (0, 1)))
+                for _, c in sorted(counts.items())]
+
+
+class StateVectorSimulator(Simulator):
+    """Simulator whose state lives in a `StateStore`
+
+    Qubit `qubit_map[reg]` is bit `qubit_map[reg]` of the amplitude index,
+    see `StateStore` for how qubits are added and removed.
+    """
+    joint_marginals = True
+
+    def reset(self):
+        super().reset()
+        self.store = StateStore(self.dtype, self.scratch_dir)
+
+    def _state_nbytes(self, num_qubits: int) -> int:
+        return (1 << num_qubits) * np.dtype(self.dtype).itemsize
+
+    def _convert_state(self):
+        self.store = self.store.astype(self.dtype)
+
+    @property
+    def state(self) -> np.ndarray:
+        return self.store.vector
+
+    def _nonzero_amplitudes(self) -> Tuple[np.ndarray, np.ndarray]:
+        indices = np.flatnonzero(np.abs(self.state) > 1e-6)
+        return indices, self.state[indices]
+
+    def _dump_lines(self, regs: List[int], indices: np.ndarray, amplitudes: np.ndarray) -> List[str]:
+        # one line per basis state, registers in increasing order from the left
+        regs = sorted(regs)
+        lines = ['# %d qubits: %s' % (len(regs), ' '.join(map(str, regs)))]
+        for index, amplitude in zip(indices[:DUMP_LIMIT].tolist(), amplitudes[:DUMP_LIMIT].tolist()):
+            label = ''.join(str(index >> self.qubit_map[reg] & 1) for reg in regs)
+            lines.append('# |%s> %.6f%+.6fi' % (label, amplitude.real, amplitude.imag))
+        if len(indices) > DUMP_LIMIT:
+            lines.append('# ... and %d more' % (len(indices) - DUMP_LIMIT))
+        return lines
+
+    def dump(self) -> str:
+        indices, amplitudes = self._nonzero_amplitudes()
+        return ''.join(line + '\n' for line in self._dump_lines(self.qubit_map, indices, amplitudes))
+
+    def _allocate_qubit(self, reg: int, bvalue: bool = False):
+        self.qubit_map[reg] = self.store.allocate(reg, bvalue)
+        self.num_qubits += 1
+
+    def _apply_gate(self, gate: Gate):
+        # one masked pass over the amplitudes, however many controls the gate has
+        target = self.qubit_map[gate.target]
+        controls = [self.qubit_map[c] for c in gate.controls]
+        apply_gate(self.store.writable(), self.num_qubits, target, controls, gate.matrix, self.pool)
+
+    def _remove(self, reg: int, bit: int):
+        # the highest qubit takes the removed qubit's place, nothing else moves
+        qubit = self.qubit_map.pop(reg)
+        moved = self.store.remove(qubit, bit)
+        if moved is not None:
+            self.qubit_map[moved] = qubit
+        self.num_qubits -= 1
+
+    def _measure(self, reg: int):
+        p1 = self._marginal([reg])[1]
+        bit_result = int(self.rng.random() < p1)
+        self._collapse(reg, bit_result, p1 if bit_result else 1 - p1)
+        self.bit_register[reg] = bit_result
+
+    def _collapse(self, reg: int, bit: int, probability: float):
+        self._remove(reg, bit)
+        self.store.normalize(probability)
+
+    def _marginal(self, regs: List[int]) -> np.ndarray:
+        n = self.num_qubits
+        if len(regs) == 1:
+            p1 = probability_one(self.state, n, self.qubit_map[regs[0]], self.pool)
+            return np.array([1 - p1, p1])
+        return marginal(self.state, n, [self.qubit_map[reg] for reg in regs], self.pool)
+
+    def _measure_many(self, regs: List[int]):
+        if len(regs) == 1:
+            return self._measure(regs[0])
+
+        # sampling every outcome jointly, then collapsing qubit by qubit
+        marginal = self._marginal(regs)
+        outcome = self.rng.choice(len(marginal), p=marginal / marginal.sum())
+        bits = np.unravel_index(outcome, (2,) * len(regs))
+        for reg, bit in zip(regs, bits):
+            self.bit_register[reg] = int(bit)
+            self._remove(reg, int(bit))
+        self.store.normalize(marginal[outcome])
+
+    def _save_state(self):
+        # copy-on-write, so only the first of the saved and the live state to change copies
+        return (self.store.share(), dict(self.qubit_map), dict(self.bit_register))
+
+    def _share_state(self, saved):
+        store, qubit_map, bit_register = saved
+        return (store.share(), dict(qubit_map), dict(bit_register))
+
+    def _load_state(self, saved):
+        # saved states are loaded at most once, so they are adopted without copying
+        self.store, self.qubit_map, self.bit_register = saved
+        self.num_qubits = self.store.num_qubits
+        self.queue = []
+        self.queued_qubits = 0
+        self.pending_measurements = 0
+
 
-    def _command_to_qasm_gate(self, command: Command) -> str:
+class QasmSimulator(StateVectorSimulator):
+    """State vector simulator whose backend runs OpenQASM circuits"""
+    @abstractmethod
+    def _execute_qasm(self, qasm_str: str, params: List[float]):
+        """Runs an OpenQASM circuit on the current state, with input `p<k>` set to `params[k]`"""
+
+    def _has_qasm_gate(self, command: Command) -> bool:
+        """Whether `_command_to_qasm_gate` has an OpenQASM statement for the command"""
         match command:
+            case _ if getattr(command, 'controls', None):
+                return False
+            case X() | Y() | Z() | H() | S() | SInv() | T() | TInv() | Rot() | Unitary():
+                return True
+            case CRot() | CNOT() | Toffoli() | CZ() | CY():
+                return True
+            case _:
+                return False
+
+    def _command_to_qasm_gate(self, command: Command, params: List[float]) -> str:
+        match command:
+            case _ if getattr(command, 'controls', None):
+                # controlled variants have no OpenQASM statement here
+                return ''
             case Q():
                 if command.bvalue:
                     return 'x qs[%d];' % self.qubit_map[command.reg]
@@ -88,11 +631,15 @@ class Simulator(ABC):
                 return 'tdg qs[%d];' % idx
             case Rot():
                 idx = self.qubit_map[command.reg]
-                return 'rz(%f) qs[%d];' % (command.r, idx)
+                return 'rz(%s) qs[%d];' % (_param(params, command.r), idx)
+            case Unitary():
+                idx = self.qubit_map[command.reg]
+                angles = [_param(params, angle) for angle in u_angles(command.matrix)]
+                return 'U(%s, %s, %s) qs[%d];' % (*angles, idx)
             case CRot():
                 x = self.qubit_map[command.x]
                 y = self.qubit_map[command.y]
-                return 'cp(%f) qs[%d], qs[%d];' % (command.r, x, y)
+                return 'cp(%s) qs[%d], qs[%d];' % (_param(params, command.r), x, y)
             case CNOT():
                 x = self.qubit_map[command.x]
                 y = self.qubit_map[command.y]
@@ -102,53 +649,56 @@ class Simulator(ABC):
                 y = self.qubit_map[command.y]
                 z = self.qubit_map[command.z]
                 return 'ccx qs[%d], qs[%d], qs[%d];' % (x, y, z)
+            case CZ():
+                x = self.qubit_map[command.x]
+                y = self.qubit_map[command.y]
+                return 'cz qs[%d], qs[%d];' % (x, y)
+            case CY():
+                x = self.qubit_map[command.x]
+                y = self.qubit_map[command.y]
+                return 'cy qs[%d], qs[%d];' % (x, y)
             case _:
                 return ''
 
-    def _commands_to_qasm(self, commands: List[Command]) -> str:
+    def _commands_to_qasm(self, commands: List[Command]) -> Tuple[str, List[float]]:
+        """OpenQASM circuit of the commands whose angles are inputs `p<k>`, and the angles"""
         # calculating how many qubits to allocate for simulation
         for command in commands:
             match command:
                 case Q():
-                    self.qubit_map[command.reg] = self.num_qubits
-                    self.num_qubits += 1
+                    self._allocate_qubit(command.reg)
 
         # constrution OpenQASM circuit
         qasm_stmts = ['OPENQASM 3.0;', 'include "stdgates.inc";']
         qasm_stmts.append('qubit[%d] qs;' % self.num_qubits)
         qasm_stmts.append('id qs;') # temporary fix for cirq issue where qubits don't show up unless gates act on them
+        params = []
         for command in commands:
-            stmt = self._command_to_qasm_gate(command)
+            stmt = self._command_to_qasm_gate(command, params)
             if stmt:
                 qasm_stmts.append(stmt)
+        qasm_stmts[2:2] = ['input float[64] p%d;' % k for k in range(len(params))]
 
         qasm_str = '\n'.join(qasm_stmts)
-        return qasm_str
+        return qasm_str, params
 
-    def _execute_queue(self):
-        # do nothing if there are no commands in the queue
-        if len(self.queue) > 0:
-            qasm_str = self._commands_to_qasm(self.queue)
-            self._execute_qasm(qasm_str)
-            self.queue = []
+    def _execute_qasm_commands(self, commands: List[Command]):
+        qasm_str, params = self._timed('qasm_seconds', self._commands_to_qasm, commands)
+        self._timed('backend_seconds', self._execute_qasm, qasm_str, params)
 
-    def execute(self, command: Command):
-        match command:
-            case M():
-                self._execute_queue()
-                self._measure(command.reg)
-                return OK()
-            case R():
-                rval = self.bit_register[command.reg]
-                del self.bit_register[command.reg]
-                return Reply(str(rval))
-            case Quit():
-                return Terminate()
-            case Reset():
-                self.reset()
-                return OK()
-            case _:
-                self.queue.append(command)
-                if not self.queueing:
-                    self._execute_queue()
-                return OK()
+    def _execute_commands(self, commands: List[Command]):
+        # running OpenQASM circuits, with gates OpenQASM cannot express here
+        # (controlled variants, DIAG) applied to the state directly in between
+        run = []
+        for command in commands:
+            if isinstance(command, Q) or self._has_qasm_gate(command):
+                run.append(command)
+                continue
+            gate = lower_command(command)
+            if gate is not None:
+                if run:
+                    self._execute_qasm_commands(run)
+                    run = []
+                self._apply_gate(gate)
+        if run:
+            self._execute_qasm_commands(run)
@@ -0,0 +1,54 @@
+from threading import Lock
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+
+@dataclass
+class CachedState:
+    """Simulator state saved under a name, `saved` comes from `backend._save_state`"""
+    backend: type
+    saved: Any
+    num_qubits: int
+    nbytes: int
+    dtype: type
+
+
+class SnapshotCache:
+    """LRU cache of named states shared by every session in a process
+
+    Cached states share their storage copy-on-write with the sessions that
+    saved or restored them. Once they take more than `max_bytes`, the least
+    recently used ones are evicted.
+    """
+    def __init__(self, max_bytes: int = 1 << 30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.states = OrderedDict()
+        self.lock = Lock()
+
+    def put(self, name: str, state: CachedState) -> bool:
+        """Caches `state` under `name`, unless it alone is larger than the cache"""
+        if state.nbytes > self.max_bytes:
+            return False
+        with self.lock:
+            old = self.states.pop(name, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.states[name] = state
+            self.nbytes += state.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.states.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return True
+
+    def get(self, name: str) -> Optional[CachedState]:
+        with self.lock:
+            state = self.states.get(name)
+            if state is not None:
+                self.states.move_to_end(name)
+        return state
+
+
+# snapshots of every session in this process
+SNAPSHOTS = SnapshotCache()
@@ -0,0 +1,88 @@
+import numpy as np
+from typing import List, Tuple
+
+from .simulator import *
+from .gates import Gate
+from .numpy_simulator import NumpySimulator
+from .state import SparseStore
+
+
+class SparseSimulator(NumpySimulator):
+    """State vector simulator that only stores nonzero amplitudes
+
+    Suits reversible arithmetic on basis states with few superpositions, on
+    up to 64 qubits. Once a state of at least `min_dense_qubits` qubits has
+    more than `density_threshold` of its amplitudes nonzero, the session
+    continues on a dense `StateStore`.
+    """
+    native_blocks = False
+    density_threshold = 0.1
+    min_dense_qubits = 12
+
+    def __init__(self, **kwargs):
+        super(SparseSimulator, self).__init__(**kwargs)
+
+    def reset(self):
+        super().reset()
+        self.store = SparseStore(self.dtype)
+
+    def _state_nbytes(self, num_qubits: int) -> int:
+        # a new qubit does not add amplitudes to a sparse state
+        if self.sparse:
+            return self.store.nbytes
+        return super()._state_nbytes(num_qubits)
+
+    @property
+    def sparse(self) -> bool:
+        return isinstance(self.store, SparseStore)
+
+    def _allocate_qubit(self, reg: int, bvalue: bool = False):
+        if self.sparse and self.num_qubits == SparseStore.max_qubits:
+            raise UsageError('Sparse simulation is limited to %d qubits' % SparseStore.max_qubits)
+        super()._allocate_qubit(reg, bvalue)
+
+    @property
+    def state(self) -> np.ndarray:
+        if not self.sparse:
+            return super().state
+        state = np.zeros(1 << self.num_qubits, dtype=self.dtype)
+        state[self.store.indices.astype(np.int64)] = self.store.amplitudes
+        return state
+
+    def _nonzero_amplitudes(self) -> Tuple[np.ndarray, np.ndarray]:
+        if not self.sparse:
+            return super()._nonzero_amplitudes()
+        order = np.argsort(self.store.indices)
+        return self.store.indices[order], self.store.amplitudes[order]
+
+    def _dense_fits(self) -> bool:
+        nbytes = super()._state_nbytes(self.num_qubits)
+        return self.memory_limit is None or nbytes <= self.memory_limit
+
+    def _apply_gate(self, gate: Gate):
+        if not self.sparse:
+            return super()._apply_gate(gate)
+        target = self.qubit_map[gate.target]
+        controls = [self.qubit_map[c] for c in gate.controls]
+
+        # refusing a gate that could grow the amplitudes past the session's memory,
+        # unless the dense state fits
+        if self.memory_limit is not None:
+            nbytes = self.store.grown_nbytes(target, controls, gate.matrix)
+            if nbytes > self.memory_limit:
+                if not self._dense_fits():
+                    raise UsageError('Gate could grow the sparse state to %d bytes, over the '
+                                     'session limit of %d bytes' % (nbytes, self.memory_limit))
+                self.store = self.store.to_dense(self.scratch_dir)
+                return super()._apply_gate(gate)
+
+        self.store.apply_gate(target, controls, gate.matrix)
+        if self.num_qubits >= self.min_dense_qubits and self.store.density > self.density_threshold \
+                and self._dense_fits():
+            # staying sparse if the dense state would not fit in the session's memory
+            self.store = self.store.to_dense(self.scratch_dir)
+
+    def _marginal(self, regs: List[int]) -> np.ndarray:
+        if not self.sparse:
+            return super()._marginal(regs)
+        return self.store.marginal([self.qubit_map[reg] for reg in regs])
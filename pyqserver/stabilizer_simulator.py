@@ -0,0 +1,385 @@
+import numpy as np
+from typing import List
+
+from .simulator import *
+from .gates import Unitary, Block
+from .numpy_simulator import NumpySimulator
+from .snapshots import SNAPSHOTS
+
+
+def is_clifford(command: Command) -> bool:
+    """Whether the command can run on a stabilizer tableau"""
+    match command:
+        case X() | Y() | Z():
+            return len(command.controls) <= 1
+        case H() | S() | SInv() | CNOT() | CZ() | CY():
+            return not command.controls
+        case T() | TInv() | Rot() | CRot() | Toffoli() | Diag() | Unitary() | Block():
+            return False
+        case _:
+            return True
+
+
+def _rowsum_phases(x1, z1, r1, x2, z2, r2):
+    # phases of the products (row 1) * (rows 2), following Aaronson & Gottesman
+    x1, z1 = x1.astype(np.int8), z1.astype(np.int8)
+    x2, z2 = x2.astype(np.int8), z2.astype(np.int8)
+    g = x1 * z1 * (z2 - x2) + x1 * (1 - z1) * z2 * (2 * x2 - 1) \
+        + (1 - x1) * z1 * x2 * (1 - 2 * z2)
+    total = 2 * r1.astype(np.int64) + 2 * r2 + g.sum(axis=-1, dtype=np.int64)
+    return total % 4 == 2
+
+
+class StabilizerSimulator(Simulator):
+    """Stabilizer tableau simulator for Clifford circuits
+
+    Keeps `num_qubits` destabilizer rows (`dx`, `dz`) and stabilizer rows
+    (`sx`, `sz`, phases `sr`) over one column per qubit, in preallocated
+    arrays. Memory is quadratic and gates are linear in the number of
+    qubits. Measured qubits are removed by moving the last row and column
+    into their place, `regs[k]` is the register held by column `k`.
+    """
+    def __init__(self, **kwargs):
+        super(StabilizerSimulator, self).__init__(**kwargs)
+        # fused gates are generally not Clifford
+        self.optimizer = None
+
+    def reset(self):
+        super().reset()
+        self.regs = []
+        self._resize(8)
+
+    def _resize(self, capacity: int):
+        n = self.num_qubits
+        arrays = []
+        for shape in [(capacity, capacity)] * 4 + [(capacity,)]:
+            arrays.append(np.zeros(shape, dtype=np.bool_))
+        if hasattr(self, 'sx'):
+            for new, old in zip(arrays, [self.dx, self.dz, self.sx, self.sz, self.sr]):
+                new[(np.s_[:n],) * old.ndim] = old[(np.s_[:n],) * old.ndim]
+        self.dx, self.dz, self.sx, self.sz, self.sr = arrays
+
+    def _state_nbytes(self, num_qubits: int) -> int:
+        # four bit matrices and the phases
+        return 4 * num_qubits * num_qubits + num_qubits
+
+    def dump(self) -> str:
+        # one stabilizer generator per line, registers in increasing order from the left
+        regs = sorted(self.qubit_map)
+        columns = [self.qubit_map[reg] for reg in regs]
+        lines = ['# %d qubits: %s' % (len(regs), ' '.join(map(str, regs)))]
+        for i in range(self.num_qubits):
+            paulis = ''.join('IXZY'[self.sx[i, a] + 2 * self.sz[i, a]] for a in columns)
+            lines.append('# %s%s' % ('-' if self.sr[i] else '+', paulis))
+        return ''.join(line + '\n' for line in lines)
+
+    def _allocate_qubit(self, reg: int, bvalue: bool = False):
+        n = self.num_qubits
+        if n == len(self.sr):
+            self._resize(2 * n)
+
+        # new qubit in |0> has destabilizer X and stabilizer Z
+        for a in (self.dx, self.dz, self.sx, self.sz):
+            a[n, :n + 1] = False
+            a[:n, n] = False
+        self.dx[n, n] = True
+        self.sz[n, n] = True
+        self.sr[n] = bvalue
+
+        self.regs.append(reg)
+        self.qubit_map[reg] = n
+        self.num_qubits += 1
+
+    # gates on tableau columns
+
+    def _h(self, a: int):
+        n = self.num_qubits
+        self.sr[:n] ^= self.sx[:n, a] & self.sz[:n, a]
+        for x, z in ((self.dx, self.dz), (self.sx, self.sz)):
+            x[:n, a], z[:n, a] = z[:n, a].copy(), x[:n, a].copy()
+
+    def _s(self, a: int):
+        n = self.num_qubits
+        self.sr[:n] ^= self.sx[:n, a] & self.sz[:n, a]
+        self.dz[:n, a] ^= self.dx[:n, a]
+        self.sz[:n, a] ^= self.sx[:n, a]
+
+    def _sdg(self, a: int):
+        n = self.num_qubits
+        self.sr[:n] ^= self.sx[:n, a] & ~self.sz[:n, a]
+        self.dz[:n, a] ^= self.dx[:n, a]
+        self.sz[:n, a] ^= self.sx[:n, a]
+
+    def _pauli(self, a: int, x: bool, z: bool):
+        # X flips the phase of rows with Z on `a`, and Z of rows with X
+        n = self.num_qubits
+        if x:
+            self.sr[:n] ^= self.sz[:n, a]
+        if z:
+            self.sr[:n] ^= self.sx[:n, a]
+
+    def _cnot(self, a: int, b: int):
+        n = self.num_qubits
+        self.sr[:n] ^= self.sx[:n, a] & self.sz[:n, b] & ~(self.sx[:n, b] ^ self.sz[:n, a])
+        for x, z in ((self.dx, self.dz), (self.sx, self.sz)):
+            x[:n, b] ^= x[:n, a]
+            z[:n, a] ^= z[:n, b]
+
+    def _cz(self, a: int, b: int):
+        self._h(b)
+        self._cnot(a, b)
+        self._h(b)
+
+    def _cy(self, a: int, b: int):
+        self._sdg(b)
+        self._cnot(a, b)
+        self._s(b)
+
+    def _execute_commands(self, commands: List[Command]):
+        qubit_map = self.qubit_map
+        for command in commands:
+            if not is_clifford(command):
+                raise UsageError('%s is not a Clifford gate' % type(command).__name__)
+
+            match command:
+                case Q():
+                    self._allocate_qubit(command.reg, command.bvalue)
+                case X() | Y() | Z() if command.controls:
+                    a, b = qubit_map[command.controls[0]], qubit_map[command.reg]
+                    {X: self._cnot, Y: self._cy, Z: self._cz}[type(command)](a, b)
+                case X():
+                    self._pauli(qubit_map[command.reg], True, False)
+                case Y():
+                    self._pauli(qubit_map[command.reg], True, True)
+                case Z():
+                    self._pauli(qubit_map[command.reg], False, True)
+                case H():
+                    self._h(qubit_map[command.reg])
+                case S():
+                    self._s(qubit_map[command.reg])
+                case SInv():
+                    self._sdg(qubit_map[command.reg])
+                case CNOT():
+                    self._cnot(qubit_map[command.x], qubit_map[command.y])
+                case CZ():
+                    self._cz(qubit_map[command.x], qubit_map[command.y])
+                case CY():
+                    self._cy(qubit_map[command.x], qubit_map[command.y])
+
+    # measurement
+
+    def _deterministic_outcome(self, a: int) -> int:
+        # Z_a is a product of the stabilizers whose destabilizers anticommute with it
+        n = self.num_qubits
+        x = np.zeros(n, dtype=np.bool_)
+        z = np.zeros(n, dtype=np.bool_)
+        r = np.zeros((), dtype=np.bool_)
+        for i in np.flatnonzero(self.dx[:n, a]):
+            r = _rowsum_phases(self.sx[i, :n], self.sz[i, :n], self.sr[i], x, z, r)
+            x ^= self.sx[i, :n]
+            z ^= self.sz[i, :n]
+        return int(r)
+
+    def _marginal(self, regs: List[int]) -> np.ndarray:
+        if len(regs) != 1:
+            raise UsageError('Joint distributions are not supported by %s' % type(self).__name__)
+        a = self.qubit_map[regs[0]]
+        if self.sx[:self.num_qubits, a].any():
+            return np.array([0.5, 0.5])
+        bit = self._deterministic_outcome(a)
+        return np.array([1.0 - bit, float(bit)])
+
+    def _collapse(self, reg: int, bit: int, probability: float = None):
+        n = self.num_qubits
+        a = self.qubit_map[reg]
+        ps = np.flatnonzero(self.sx[:n, a])
+        if ps.size:
+            # random outcome: every other row anticommuting with Z_a absorbs stabilizer p
+            p = ps[0]
+            hs = ps[1:]
+            self.sr[hs] = _rowsum_phases(self.sx[p, :n], self.sz[p, :n], self.sr[p],
+                                         self.sx[hs, :n], self.sz[hs, :n], self.sr[hs])
+            self.sx[hs, :n] ^= self.sx[p, :n]
+            self.sz[hs, :n] ^= self.sz[p, :n]
+            ds = np.flatnonzero(self.dx[:n, a])
+            ds = ds[ds != p]
+            self.dx[ds, :n] ^= self.sx[p, :n]
+            self.dz[ds, :n] ^= self.sz[p, :n]
+
+            # stabilizer p becomes +/- Z_a and its destabilizer the old stabilizer
+            self.dx[p, :n], self.dz[p, :n] = self.sx[p, :n], self.sz[p, :n]
+            self.sx[p, :n] = False
+            self.sz[p, :n] = False
+            self.sz[p, a] = True
+            self.sr[p] = bit
+        elif self._deterministic_outcome(a) != bit:
+            raise UsageError('Measurement outcome %d is impossible' % bit)
+
+        self._remove_column(a)
+
+    def _remove_column(self, a: int):
+        # picking one stabilizer with Z on `a` and clearing `a` from the others
+        n = self.num_qubits
+        qs = np.flatnonzero(self.sz[:n, a])
+        q, hs = qs[0], qs[1:]
+        self.sr[hs] = _rowsum_phases(self.sx[q, :n], self.sz[q, :n], self.sr[q],
+                                     self.sx[hs, :n], self.sz[hs, :n], self.sr[hs])
+        self.sx[hs, :n] ^= self.sx[q, :n]
+        self.sz[hs, :n] ^= self.sz[q, :n]
+
+        # that stabilizer is now redundant, so the last row and column fill the gap
+        last = n - 1
+        for arr in (self.dx, self.dz, self.sx, self.sz):
+            arr[q, :n] = arr[last, :n]
+            arr[:n, a] = arr[:n, last]
+        self.sr[q] = self.sr[last]
+
+        reg = self.regs[a]
+        self.regs[a] = self.regs[last]
+        self.qubit_map[self.regs[a]] = a
+        self.regs.pop()
+        del self.qubit_map[reg]
+        self.num_qubits -= 1
+
+    def _measure(self, reg: int):
+        p1 = self._marginal([reg])[1]
+        bit_result = int(self.rng.random() < p1)
+        self._collapse(reg, bit_result)
+        self.bit_register[reg] = bit_result
+
+    def _save_state(self):
+        arrays = tuple(a.copy() for a in (self.dx, self.dz, self.sx, self.sz, self.sr))
+        return arrays, list(self.regs), dict(self.qubit_map), dict(self.bit_register)
+
+    def _share_state(self, saved):
+        # tableaus are small, so they are simply copied
+        arrays, regs, qubit_map, bit_register = saved
+        arrays = tuple(a.copy() for a in arrays)
+        return arrays, list(regs), dict(qubit_map), dict(bit_register)
+
+    def _load_state(self, saved):
+        arrays, self.regs, self.qubit_map, self.bit_register = saved
+        self.dx, self.dz, self.sx, self.sz, self.sr = arrays
+        self.num_qubits = len(self.regs)
+        self.queue = []
+        self.queued_qubits = 0
+        self.pending_measurements = 0
+
+    def state_vector(self) -> np.ndarray:
+        """Amplitudes of the stabilizer state, column `k` being bit `k` of the index"""
+        n = self.num_qubits
+        indices = np.arange(1 << n)
+
+        # a basis state with nonzero amplitude, from measuring every qubit of a copy
+        saved = self._save_state()
+        basis = 0
+        for a in reversed(range(n)):
+            bit = 0 if self.sx[:self.num_qubits, a].any() else self._deterministic_outcome(a)
+            basis |= bit << a
+            self._collapse(self.regs[a], bit)
+        self._load_state(saved)
+
+        # projecting it onto the stabilizer state, one generator at a time
+        vector = np.zeros(1 << n, dtype=self.dtype)
+        vector[basis] = 1
+        for i in range(n):
+            xmask = sum(1 << k for k in np.flatnonzero(self.sx[i, :n]))
+            zs = np.flatnonzero(self.sz[i, :n])
+            parity = np.zeros(1 << n, dtype=np.bool_)
+            for k in zs:
+                parity ^= ((indices >> k) & 1).astype(np.bool_)
+            # stabilizer = (-1)^r i^(#Y) X^x Z^z, with Y = iXZ
+            num_y = int((self.sx[i, :n] & self.sz[i, :n]).sum())
+            phase = (-1) ** int(self.sr[i]) * 1j ** num_y
+            applied = phase * np.where(parity, -vector, vector)[indices ^ xmask]
+            vector = (vector + applied) / 2
+        return vector / np.linalg.norm(vector)
+
+
+class AutoSimulator(Simulator):
+    """Runs a session on a stabilizer tableau while it stays Clifford
+
+    The first non-Clifford gate converts the tableau into the state vector
+    of a `NumpySimulator`, which runs the rest of the session.
+    """
+    def __init__(self, **kwargs):
+        self.options = kwargs
+        super(AutoSimulator, self).__init__(**kwargs)
+        # the backends optimize their own queues
+        self.optimizer = None
+
+    def reset(self):
+        super().reset()
+        if hasattr(self, 'backend'):
+            self.backend.close()
+        self.backend = self._create(StabilizerSimulator)
+
+    def dump(self):
+        return self.backend.dump()
+
+    def _create(self, backend_class: type) -> Simulator:
+        backend = backend_class(**self.options)
+        # every backend of the session records into the same metrics
+        backend.metrics = self.metrics
+        return backend
+
+    def close(self):
+        self.backend.close()
+        super().close()
+
+    def collect_metrics(self):
+        return self.backend.collect_metrics()
+
+    def _execute_commands(self, commands: List[Command]):
+        self.backend._execute_commands(commands)
+
+    def _measure(self, reg: int):
+        self.backend._measure(reg)
+
+    def _switch(self):
+        stabilizer = self.backend
+        stabilizer._execute_queue()
+        backend = self._create(NumpySimulator)
+        backend._check_memory(stabilizer.num_qubits)
+        for reg in stabilizer.regs:
+            backend._allocate_qubit(reg)
+        backend.store.assign(stabilizer.state_vector())
+        backend.bit_register = stabilizer.bit_register
+        stabilizer.close()
+        self.backend = backend
+
+    def execute(self, command: Command):
+        match command:
+            case Reset():
+                self.reset()
+                return OK()
+            case Threads():
+                # later backends of the session start with the same threads
+                result = self.backend.execute(command)
+                self.options['threads'] = command.count
+                return result
+            case Precision():
+                result = self.backend.execute(command)
+                self.options['precision'] = command.precision
+                return result
+            case Restore():
+                # snapshots load into a fresh backend of the kind that took them
+                backend = self.backend
+                state = SNAPSHOTS.get(command.name)
+                if state is not None and state.backend is not type(backend) \
+                        and state.backend in (StabilizerSimulator, NumpySimulator):
+                    backend = self._create(state.backend)
+                result = backend.execute(command)
+                if backend is not self.backend:
+                    self.backend.close()
+                    self.backend = backend
+                return result
+        if isinstance(self.backend, StabilizerSimulator) and not is_clifford(command):
+            self._switch()
+        return self.backend.execute(command)
+
+    def run_shots(self, commands: List[Command], shots: int) -> List[Result]:
+        if isinstance(self.backend, StabilizerSimulator) \
+                and not all(is_clifford(command) for command in commands):
+            self._switch()
+        return self.backend.run_shots(commands, shots)
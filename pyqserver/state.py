@@ -0,0 +1,294 @@
+import tempfile
+import numpy as np
+from typing import List, Optional
+
+
+# smallest buffer worth keeping in a scratch file
+MEMMAP_MIN_BYTES = 1 << 20
+
+
+class StateStore:
+    """State vector kept in a preallocated buffer that grows and shrinks in place
+
+    Physical qubit `k` is bit `k` of the amplitude index, so a new qubit is
+    always the highest bit and the active state is a prefix of the buffer.
+    Removing a qubit moves the highest qubit into its place instead of
+    renumbering every qubit above it, `regs[k]` is the register held by
+    physical qubit `k`. With a `scratch_dir`, large buffers are memory-mapped
+    files there, so a state is not limited by RAM.
+    """
+    def __init__(self, dtype=np.complex64, scratch_dir: Optional[str] = None):
+        self.dtype = np.dtype(dtype)
+        self.scratch_dir = scratch_dir
+        self.buffer = np.ones(1, dtype=self.dtype)
+        self.num_qubits = 0
+        self.regs: List[int] = []
+        # whether the buffer may be shared with another store, so must be copied before writing
+        self.shared = False
+
+    @property
+    def vector(self) -> np.ndarray:
+        return self.buffer[:1 << self.num_qubits]
+
+    @property
+    def nbytes(self) -> int:
+        return (1 << self.num_qubits) * self.dtype.itemsize
+
+    def _empty(self, size: int) -> np.ndarray:
+        if self.scratch_dir is None or size * self.dtype.itemsize < MEMMAP_MIN_BYTES:
+            return np.empty(size, dtype=self.dtype)
+        # the file is unlinked right away, its space is freed with the last mapping
+        with tempfile.TemporaryFile(dir=self.scratch_dir) as f:
+            return np.memmap(f, dtype=self.dtype, mode='w+', shape=(size,))
+
+    def _reserve(self, num_qubits: int):
+        # the buffer only grows, so later allocations up to the peak size are free
+        if self.shared or len(self.buffer) < 1 << num_qubits:
+            buffer = self._empty(1 << num_qubits)
+            buffer[:1 << self.num_qubits] = self.vector
+            self.buffer = buffer
+            self.shared = False
+
+    def writable(self) -> np.ndarray:
+        """The active state, copied first if its buffer is shared"""
+        self._reserve(self.num_qubits)
+        return self.vector
+
+    def allocate(self, reg: int, bvalue: bool = False) -> int:
+        """Adds a qubit in state |bvalue> holding `reg` and returns its physical index"""
+        size = 1 << self.num_qubits
+        self._reserve(self.num_qubits + 1)
+        if bvalue:
+            self.buffer[size:2 * size] = self.buffer[:size]
+            self.buffer[:size] = 0
+        else:
+            self.buffer[size:2 * size] = 0
+        self.regs.append(reg)
+        self.num_qubits += 1
+        return self.num_qubits - 1
+
+    def share(self) -> 'StateStore':
+        """Copy of the store that shares its buffer until either of them writes to it"""
+        store = StateStore(self.dtype, self.scratch_dir)
+        store.buffer = self.buffer
+        store.num_qubits = self.num_qubits
+        store.regs = list(self.regs)
+        store.shared = self.shared = True
+        return store
+
+    def astype(self, dtype) -> 'StateStore':
+        """Copy of the store with amplitudes of type `dtype`"""
+        # (the product with a one amplitude state is a copy)
+        store = StateStore(dtype, self.scratch_dir)
+        store.extend(self)
+        return store
+
+    def extend(self, other: 'StateStore'):
+        """Takes on the qubits of `other` as its highest qubits (the tensor product of both states)"""
+        size = 1 << self.num_qubits
+        self._reserve(self.num_qubits + other.num_qubits)
+        # row j holds the amplitudes where `other` is in basis state j
+        rows = self.buffer[:size << other.num_qubits].reshape(-1, size)
+        np.multiply(other.vector[1:, None], rows[0], out=rows[1:])
+        rows[0] *= other.vector[0]
+        self.regs += other.regs
+        self.num_qubits += other.num_qubits
+
+    def assign(self, vector: np.ndarray):
+        """Overwrites the active state with `vector` (of the current size)"""
+        np.copyto(self.writable(), vector, casting='same_kind')
+
+    def remove(self, qubit: int, bit: int) -> Optional[int]:
+        """Projects `qubit` onto `bit` and drops it without renormalizing
+
+        Returns the register that moved into physical index `qubit`, if any.
+        """
+        top = self.num_qubits - 1
+        vector = self.writable()
+        moved = None
+        if qubit == top:
+            if bit:
+                half = 1 << top
+                vector[:half] = vector[half:]
+        else:
+            # axes are (top qubit, qubits between, removed qubit, qubits below)
+            v = vector.reshape(2, -1, 2, 1 << qubit)
+            if bit:
+                v[0, :, 0, :] = v[0, :, 1, :]
+                v[0, :, 1, :] = v[1, :, 1, :]
+            else:
+                v[0, :, 1, :] = v[1, :, 0, :]
+            moved = self.regs[top]
+            self.regs[qubit] = moved
+        self.regs.pop()
+        self.num_qubits -= 1
+        return moved
+
+    def normalize(self, probability: float):
+        # (a python float keeps the state dtype)
+        if probability != 1:
+            vector = self.writable()
+            vector *= float(1 / np.sqrt(probability))
+
+
+class SparseStore:
+    """Nonzero amplitudes of a state, as unique basis state `indices` and their `amplitudes`
+
+    Qubits are numbered, added and removed exactly as in `StateStore`, with
+    basis states held in 64 bit integers. Amplitudes that drop below
+    `tolerance` are discarded after each gate.
+    """
+    max_qubits = 64
+
+    def __init__(self, dtype=np.complex64):
+        self.dtype = np.dtype(dtype)
+        self.indices = np.zeros(1, dtype=np.uint64)
+        self.amplitudes = np.ones(1, dtype=self.dtype)
+        self.num_qubits = 0
+        self.regs: List[int] = []
+        self.tolerance = 4 * np.finfo(self.dtype).eps
+        self.shared = False
+
+    @property
+    def nbytes(self) -> int:
+        return self.indices.nbytes + self.amplitudes.nbytes
+
+    @property
+    def density(self) -> float:
+        return len(self.indices) / 2**self.num_qubits
+
+    def allocate(self, reg: int, bvalue: bool = False) -> int:
+        """Adds a qubit in state |bvalue> holding `reg` and returns its physical index"""
+        if bvalue:
+            self._own()
+            self.indices |= np.uint64(1) << np.uint64(self.num_qubits)
+        self.regs.append(reg)
+        self.num_qubits += 1
+        return self.num_qubits - 1
+
+    def share(self) -> 'SparseStore':
+        """Copy of the store that shares its arrays until either of them writes to them"""
+        store = SparseStore(self.dtype)
+        store.indices = self.indices
+        store.amplitudes = self.amplitudes
+        store.num_qubits = self.num_qubits
+        store.regs = list(self.regs)
+        store.shared = self.shared = True
+        return store
+
+    def astype(self, dtype) -> 'SparseStore':
+        """Copy of the store with amplitudes of type `dtype`"""
+        store = SparseStore(dtype)
+        store.indices = self.indices.copy()
+        store.amplitudes = self.amplitudes.astype(store.dtype)
+        store.num_qubits = self.num_qubits
+        store.regs = list(self.regs)
+        return store
+
+    def _own(self):
+        # copying shared arrays before writing to them in place
+        if self.shared:
+            self.indices = self.indices.copy()
+            self.amplitudes = self.amplitudes.copy()
+            self.shared = False
+
+    def _bits(self, qubit: int) -> np.ndarray:
+        return (self.indices >> np.uint64(qubit)) & np.uint64(1)
+
+    def grown_nbytes(self, target: int, controls: List[int], matrix: np.ndarray) -> int:
+        """Most bytes the store can take once `apply_gate` applied the gate"""
+        (u00, u01), (u10, u11) = matrix.tolist()
+        if (u01 == 0 and u10 == 0) or (u00 == 0 and u11 == 0):
+            # (anti-)diagonal gates keep the number of amplitudes
+            return self.nbytes
+        # every active amplitude can gain a partner differing in the target
+        cmask = np.uint64(sum(1 << c for c in controls))
+        active = int(np.count_nonzero((self.indices & cmask) == cmask))
+        return self.nbytes + active * (self.indices.itemsize + self.amplitudes.itemsize)
+
+    def apply_gate(self, target: int, controls: List[int], matrix: np.ndarray):
+        """Applies a controlled single qubit unitary"""
+        tbit = np.uint64(1) << np.uint64(target)
+        cmask = np.uint64(sum(1 << c for c in controls))
+        active = (self.indices & cmask) == cmask
+        if not active.any():
+            return
+        bits = (self.indices[active] & tbit) != 0
+
+        # python scalars keep the amplitude dtype (no upcast to complex128)
+        (u00, u01), (u10, u11) = matrix.tolist()
+        if u01 == 0 and u10 == 0:
+            # diagonal gates only scale amplitudes
+            self._own()
+            self.amplitudes[active] *= np.where(bits, u11, u00)
+        elif u00 == 0 and u11 == 0:
+            # anti-diagonal gates move every amplitude to the flipped basis state
+            self._own()
+            self.indices[active] ^= tbit
+            self.amplitudes[active] *= np.where(bits, u01, u10)
+        else:
+            # pairing up the amplitudes of basis states that only differ in the target
+            keys, inverse = np.unique(self.indices[active] & ~tbit, return_inverse=True)
+            amplitudes = self.amplitudes[active]
+            a0 = np.zeros(len(keys), dtype=self.dtype)
+            a1 = np.zeros(len(keys), dtype=self.dtype)
+            a0[inverse[~bits]] = amplitudes[~bits]
+            a1[inverse[bits]] = amplitudes[bits]
+            indices = np.concatenate([keys, keys | tbit])
+            amplitudes = np.concatenate([u00 * a0 + u01 * a1, u10 * a0 + u11 * a1])
+            keep = np.abs(amplitudes) > self.tolerance
+            self.indices = np.concatenate([self.indices[~active], indices[keep]])
+            self.amplitudes = np.concatenate([self.amplitudes[~active], amplitudes[keep]])
+            self.shared = False
+
+    def probability_one(self, qubit: int) -> float:
+        probabilities = np.abs(self.amplitudes) ** 2
+        return float(probabilities[self._bits(qubit) == 1].sum())
+
+    def marginal(self, qubits: List[int]) -> np.ndarray:
+        """Joint outcome distribution of `qubits` (`qubits[0]` is the most significant bit)"""
+        k = len(qubits)
+        outcomes = np.zeros(len(self.indices), dtype=np.intp)
+        for i, qubit in enumerate(qubits):
+            outcomes |= self._bits(qubit).astype(np.intp) << (k - 1 - i)
+        return np.bincount(outcomes, weights=np.abs(self.amplitudes) ** 2, minlength=2**k)
+
+    def remove(self, qubit: int, bit: int) -> Optional[int]:
+        """Projects `qubit` onto `bit` and drops it without renormalizing
+
+        Returns the register that moved into physical index `qubit`, if any.
+        """
+        keep = self._bits(qubit) == bit
+        indices = self.indices[keep] & ~(np.uint64(1) << np.uint64(qubit))
+        self.amplitudes = self.amplitudes[keep]
+
+        top = self.num_qubits - 1
+        moved = None
+        if qubit != top:
+            # the top qubit's bit moves down into the removed qubit's place
+            topbit = np.uint64(1) << np.uint64(top)
+            moved_bits = (indices & topbit) >> np.uint64(top - qubit)
+            indices = (indices & ~topbit) | moved_bits
+            moved = self.regs[top]
+            self.regs[qubit] = moved
+        self.indices = indices
+        self.shared = False
+        self.regs.pop()
+        self.num_qubits -= 1
+        return moved
+
+    def normalize(self, probability: float):
+        # (a python float keeps the state dtype)
+        if probability != 1:
+            self._own()
+            self.amplitudes *= float(1 / np.sqrt(probability))
+
+    def to_dense(self, scratch_dir: Optional[str] = None) -> StateStore:
+        store = StateStore(self.dtype, scratch_dir)
+        store._reserve(self.num_qubits)
+        store.num_qubits = self.num_qubits
+        store.regs = list(self.regs)
+        vector = store.vector
+        vector[:] = 0
+        vector[self.indices.astype(np.intp)] = self.amplitudes
+        return store
@@ -0,0 +1,152 @@
+import os
+import itertools
+import multiprocessing
+from threading import Lock
+from typing import Callable, Dict, List
+
+from .parser import *
+from .simulator import *
+from .snapshots import SNAPSHOTS
+
+
+def _worker_main(conn, simulator_factory: Callable[[], Simulator], snapshot_memory: int = None):
+    # the worker's sessions share a snapshot cache of their own
+    if snapshot_memory is not None:
+        SNAPSHOTS.max_bytes = snapshot_memory
+
+    # simulators of every session pinned to this worker
+    simulators = {}
+    while True:
+        try:
+            session_id, method, args = conn.recv()
+        except EOFError:
+            break
+
+        try:
+            if method == 'open':
+                simulators[session_id] = simulator_factory()
+                reply = (True, None)
+            elif method == 'close':
+                simulators.pop(session_id).close()
+                reply = (True, None)
+            elif method == 'get_snapshot':
+                reply = (True, SNAPSHOTS.get(*args))
+            elif method == 'put_snapshot':
+                reply = (True, SNAPSHOTS.put(*args))
+            else:
+                reply = (True, getattr(simulators[session_id], method)(*args))
+        except Exception as e:
+            reply = (False, e)
+
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # the result or exception could not be pickled
+            conn.send((False, Exception(str(e))))
+
+
+class Worker:
+    """Simulator process that hosts the simulators of many sessions"""
+    def __init__(self, ctx, simulator_factory: Callable[[], Simulator], snapshot_memory: int = None):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main,
+                                   args=(child_conn, simulator_factory, snapshot_memory),
+                                   daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.lock = Lock()
+        self.num_sessions = 0
+
+    def call(self, session_id: int, method: str, *args):
+        # one request in flight per worker, sessions on it take turns
+        with self.lock:
+            self.conn.send((session_id, method, args))
+            ok, value = self.conn.recv()
+        if not ok:
+            raise value
+        return value
+
+    def stop(self):
+        self.conn.close()
+        self.process.join()
+
+
+class RemoteSimulator:
+    """Stands in for a `Simulator` that lives in a worker process
+
+    Only parsed commands and their results cross the process boundary.
+    """
+    def __init__(self, pool: 'WorkerPool', worker: Worker, session_id: int):
+        self.pool = pool
+        self.worker = worker
+        self.session_id = session_id
+
+    def execute(self, command: Command) -> Result:
+        match command:
+            case Snapshot():
+                result = self.worker.call(self.session_id, 'execute', command)
+                self.pool.snapshot_taken(command.name, self.worker)
+                return result
+            case Restore():
+                self.pool.fetch_snapshot(command.name, self.worker)
+        return self.worker.call(self.session_id, 'execute', command)
+
+    def run_shots(self, commands: List[Command], shots: int) -> List[Result]:
+        return self.worker.call(self.session_id, 'run_shots', commands, shots)
+
+    def collect_metrics(self):
+        return self.worker.call(self.session_id, 'collect_metrics')
+
+    def close(self):
+        self.worker.call(self.session_id, 'close')
+        self.pool.release(self.worker)
+
+
+class WorkerPool:
+    """Pins each session's simulator to one of `num_workers` worker processes
+
+    Every worker has a snapshot cache of its own. A snapshot is restored from
+    the worker that took it last, copying it into the restoring worker's cache.
+    """
+    def __init__(self, simulator_factory: Callable[[], Simulator], num_workers: int = None,
+                 snapshot_memory: int = None):
+        ctx = multiprocessing.get_context('spawn')
+        num_workers = num_workers or os.cpu_count() or 1
+        self.workers: List[Worker] = [Worker(ctx, simulator_factory, snapshot_memory)
+                                      for _ in range(num_workers)]
+        self.session_ids = itertools.count()
+        # snapshot name -> worker that took it last
+        self.snapshot_owners: Dict[str, Worker] = {}
+        self.lock = Lock()
+
+    def open_session(self) -> RemoteSimulator:
+        # placing the session on the least loaded worker
+        with self.lock:
+            worker = min(self.workers, key=lambda w: w.num_sessions)
+            worker.num_sessions += 1
+            session_id = next(self.session_ids)
+        worker.call(session_id, 'open')
+        return RemoteSimulator(self, worker, session_id)
+
+    def snapshot_taken(self, name: str, worker: Worker):
+        with self.lock:
+            self.snapshot_owners[name] = worker
+
+    def fetch_snapshot(self, name: str, worker: Worker):
+        """Copies snapshot `name` into the cache of `worker`, if another worker took it"""
+        with self.lock:
+            owner = self.snapshot_owners.get(name)
+        if owner is None or owner is worker:
+            return
+        # (a snapshot the owner has evicted is left for the restore to report missing)
+        state = owner.call(None, 'get_snapshot', name)
+        if state is not None:
+            worker.call(None, 'put_snapshot', name, state)
+
+    def release(self, worker: Worker):
+        with self.lock:
+            worker.num_sessions -= 1
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
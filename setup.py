@@ -7,7 +7,8 @@ setup(
     packages=['pyqserver'],
     entry_points={
         'console_scripts': [
-            'pyqserver = pyqserver.main:main'
+            'pyqserver = pyqserver.main:main',
+            'pyqserver-bench = pyqserver.bench:main',
         ]
     },
     install_requires=[
@@ -0,0 +1,254 @@
+import random
+import numpy as np
+import pytest
+
+from pyqserver import kernels, state
+from pyqserver.parser import *
+from pyqserver.gates import lower_command
+from pyqserver.simulator import Reply, UsageError
+from pyqserver.bench import state_fidelity
+from pyqserver.backends import create_simulator
+from pyqserver.mps_simulator import MPSSimulator
+from pyqserver.factored_simulator import FactoredSimulator
+from pyqserver.stabilizer_simulator import StabilizerSimulator, AutoSimulator
+
+
+NUM_QUBITS = 5
+CLIFFORD_GATES = ['X', 'Y', 'Z', 'H', 'S', 'S*', 'CNOT', 'CZ', 'CY']
+GATES = CLIFFORD_GATES + ['T', 'T*', 'ROT', 'DIAG', 'CROT', 'TOF']
+
+
+def random_circuit(seed: int, gates: list, num_gates: int = 60) -> list:
+    rng = random.Random(seed)
+    commands = [Q(reg, bool(rng.getrandbits(1))) for reg in range(NUM_QUBITS)]
+    for _ in range(num_gates):
+        x, y, z = rng.sample(range(NUM_QUBITS), 3)
+        match rng.choice(gates):
+            case 'X': commands.append(X(x, []))
+            case 'Y': commands.append(Y(x, []))
+            case 'Z': commands.append(Z(x, []))
+            case 'H': commands.append(H(x, []))
+            case 'S': commands.append(S(x, []))
+            case 'S*': commands.append(SInv(x, []))
+            case 'T': commands.append(T(x, [y] if rng.random() < 0.2 else []))
+            case 'T*': commands.append(TInv(x, []))
+            case 'ROT': commands.append(Rot(rng.uniform(-np.pi, np.pi), x, []))
+            case 'DIAG': commands.append(Diag(rng.uniform(-1, 1), rng.uniform(-1, 1), x, []))
+            case 'CROT': commands.append(CRot(rng.uniform(-np.pi, np.pi), x, y, []))
+            case 'CNOT': commands.append(CNOT(x, y, []))
+            case 'CZ': commands.append(CZ(x, y, []))
+            case 'CY': commands.append(CY(x, y, []))
+            case 'TOF': commands.append(Toffoli(x, y, z, []))
+    return commands
+
+
+def reference_state(commands: list) -> np.ndarray:
+    """Dense state of the commands, register `k` being bit `k` of the index"""
+    num_qubits = sum(1 for command in commands if isinstance(command, Q))
+    state = np.zeros(1 << num_qubits, dtype=np.complex128)
+    state[0] = 1
+    indices = np.arange(1 << num_qubits)
+    for command in commands:
+        if isinstance(command, Q):
+            if command.bvalue:
+                state = state[indices ^ (1 << command.reg)]
+            continue
+        gate = lower_command(command)
+        tbit = 1 << gate.target
+        cmask = sum(1 << c for c in gate.controls)
+        i0 = indices[(indices & cmask == cmask) & (indices & tbit == 0)]
+        i1 = i0 | tbit
+        (u00, u01), (u10, u11) = gate.matrix
+        a0, a1 = state[i0], state[i1]
+        state[i0] = u00 * a0 + u01 * a1
+        state[i1] = u10 * a0 + u11 * a1
+    return state
+
+
+def amplitudes(simulator) -> np.ndarray:
+    """State of a simulator, its `k`-th lowest register being bit `k` of the index"""
+    match simulator:
+        case AutoSimulator():
+            return amplitudes(simulator.backend)
+        case MPSSimulator():
+            # site `qubit_map[reg]` is an axis of the contracted chain
+            tensor, axes = simulator.state, simulator.qubit_map
+        case _:
+            match simulator:
+                case StabilizerSimulator():
+                    vector, bits = simulator.state_vector(), simulator.qubit_map
+                case FactoredSimulator():
+                    vector = simulator.state
+                    bits = {reg: k for k, reg in enumerate(sorted(simulator.qubit_map))}
+                case _:
+                    vector, bits = simulator.state, simulator.qubit_map
+            n = len(bits)
+            tensor = vector.reshape((2,) * n)
+            axes = {reg: n - 1 - bit for reg, bit in bits.items()}
+    order = [axes[reg] for reg in sorted(axes, reverse=True)]
+    return np.transpose(tensor, order).reshape(-1)
+
+
+def run(sim_method: str, commands: list, **options) -> np.ndarray:
+    simulator = create_simulator(sim_method, queueing=True, **options)
+    try:
+        for command in commands:
+            simulator.execute(command)
+        # dumping runs whatever is still queued
+        simulator.execute(Dump())
+        return amplitudes(simulator)
+    finally:
+        simulator.close()
+
+
+def assert_same_state(state: np.ndarray, expected: np.ndarray):
+    # fused gates and tableaus may change the global phase
+    assert abs(np.vdot(expected, state)) == pytest.approx(1, abs=1e-4)
+
+
+UNIVERSAL_BACKENDS = [
+    ('numpy', {}),
+    ('sparse', {}),
+    ('factored', {}),
+    ('sharded', {'shards': 2}),
+    ('mps', {}),
+    ('auto', {}),
+]
+
+
+@pytest.mark.parametrize('optimize', [False, True])
+@pytest.mark.parametrize('sim_method, options', UNIVERSAL_BACKENDS)
+def test_universal_backends(sim_method, options, optimize):
+    for seed in range(3):
+        commands = random_circuit(seed, GATES)
+        state = run(sim_method, commands, optimize=optimize, **options)
+        assert_same_state(state, reference_state(commands))
+
+
+@pytest.mark.parametrize('sim_method', ['stabilizer', 'auto'])
+def test_clifford_backends(sim_method):
+    for seed in range(3):
+        commands = random_circuit(seed, CLIFFORD_GATES)
+        assert_same_state(run(sim_method, commands), reference_state(commands))
+
+
+@pytest.mark.parametrize('optimize', [False, True])
+@pytest.mark.parametrize('sim_method', ['cirq', 'qiskit'])
+def test_qasm_backends(sim_method, optimize):
+    pytest.importorskip(sim_method)
+    for seed in range(3):
+        commands = random_circuit(seed, GATES)
+        state = run(sim_method, commands, optimize=optimize)
+        assert_same_state(state, reference_state(commands))
+
+
+
+def test_sparse_memory_limit():
+    # gates on basis states of many qubits double the amplitudes they touch
+    simulator = create_simulator('sparse', memory_limit=1 << 20)
+    for reg in range(40):
+        simulator.execute(Q(reg))
+    with pytest.raises(UsageError, match='over the session limit of 1048576 bytes'):
+        for reg in range(20):
+            simulator.execute(H(reg, []))
+    assert simulator.store.nbytes <= 1 << 20
+    simulator.close()
+
+
+def test_sparse_turns_dense():
+    # below the density switch's size, sparse amplitudes that would not fit make room for dense ones
+    simulator = create_simulator('sparse', memory_limit=256)
+    for reg in range(5):
+        simulator.execute(Q(reg))
+    for reg in range(5):
+        simulator.execute(H(reg, []))
+    assert not simulator.sparse
+    assert np.allclose(simulator.state, 2 ** -2.5)
+    simulator.close()
+
+
+@pytest.mark.parametrize('sim_method, options', UNIVERSAL_BACKENDS)
+def test_measure_and_discard(sim_method, options):
+    # registers 5 and 6 are the lowest qubits, so removing them moves others into their place
+    commands = [Q(5, True), Q(6)] + random_circuit(0, GATES)
+    simulator = create_simulator(sim_method, **options)
+    try:
+        for command in commands:
+            simulator.execute(command)
+        simulator.execute(M(5))
+        simulator.execute(D(6))
+        assert simulator.execute(R(5)) == Reply('1')
+        state = amplitudes(simulator)
+    finally:
+        simulator.close()
+    expected = reference_state(commands)
+    indices = np.arange(1 << NUM_QUBITS)
+    assert_same_state(state, expected[indices | (1 << 5)])
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_chunked_kernels(monkeypatch, tmp_path, threads):
+    # chunks of four amplitudes, and every buffer a scratch file
+    monkeypatch.setattr(kernels, 'CHUNK_QUBITS', 2)
+    monkeypatch.setattr(state, 'MEMMAP_MIN_BYTES', 0)
+    commands = random_circuit(0, GATES)
+    simulator = create_simulator('numpy', optimize=True, queueing=True, threads=threads,
+                                 scratch_dir=str(tmp_path))
+    for command in commands:
+        simulator.execute(command)
+    simulator.execute(Dump())
+    assert isinstance(simulator.store.buffer, np.memmap)
+    assert_same_state(amplitudes(simulator), reference_state(commands))
+    simulator.close()
+
+
+def test_memory_limit():
+    # five qubits of single precision amplitudes take 256 bytes
+    simulator = create_simulator('numpy', memory_limit=256)
+    for reg in range(NUM_QUBITS):
+        simulator.execute(Q(reg))
+    with pytest.raises(UsageError, match='6 qubits need 512 bytes'):
+        simulator.execute(Q(NUM_QUBITS))
+    # the refused allocation leaves the session usable
+    simulator.execute(X(0, []))
+    assert simulator.num_qubits == NUM_QUBITS
+    assert abs(simulator.state[1]) == 1
+    simulator.close()
+
+
+def test_threads():
+    simulator = create_simulator('numpy')
+    simulator.execute(Threads(4))
+    assert simulator.pool is not None
+    simulator.execute(Threads(1))
+    assert simulator.pool is None
+    with pytest.raises(UsageError):
+        simulator.execute(Threads(0))
+    simulator.close()
+
+
+@pytest.mark.parametrize('sim_method, options', UNIVERSAL_BACKENDS)
+def test_precision(sim_method, options):
+    commands = random_circuit(0, GATES)
+    half = len(commands) // 2
+    simulator = create_simulator(sim_method, precision='double', **options)
+    try:
+        for command in commands[:half]:
+            simulator.execute(command)
+        assert amplitudes(simulator).dtype == np.complex128
+        # switching precision mid-session keeps the state
+        simulator.execute(Precision('single'))
+        for command in commands[half:]:
+            simulator.execute(command)
+        assert amplitudes(simulator).dtype == np.complex64
+        state = amplitudes(simulator)
+    finally:
+        simulator.close()
+    assert_same_state(state, reference_state(commands))
+
+
+def test_state_fidelity():
+    lines = ['Q 0', 'Q 1', 'H 0', 'T 0', 'CNOT 1 0', 'M 0', 'R 0']
+    assert state_fidelity('numpy', 'single', lines) == pytest.approx(1, abs=1e-6)
+    # the tableau has no dense state
+    assert state_fidelity('stabilizer', 'single', lines) is None
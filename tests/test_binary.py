@@ -0,0 +1,84 @@
+import pytest
+from dataclasses import fields
+
+from pyqserver.parser import *
+from pyqserver.session import Session
+from pyqserver.backends import create_simulator
+from pyqserver.binary import (HEADER, RECORDS, REPLY, PARSE_ERROR, REPLY_HEADER, FramingError,
+                              decode_records, encode_command)
+
+
+# a value of every field name records carry
+FIELD_VALUES = {'controls': [4, 1, 7], 'bvalue': True, 'name': 'snäpshot', 'scope': 'server',
+                'precision': 'double', 'r': 0.25, 'a': -1.5, 'b': 3.0}
+
+
+def sample_command(cls: type) -> Command:
+    # registers and counts get distinct values, so swapped operands do not round trip
+    values = [FIELD_VALUES.get(field.name, i + 2) for i, field in enumerate(fields(cls))]
+    return cls(*values)
+
+
+def decode_all(data: bytes) -> list:
+    commands, size = decode_records(memoryview(data))
+    assert size == len(data)
+    return commands
+
+
+@pytest.mark.parametrize('cls', [cls for cls, *_ in RECORDS.values()],
+                         ids=lambda cls: cls.__name__)
+def test_round_trip(cls):
+    command = sample_command(cls)
+    assert decode_all(encode_command(command)) == [command]
+
+
+def test_stream():
+    commands = [Q(0), Q(1, True), H(0, []), CNOT(0, 1, [2]), Rot(0.5, 1, []), M(0), R(0)]
+    assert decode_all(b''.join(map(encode_command, commands))) == commands
+
+
+def test_partial_record():
+    # an incomplete record is left in the buffer until the rest arrives
+    data = encode_command(Q(0)) + encode_command(CNOT(0, 1, [2, 3]))
+    commands, size = decode_records(memoryview(data[:-1]))
+    assert commands == [Q(0)]
+    assert size == len(encode_command(Q(0)))
+
+
+def test_protocol_ends_decoding():
+    data = encode_command(Protocol(1)) + b'Q 0\n'
+    commands, size = decode_records(memoryview(data))
+    assert commands == [Protocol(1)]
+    assert size == len(encode_command(Protocol(1)))
+
+
+def test_bad_flag():
+    (error,) = decode_all(HEADER.pack(1, 2, 0) + b'\x00' * 4)
+    assert type(error) is ParseError
+    assert str(error) == '2 is not a bit, must be 0 or 1'
+
+
+def test_unknown_opcode():
+    data = encode_command(Q(0)) + HEADER.pack(99, 0, 0) + encode_command(M(0))
+    commands, size = decode_records(memoryview(data))
+    assert commands[0] == Q(0)
+    assert isinstance(commands[1], FramingError)
+    assert str(commands[1]) == 'Unknown opcode 99'
+    assert len(commands) == 2
+
+
+def test_command_without_record():
+    with pytest.raises(ParseError):
+        encode_command(Help())
+
+
+def test_session_closes_on_unknown_opcode():
+    session = Session(lambda: create_simulator('numpy'), debug=False)
+    data = (b'Universal\nprotocol 4\n' + encode_command(Q(0, True)) + encode_command(M(0)) +
+            encode_command(R(0)) + HEADER.pack(99, 0, 0) + encode_command(Q(1)))
+    replies = b''.join(session.feed(data))
+    reply = b'1'
+    error = b'Unknown opcode 99'
+    assert replies == (REPLY_HEADER.pack(REPLY, len(reply)) + reply +
+                       REPLY_HEADER.pack(PARSE_ERROR, len(error)) + error)
+    assert session.closed
@@ -0,0 +1,90 @@
+import random
+import numpy as np
+import pytest
+
+from pyqserver.parser import *
+from pyqserver.optimizer import Optimizer
+from pyqserver.backends import create_simulator
+
+
+NUM_QUBITS = 4
+
+
+def random_circuit(seed: int, num_gates: int = 80) -> list:
+    # few registers and many self-inverse gates, so there is plenty to cancel and fuse
+    rng = random.Random(seed)
+    commands = [Q(reg, bool(rng.getrandbits(1))) for reg in range(NUM_QUBITS)]
+    for _ in range(num_gates):
+        x, y, z = rng.sample(range(NUM_QUBITS), 3)
+        controls = [z] if rng.random() < 0.1 else []
+        match rng.choice(['X', 'H', 'S', 'S*', 'T', 'T*', 'ROT', 'CNOT', 'CZ', 'CROT', 'TOF']):
+            case 'X': commands.append(X(x, controls))
+            case 'H': commands.append(H(x, controls))
+            case 'S': commands.append(S(x, []))
+            case 'S*': commands.append(SInv(x, []))
+            case 'T': commands.append(T(x, []))
+            case 'T*': commands.append(TInv(x, controls))
+            case 'ROT': commands.append(Rot(rng.uniform(-np.pi, np.pi), x, []))
+            case 'CNOT': commands.append(CNOT(x, y, controls))
+            case 'CZ': commands.append(CZ(x, y, []))
+            case 'CROT': commands.append(CRot(rng.uniform(-np.pi, np.pi), x, y, []))
+            case 'TOF': commands.append(Toffoli(x, y, z, []))
+    return commands
+
+
+def final_state(commands: list) -> np.ndarray:
+    # numpy applies the optimizer's Unitary and Block commands natively
+    simulator = create_simulator('numpy', precision='double')
+    for command in commands:
+        simulator.execute(command)
+    state = simulator.state.copy()
+    simulator.close()
+    return state
+
+
+@pytest.mark.parametrize('fusion_qubits', [1, 2, 3])
+def test_equivalence(fusion_qubits):
+    for seed in range(5):
+        commands = random_circuit(seed)
+        optimizer = Optimizer(fusion_qubits)
+        optimized = optimizer.optimize(list(commands))
+        assert len(optimized) < len(commands)
+        # fusing multiplies the gates' matrices, so even the global phase is kept
+        assert np.allclose(final_state(optimized), final_state(commands), atol=1e-9)
+
+
+@pytest.mark.parametrize('commands, removed', [
+    ([H(0, []), H(0, [])], 2),
+    ([X(0, [1]), X(0, [1])], 2),
+    ([T(0, []), TInv(0, [])], 2),
+    ([CNOT(0, 1, []), CNOT(0, 1, [])], 2),
+    ([Toffoli(0, 1, 2, []), Toffoli(0, 1, 2, [])], 2),
+    ([H(0, []), X(1, []), H(0, [])], 2),
+])
+def test_cancellation(commands, removed):
+    optimizer = Optimizer()
+    remaining = optimizer.optimize(commands)
+    assert len(remaining) == len(commands) - removed
+    assert optimizer.gates_removed == removed
+
+
+@pytest.mark.parametrize('commands', [
+    # a measurement, or a gate on the same wire, in between
+    [H(0, []), M(0), H(0, [])],
+    [H(0, []), CNOT(0, 1, []), H(0, [])],
+    # different controls
+    [X(0, [1]), X(0, [2])],
+])
+def test_no_cancellation(commands):
+    optimizer = Optimizer()
+    assert optimizer.optimize(list(commands)) == commands
+    assert optimizer.gates_removed == 0
+
+
+def test_counters_in_dump():
+    simulator = create_simulator('numpy', queueing=True, optimize=True)
+    for command in [Q(0), H(0, []), H(0, []), T(0, []), S(0, [])]:
+        simulator.execute(command)
+    dump = simulator.execute(Dump()).content
+    assert dump.endswith('# gates removed: 2, gates fused: 1\n')
+    simulator.close()
@@ -0,0 +1,91 @@
+import pytest
+
+from pyqserver.parser import *
+from pyqserver.session import Session
+from pyqserver.backends import create_simulator
+
+
+@pytest.mark.parametrize('line, message', [
+    ('FOO 1', 'Unrecognized operation'),
+    ('q 0', 'Unrecognized operation'),
+    ('Q', 'Command Q requires an argument'),
+    ('Q 1 2', '2 is not a bit, must be 0 or 1'),
+    ('Q a', 'a is not a natural number'),
+    ('Q 1 1 1', 'Command Q requires at most two arguments'),
+    ('Q  0', ' is not a natural number'),
+    ('N', 'Command N requires exactly one argument'),
+    ('N 1 2', 'Command N requires exactly one argument'),
+    ('M', 'Command M requires exactly one argument'),
+    ('R x', 'x is not a natural number'),
+    ('D', 'Command D requires exactly one argument'),
+    ('X', 'Command X requires at least one argument'),
+    ('H a', 'a is not a natural number'),
+    ('T 1 b', 'b is not a natural number'),
+    ('ROT', 'Command ROT requires at least two arguments'),
+    ('ROT 0.5', 'Command ROT requires at least two arguments'),
+    ('ROT x 1', 'x is not a float'),
+    ('ROT 0.5 x', 'x is not a natural number'),
+    ('CROT 1 2', 'Command CROT requires at least three arguments'),
+    ('CROT x 1 2', 'x is not a float'),
+    ('CNOT 1', 'Command CNOT requires at least two arguments'),
+    ('CNOT a 1', 'a is not a natural number'),
+    ('TOF 1 2', 'Command TOF requires at least three arguments'),
+    ('CZ 1', 'Command CZ requires at least two arguments'),
+    ('CY', 'Command CY requires at least two arguments'),
+    ('DIAG 1 2', 'Command DIAG requires at least three arguments'),
+    ('DIAG a 1 2', 'a is not a float'),
+    ('protocol', 'Command Protocol requires exactly one argument'),
+    ('protocol x', 'x is not a natural number'),
+    ('shots', 'Command Shots requires exactly one argument'),
+    ('shots 1 2', 'Command Shots requires exactly one argument'),
+    ('threads', 'Command Threads requires exactly one argument'),
+    ('precision half', 'Command precision requires one argument, single or double'),
+    ('stats a b', 'Command stats takes at most one argument, session or server'),
+    ('snapshot', 'Command Snapshot requires exactly one argument'),
+    ('restore a b', 'Command Restore requires exactly one argument'),
+])
+def test_parse_errors(line, message):
+    with pytest.raises(ParseError) as e:
+        parse_command(line)
+    assert str(e.value) == message
+
+
+@pytest.mark.parametrize('line, command', [
+    ('', Empty()),
+    ('# comment', Empty()),
+    ('Q 3', Q(3, False)),
+    ('B 3 1', B(3, True)),
+    ('T* 2 0 1', TInv(2, [0, 1])),
+    ('ROT 0.5 1 2', Rot(0.5, 1, [2])),
+    # the target comes first, then the controls
+    ('CNOT 1 0', CNOT(0, 1, [])),
+    ('CROT 0.5 1 0', CRot(0.5, 0, 1, [])),
+    ('TOF 2 1 0 3', Toffoli(0, 1, 2, [3])),
+    ('stats', Stats('session')),
+    ('precision single', Precision('single')),
+    ('snapshot a', Snapshot('a')),
+    ('dump', Dump()),
+])
+def test_parse(line, command):
+    assert parse_command(line) == command
+
+
+def test_parse_commands():
+    # every line yields its command or its error, lines being stripped
+    commands = parse_commands(' Q 0\nFOO\n\nH 0 \nM\n')
+    assert commands[0] == Q(0)
+    assert isinstance(commands[1], ParseError)
+    assert str(commands[1]) == 'Unrecognized operation'
+    assert commands[2:4] == [Empty(), H(0, [])]
+    assert str(commands[4]) == 'Command M requires exactly one argument'
+    assert len(commands) == 5
+
+
+@pytest.mark.parametrize('protocol', [1, 3])
+def test_session_replies(protocol):
+    # line by line and pipelined sessions reply the same
+    session = Session(lambda: create_simulator('numpy'), debug=False)
+    replies = b''.join(session.feed(b'Universal\nprotocol %d\nQ 0\nROT x 0\nFOO\nR\n' % protocol))
+    assert replies == (b'! Parse error: x is not a float. Try help.\n'
+                       b'! Parse error: Unrecognized operation. Try help.\n'
+                       b'! Parse error: Command R requires exactly one argument. Try help.\n')
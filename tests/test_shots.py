@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from pyqserver.session import Session
+from pyqserver.backends import create_simulator
+
+
+def start_session(sim_method: str = 'numpy', protocol: int = 2) -> Session:
+    session = Session(lambda: create_simulator(sim_method), debug=False)
+    session.handle_line('Universal')
+    session.simulator.rng = np.random.default_rng(0)
+    session.handle_line('protocol %d' % protocol)
+    return session
+
+
+def run_block(session: Session, shots: int, lines: list) -> list:
+    """Counts of every read of the block, as (zeros, ones)"""
+    for line in ['shots %d' % shots] + lines:
+        assert session.handle_line(line) is None
+    reply = session.handle_line('end').decode()
+    counts = []
+    for line in reply.splitlines():
+        assert line.startswith('Reply "') and line.endswith('"')
+        zeros, ones = line[len('Reply "'):-1].split(' ')
+        counts.append((int(zeros[len('0:'):]), int(ones[len('1:'):])))
+    return counts
+
+
+@pytest.mark.parametrize('sim_method', ['numpy', 'sparse', 'mps', 'auto'])
+def test_deterministic_reads(sim_method):
+    session = start_session(sim_method)
+    counts = run_block(session, 100, ['Q 0', 'Q 1', 'X 0', 'M 0', 'M 1', 'R 0', 'R 1'])
+    assert counts == [(0, 100), (100, 0)]
+
+
+@pytest.mark.parametrize('sim_method', ['numpy', 'sparse', 'mps', 'auto'])
+def test_statistics(sim_method):
+    shots = 10000
+    session = start_session(sim_method)
+    (zeros, ones), = run_block(session, shots, ['Q 0', 'H 0', 'M 0', 'R 0'])
+    assert zeros + ones == shots
+    # within six standard deviations of a fair coin
+    assert abs(zeros - shots / 2) < 6 * np.sqrt(shots / 4)
+
+
+def test_correlated_reads():
+    # the gate after the first measurement makes it branch, and the second follows its branch
+    # (CNOT takes its target first)
+    session = start_session()
+    lines = ['Q 0', 'Q 1', 'Q 2', 'H 0', 'CNOT 1 0', 'M 0', 'X 2', 'M 1', 'R 0', 'R 1']
+    first, second = run_block(session, 1000, lines)
+    assert sum(first) == 1000
+    assert first == second
+
+
+def test_state_is_restored():
+    session = start_session()
+    for line in ['Q 0', 'H 0']:
+        session.handle_line(line)
+    before = session.handle_line('dump')
+    run_block(session, 100, ['M 0', 'R 0'])
+    assert session.handle_line('dump') == before
+
+
+@pytest.mark.parametrize('protocol, lines, error', [
+    (1, ['shots 10'], 'Shot blocks require protocol 2'),
+    (2, ['end'], 'No shot block to end'),
+    (2, ['shots 10', 'shots 10'], 'Shot blocks cannot be nested'),
+    (2, ['shots 0'], 'Shot blocks need at least one shot'),
+    (2, ['shots -5'], 'Shot blocks need at least one shot'),
+])
+def test_errors(protocol, lines, error):
+    session = start_session(protocol=protocol)
+    replies = [session.handle_line(line) for line in lines]
+    assert replies[-1] == b'Usage error "! %s"\n' % error.encode()
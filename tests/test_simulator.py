@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+
+from pyqserver.parser import *
+from pyqserver.simulator import OK, Reply, UsageError
+from pyqserver.backends import create_simulator
+
+
+def run(simulator, commands: list) -> list:
+    return [simulator.execute(command) for command in commands]
+
+
+BELL = [Q(0), Q(1), H(0, []), CNOT(0, 1, [])]
+
+
+@pytest.mark.parametrize('sim_method', ['numpy', 'sparse', 'factored', 'mps'])
+def test_lazy_measurement(sim_method):
+    simulator = create_simulator(sim_method, lazy_measurement=True)
+    run(simulator, BELL + [M(0), M(1)])
+    # nothing is measured until a bit is read
+    assert simulator.pending_measurements == 2
+    first, second = run(simulator, [R(0), R(1)])
+    assert first == second
+    assert simulator.pending_measurements == 0
+    simulator.close()
+
+
+def test_pending_measurements_are_joint(monkeypatch):
+    simulator = create_simulator('numpy', queueing=True, lazy_measurement=True)
+    calls = []
+    measure_many = simulator._measure_many
+    monkeypatch.setattr(simulator, '_measure_many', lambda regs: (calls.append(list(regs)),
+                                                                  measure_many(regs)))
+    run(simulator, BELL + [M(0), M(1), R(0)])
+    assert calls == [[0, 1]]
+    simulator.close()
+
+
+def test_lazy_outcomes():
+    # both correlated outcomes of a Bell pair show up
+    outcomes = set()
+    for seed in range(20):
+        simulator = create_simulator('numpy', lazy_measurement=True)
+        simulator.rng = np.random.default_rng(seed)
+        replies = run(simulator, BELL + [M(0), M(1), R(0), R(1)])
+        outcomes.add((replies[-2].message, replies[-1].message))
+        simulator.close()
+    assert outcomes == {('0', '0'), ('1', '1')}
+
+
+@pytest.mark.parametrize('lazy_measurement', [False, True])
+def test_bit_registers(lazy_measurement):
+    simulator = create_simulator('numpy', lazy_measurement=lazy_measurement)
+    assert run(simulator, [B(3, True), R(3)]) == [OK(), Reply('1')]
+    assert run(simulator, [B(3), N(3), R(3)])[-1] == Reply('1')
+
+    # negating a pending measurement's bit runs the measurement first
+    assert run(simulator, [Q(0), X(0, []), M(0), N(0), R(0)])[-1] == Reply('0')
+
+    # dropping a bit
+    run(simulator, [B(4, True), D(4)])
+    assert 4 not in simulator.bit_register
+    with pytest.raises(UsageError, match='Register 4 is not a bit'):
+        simulator.execute(N(4))
+    simulator.close()
+
+
+def test_discard():
+    simulator = create_simulator('numpy')
+    run(simulator, BELL + [D(0)])
+    # discarding leaves no bit, and the other half of the pair in a basis state
+    assert 0 not in simulator.bit_register
+    assert simulator.num_qubits == 1
+    assert sorted(np.abs(simulator.state) ** 2) == pytest.approx([0, 1])
+    with pytest.raises(UsageError, match='Register 7 does not exist'):
+        simulator.execute(D(7))
+    simulator.close()
+
+
+def flushing_simulator(**options):
+    simulator = create_simulator('numpy', queueing=True, metrics=True, **options)
+    run(simulator, [Q(reg) for reg in range(4)])
+    simulator._execute_queue()
+    simulator.metrics.counters.clear()
+    return simulator
+
+
+def flushes(simulator) -> dict:
+    return {name: n for name, n in simulator.metrics.counters.items()
+            if name.startswith('flushes_')}
+
+
+def test_flush_on_gates():
+    simulator = flushing_simulator(flush_gates=4)
+    run(simulator, [T(0, []) for _ in range(5)])
+    assert flushes(simulator) == {'flushes_gates': 1}
+    assert len(simulator.queue) == 1
+
+
+def test_flush_on_cost():
+    # queued commands times qubits
+    simulator = flushing_simulator(flush_cost=8)
+    run(simulator, [T(0, []) for _ in range(3)])
+    assert flushes(simulator) == {'flushes_cost': 1}
+    assert len(simulator.queue) == 1
+
+
+def test_flush_on_delay(monkeypatch):
+    simulator = flushing_simulator(flush_delay=0.1)
+    clock = [100.0]
+    monkeypatch.setattr('pyqserver.simulator.time.monotonic', lambda: clock[0])
+    run(simulator, [T(0, []), T(0, [])])
+    assert flushes(simulator) == {}
+    clock[0] += 1
+    simulator.execute(T(0, []))
+    assert flushes(simulator) == {'flushes_delay': 1}
+    assert len(simulator.queue) == 1
+
+
+def test_flush_on_disjoint():
+    # from 2 queued commands on, a command on other registers starts a new queue
+    simulator = flushing_simulator(flush_gates=32)
+    run(simulator, [H(0, []), CNOT(0, 1, []), T(1, []), X(3, [])])
+    assert flushes(simulator) == {'flushes_disjoint': 1}
+    assert simulator.queue == [X(3, [])]
+
+
+def test_no_flush():
+    simulator = flushing_simulator()
+    run(simulator, [T(reg % 4, []) for reg in range(100)])
+    assert flushes(simulator) == {}
+    assert len(simulator.queue) == 100
@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+from functools import partial
+
+from pyqserver.parser import *
+from pyqserver.simulator import Reply, UsageError
+from pyqserver.backends import create_simulator
+from pyqserver.workers import WorkerPool
+from pyqserver.snapshots import SNAPSHOTS, CachedState, SnapshotCache
+
+
+def cached(nbytes: int) -> CachedState:
+    return CachedState(object, None, 0, nbytes, np.complex64)
+
+
+def test_eviction():
+    cache = SnapshotCache(max_bytes=100)
+    for name in 'abc':
+        assert cache.put(name, cached(40))
+    # c pushed the cache over its limit, so the least recently used a went
+    assert cache.get('a') is None
+    assert cache.nbytes == 80
+
+    # reading b makes c the least recently used
+    cache.get('b')
+    cache.put('d', cached(40))
+    assert cache.get('c') is None
+    assert set(cache.states) == {'b', 'd'}
+
+
+def test_replace():
+    cache = SnapshotCache(max_bytes=100)
+    cache.put('a', cached(60))
+    cache.put('a', cached(30))
+    assert cache.nbytes == 30
+    assert cache.get('a').nbytes == 30
+
+
+def test_too_large():
+    cache = SnapshotCache(max_bytes=100)
+    cache.put('a', cached(50))
+    assert not cache.put('b', cached(101))
+    assert cache.get('a') is not None
+    assert cache.nbytes == 50
+
+
+@pytest.fixture
+def snapshots(monkeypatch):
+    """The process' snapshot cache, emptied and with the given limit"""
+    def limit(max_bytes: int) -> SnapshotCache:
+        monkeypatch.setattr(SNAPSHOTS, 'max_bytes', max_bytes)
+        monkeypatch.setattr(SNAPSHOTS, 'states', type(SNAPSHOTS.states)())
+        monkeypatch.setattr(SNAPSHOTS, 'nbytes', 0)
+        return SNAPSHOTS
+    return limit
+
+
+def run(simulator, commands: list):
+    return [simulator.execute(command) for command in commands]
+
+
+def test_restore(snapshots):
+    snapshots(1 << 20)
+    simulator = create_simulator('numpy')
+    run(simulator, [Q(0), H(0, []), Snapshot('plus')])
+    expected = simulator.state.copy()
+
+    # changing the state after the snapshot leaves the snapshot as it was
+    run(simulator, [X(0, []), Q(1, True)])
+    other = create_simulator('numpy')
+    run(other, [Restore('plus')])
+    assert np.array_equal(other.state, expected)
+    assert other.qubit_map == {0: 0}
+
+    # and so does changing the restored state
+    run(other, [T(0, []), Restore('plus')])
+    assert np.array_equal(other.state, expected)
+    simulator.close()
+    other.close()
+
+
+def test_evicted_snapshot(snapshots):
+    # room for one snapshot of two qubits in single precision
+    snapshots(32)
+    simulator = create_simulator('numpy')
+    run(simulator, [Q(0), Q(1), Snapshot('a'), H(0, []), Snapshot('b')])
+    run(simulator, [Restore('b')])
+    with pytest.raises(UsageError, match='No snapshot named a'):
+        simulator.execute(Restore('a'))
+    with pytest.raises(UsageError, match='does not fit in the snapshot cache'):
+        run(simulator, [Q(2), Snapshot('c')])
+    simulator.close()
+
+
+def test_other_backend(snapshots):
+    snapshots(1 << 20)
+    simulator = create_simulator('sparse')
+    run(simulator, [Q(0), Snapshot('sparse')])
+    other = create_simulator('numpy')
+    with pytest.raises(UsageError, match='Snapshot sparse was taken by SparseSimulator'):
+        other.execute(Restore('sparse'))
+    simulator.close()
+    other.close()
+
+
+def test_worker_pool():
+    # sessions on different workers restore each other's snapshots
+    pool = WorkerPool(partial(create_simulator, 'numpy'), num_workers=2)
+    a, b = pool.open_session(), pool.open_session()
+    try:
+        assert a.worker is not b.worker
+        run(a, [Q(0), X(0, []), Snapshot('prep')])
+        assert run(b, [Restore('prep'), M(0), R(0)])[-1] == Reply('1')
+
+        # the snapshot taken last under a name is restored
+        run(a, [X(0, []), Snapshot('prep')])
+        assert run(b, [Restore('prep'), M(0), R(0)])[-1] == Reply('0')
+        run(b, [Q(0), X(0, []), Snapshot('prep')])
+        assert run(a, [Restore('prep'), M(0), R(0)])[-1] == Reply('1')
+    finally:
+        a.close()
+        b.close()
+        pool.stop()